@@ -0,0 +1,47 @@
+import hashlib
+
+from polygon.ast.node import Node
+from polygon.ast.scan import Scan
+
+# bookkeeping attached to the nodes while the queries are initialized and encoded
+IGNORED = {
+    'label', 'parent', 'ctx', 'initialized', 'distinct_label', 'group_by_label', 'operator_callable',
+    'str_mutant_only',
+}
+
+
+def structure(node):
+    match node:
+        case Node():
+            return node.__class__.__name__, tuple(
+                (field, structure(value)) for field, value in sorted(vars(node).items()) if field not in IGNORED
+            )
+        case list() | tuple():
+            return tuple(structure(x) for x in node)
+        case dict():
+            return tuple((key, structure(value)) for key, value in node.items())
+        case _:
+            # keeps 1, True and '1' apart
+            return type(node).__name__, repr(node)
+
+
+def scanned_tables(node):
+    match node:
+        case Scan():
+            yield node.table
+        case Node():
+            for value in vars(node).values():
+                yield from scanned_tables(value)
+        case list() | tuple():
+            for value in node:
+                yield from scanned_tables(value)
+        case dict():
+            for value in node.values():
+                yield from scanned_tables(value)
+
+
+def fingerprint(node) -> str:
+    """
+    Stable hash of the structure of an AST, unlike str() it tells apart nodes that print the same.
+    """
+    return hashlib.sha1(repr(structure(node)).encode()).hexdigest()
@@ -0,0 +1,177 @@
+import argparse
+import datetime
+import json
+import logging
+import multiprocess.pool
+import numpy as np
+import yaml
+
+from prettytable import PrettyTable
+
+from polygon.constraint_parser import ConstraintParser
+from polygon.environment import Environment
+from polygon.logger import logger
+
+PERCENTILES = [50, 95, 99]
+
+
+def load_corpus(path: str) -> list:
+    """
+    Loads benchmark cases from a JSON or YAML file of the form
+
+        schemas: {name: schema, ...}        # optional, shared by the cases
+        cases:
+          - name: ...
+            schema: name or schema
+            constraints: list of parsed constraints or a constraint string   # optional
+            q1: ...
+            q2: ...
+            expected: EQU or NEQ            # optional
+    """
+    with open(path) as f:
+        corpus = json.load(f) if path.endswith('.json') else yaml.safe_load(f)
+
+    schemas = corpus.get('schemas', {})
+    constraint_parser = ConstraintParser()
+    cases = []
+    for idx, case in enumerate(corpus['cases']):
+        schema = case['schema']
+        constraints = case.get('constraints') or []
+        if isinstance(constraints, str):
+            constraints = constraint_parser.parse(constraints)
+        cases.append({
+            'name': case.get('name', f'case_{idx}'),
+            'schema': schemas[schema] if isinstance(schema, str) else schema,
+            'constraints': constraints,
+            'q1': case['q1'],
+            'q2': case['q2'],
+            'expected': case.get('expected'),
+        })
+    return cases
+
+
+def run_case(case: dict, bound=2, k=None, time_budget=60, options=None) -> dict:
+    env = Environment(case['schema'], case['constraints'], bound=bound, time_budget=time_budget, **(options or {}))
+    if k is not None:
+        env.default_k = dict.fromkeys(env.default_k, k)
+
+    start = datetime.datetime.now()
+    try:
+        eq, cex, checking_time, total_time, ret = env.check(case['q1'], case['q2'])
+    except Exception as e:
+        logger.error(f"{case['name']}: {e}")
+        ret = {'status': 'ERR'}
+    latency = (datetime.datetime.now() - start).total_seconds()
+
+    status = ret.get('status')
+    return {
+        'name': case['name'],
+        'status': status,
+        'expected': case['expected'],
+        'correct': None if case['expected'] is None or status not in ['EQU', 'NEQ'] else status == case['expected'],
+        'latency': latency,
+        'iterations': ret.get('iters', 0),
+        'backtracks': ret.get('backtracks', 0),
+        'solving_time': sum(ret.get('solving_time_per_iter', [])),
+        'fast_path': ret.get('fast_path'),
+    }
+
+
+def summarize(results: list, wall_time: float) -> dict:
+    latencies = [result['latency'] for result in results]
+    statuses = [result['status'] for result in results]
+    solved = [result for result in results if result['status'] in ['EQU', 'NEQ']]
+    summary = {
+        'cases': len(results),
+        'wall_time': wall_time,
+        'throughput': len(results) / wall_time if wall_time > 0 else None,
+        'timeout_rate': statuses.count('TMO') / len(results),
+        'error_rate': statuses.count('ERR') / len(results),
+        'wrong': sum(result['correct'] is False for result in results),
+        'mean_iterations': float(np.mean([result['iterations'] for result in solved])) if solved else None,
+        'mean_backtracks': float(np.mean([result['backtracks'] for result in solved])) if solved else None,
+        # time spent waiting for check-sat, over the time of the checks
+        'solver_time_share': sum(result['solving_time'] for result in results) / sum(latencies)
+        if sum(latencies) > 0 else None,
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = float(np.percentile(latencies, percentile))
+    return summary
+
+
+def run(cases: list, bound=2, k=None, time_budget=60, options=None, concurrency=1) -> dict:
+    def task(case):
+        result = run_case(case, bound, k, time_budget, options)
+        logger.info(f"{result['name']}: {result['status']} in {result['latency']:.2f}s")
+        return result
+
+    start = datetime.datetime.now()
+    # every check runs in a process of its own, threads only wait for them
+    with multiprocess.pool.ThreadPool(concurrency) as pool:
+        results = pool.map(task, cases)
+    wall_time = (datetime.datetime.now() - start).total_seconds()
+
+    return {
+        'settings': {'bound': bound, 'k': k, 'time_budget': time_budget, 'options': options or {},
+                     'concurrency': concurrency},
+        'summary': summarize(results, wall_time),
+        'cases': sorted(results, key=lambda result: result['name']),
+    }
+
+
+def format_summary(report: dict, baseline: dict = None) -> str:
+    table = PrettyTable(['metric', 'value'] if baseline is None else ['metric', 'baseline', 'value'])
+    table.align = 'r'
+    for metric, value in report['summary'].items():
+        row = [metric, value] if baseline is None else [metric, baseline['summary'].get(metric), value]
+        table.add_row([f'{x:.4f}' if isinstance(x, float) else x for x in row])
+    out = table.get_string()
+
+    if baseline is not None:
+        # verdicts that changed between the runs
+        before = {result['name']: result['status'] for result in baseline['cases']}
+        changed = [
+            f"{result['name']}: {before[result['name']]} -> {result['status']}"
+            for result in report['cases']
+            if result['name'] in before and before[result['name']] != result['status']
+        ]
+        if changed:
+            out = '\n'.join([out, 'changed verdicts:', *changed])
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a corpus of query pairs through Environment.check.')
+    parser.add_argument('corpus', help='JSON or YAML file, see load_corpus()')
+    parser.add_argument('--bound', type=int, default=2)
+    parser.add_argument('--k', type=int, default=None, help='under-approximation size of every operator')
+    parser.add_argument('--time-budget', type=int, default=60)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=JSON',
+                        help='Environment option, e.g. --option lazy_encoding=false')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.WARNING)
+
+    options = {}
+    for option in args.option:
+        name, _, value = option.partition('=')
+        options[name] = json.loads(value)
+
+    report = run(load_corpus(args.corpus), args.bound, args.k, args.time_budget, options, args.concurrency)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_summary(report, baseline))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
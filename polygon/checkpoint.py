@@ -0,0 +1,35 @@
+import os
+import pickle
+
+
+class Checkpoint:
+    """
+    Search state of a check, written to <directory>/<key>.pkl at every iteration of the search, so that a check of
+    the same pair that timed out resumes where it stopped. The key is the canonical hash of the pair and only names the
+    file; the state is restored only if it was written for the same queries, schema and settings.
+    """
+
+    def __init__(self, directory: str, key: str, fingerprint: str):
+        self.path = os.path.join(directory, f'{key}.pkl')
+        self.fingerprint = fingerprint
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                fingerprint, state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return state if fingerprint == self.fingerprint else None
+
+    def save(self, state: dict):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # a terminated check must not leave a partially written checkpoint behind
+        with open(f'{self.path}.tmp', 'wb') as f:
+            pickle.dump((self.fingerprint, state), f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
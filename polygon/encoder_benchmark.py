@@ -0,0 +1,187 @@
+import argparse
+import gc
+import json
+import logging
+import time
+import tracemalloc
+
+from prettytable import PrettyTable
+
+from polygon.environment import Environment
+from polygon.formulas.integrity_constraint import encode_integrity_constraints
+from polygon.logger import logger
+from polygon.smt.ast import *
+from polygon.sql_parser import SQLParser
+from polygon.visitors.query_encoder import QueryEncoder
+
+# r(a, b, c) and s(a, b) with s.b referencing r.a
+SCHEMA = [
+    {
+        'TableName': 'r',
+        'PKeys': [{'Name': 'a', 'Type': 'int'}],
+        'FKeys': [],
+        'Others': [{'Name': 'b', 'Type': 'int'}, {'Name': 'c', 'Type': 'int'}],
+    },
+    {
+        'TableName': 's',
+        'PKeys': [{'Name': 'a', 'Type': 'int'}],
+        'FKeys': [{'FName': 'b', 'PTable': 0, 'PName': 'a'}],
+        'Others': [],
+    },
+]
+
+# operator -> (label prefix, query using it, environment options)
+OPERATORS = {
+    'FFilter': ('filter$', 'SELECT a FROM r WHERE b > 1', {}),
+    'FProject': ('project$', 'SELECT a + b FROM r', {}),
+    'FInnerJoin': ('inner_join$', 'SELECT r.a FROM r JOIN s ON r.a = s.b', {}),
+    'FLeftJoin': ('left_join$', 'SELECT r.a FROM r LEFT JOIN s ON r.a = s.b', {}),
+    # full joins are only encoded on a key of the right table
+    'FFullJoin': ('full_join$', 'SELECT r.a FROM r FULL JOIN s ON r.a = s.a', {'key_joins': True}),
+    'FProduct': ('product$', 'SELECT r.a FROM r CROSS JOIN s', {}),
+    'FGroupBy': ('group_by$', 'SELECT b, SUM(c) FROM r GROUP BY b', {}),
+    'FDistinct': ('distinct$', 'SELECT DISTINCT b FROM r', {}),
+    'FOrderBy': ('order_by$', 'SELECT a, b FROM r ORDER BY b LIMIT 1', {}),
+    'FUnion': ('union$', 'SELECT a FROM r UNION SELECT a FROM s', {}),
+}
+ENCODERS = [*OPERATORS, 'o1_eq_o2', 'encode_integrity_constraints']
+
+
+def encode_queries(env, queries):
+    parser = SQLParser()
+    outputs = []
+    for query_id, query in enumerate(queries):
+        env.curr_query_id = query_id
+        ast = parser.parse_query(parser.parse(query))
+        encoder = QueryEncoder(env)
+        encoder.output_table = ast.accept(encoder)
+        if getattr(ast, 'order_by_clause', None) is not None:
+            # queries are compared as bags, so the query encoder leaves ORDER BY out
+            encoder.output_table = ast.order_by_clause.accept(encoder)
+        outputs.append(encoder.output_table)
+    env.initialized = True
+    return outputs
+
+
+def force(env, labels):
+    for label in labels:
+        for encode in env.formulas.deferred.pop(label, []):
+            encode()
+
+
+def prepare(env, encoder):
+    """
+    Encodes everything the encoder depends on, and returns a function running the encoder alone with the labels
+    it encodes.
+    """
+    match encoder:
+        case 'o1_eq_o2':
+            o1, o2 = encode_queries(env, ['SELECT a, b FROM r', 'SELECT a, b FROM s'])
+            force(env, list(env.formulas.deferred))
+            return lambda: env.formulas.append(Not(env.o1_eq_o2(o1, o2)), label='neq'), ['neq']
+        case 'encode_integrity_constraints':
+            del env.formulas.formulas['ic']
+            return lambda: env.formulas.append(encode_integrity_constraints(env.constraints, env), label='ic'), ['ic']
+        case _:
+            prefix, query, _ = OPERATORS[encoder]
+            encode_queries(env, [query])
+            labels = [label for label in env.formulas.deferred if label.startswith(prefix)]
+            force(env, [label for label in list(env.formulas.deferred) if label not in labels])
+            return lambda: force(env, labels), labels
+
+
+def environment(encoder, bound, k):
+    options = OPERATORS[encoder][2] if encoder in OPERATORS else {}
+    # operators are encoded lazily, so that each one can be run on its own
+    env = Environment(SCHEMA, [], bound=bound, lazy_encoding=True, fast_path=False, **options)
+    env.default_k = dict.fromkeys(env.default_k, k if k is not None else bound)
+    return env
+
+
+def measure(encoder, bound, k=None, repeat=3, timeout=60) -> dict:
+    # encoding time, best of repeat
+    timings = []
+    for _ in range(repeat):
+        env = environment(encoder, bound, k)
+        encode, labels = prepare(env, encoder)
+        start = time.perf_counter()
+        encode()
+        timings.append(time.perf_counter() - start)
+
+    # memory blocks still allocated after encoding, measured apart since tracing slows encoding down
+    env = environment(encoder, bound, k)
+    encode, labels = prepare(env, encoder)
+    before = set(env.formulas.formulas)
+    gc.collect()
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    encode()
+    allocated = tracemalloc.take_snapshot().compare_to(snapshot, 'filename')
+    tracemalloc.stop()
+
+    # the encoded labels alone, e.g., an order by also adds a size label
+    labels = [label for label in env.formulas.formulas if label in labels or label not in before]
+    env.formulas.formulas = {label: env.formulas.formulas[label] for label in labels}
+    env.formulas.labels_considered = set(labels)
+    start = time.perf_counter()
+    formula = env.formulas.dump()
+    serialize_time = time.perf_counter() - start
+
+    prover = env.formulas.new_prover(timeout)
+    sat = prover.check(formula, theory=env.formulas.theory)
+    prover.smt_process.terminate()
+
+    statistics = env.formulas.statistics
+    return {
+        'encoder': encoder,
+        'bound': bound,
+        'k': k if k is not None else bound,
+        'encode_ms': min(timings) * 1000,
+        'objects': sum(stat.count_diff for stat in allocated),
+        'allocated_kib': sum(stat.size_diff for stat in allocated) / 1024,
+        'nodes': sum(stats['nodes'] for stats in statistics['labels'].values()) + statistics['definitions']['nodes'],
+        'bytes': len(formula),
+        'serialize_ms': serialize_time * 1000,
+        'solve_ms': prover.checking_time * 1000,
+        'sat': sat,
+        'theory': env.formulas.theory,
+    }
+
+
+def format_results(results: list) -> str:
+    columns = ['encoder', 'bound', 'k', 'encode_ms', 'objects', 'allocated_kib', 'nodes', 'bytes', 'serialize_ms',
+               'solve_ms', 'sat']
+    table = PrettyTable(columns)
+    table.align = 'r'
+    table.align['encoder'] = 'l'
+    for result in results:
+        table.add_row([f'{result[c]:.2f}' if isinstance(result[c], float) else result[c] for c in columns])
+    return table.get_string()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Encode every operator on its own over a synthetic schema.')
+    parser.add_argument('--encoders', nargs='+', choices=ENCODERS, default=ENCODERS)
+    parser.add_argument('--bounds', nargs='+', type=int, default=list(range(1, 9)))
+    parser.add_argument('--k', type=int, default=None, help='under-approximation size, the bound by default')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=int, default=60, help='solver timeout in seconds')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.WARNING)
+
+    results = []
+    for encoder in args.encoders:
+        for bound in args.bounds:
+            results.append(measure(encoder, bound, args.k, args.repeat, args.timeout))
+            logger.info(f'{encoder} at bound {bound}: {results[-1]}')
+    print(format_results(results))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
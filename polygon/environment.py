@@ -1,4 +1,9 @@
+import cProfile
 import datetime
+import hashlib
+import os
+import signal
+import sys
 import traceback
 import multiprocess.pool
 import numpy as np
@@ -8,36 +13,87 @@ from typing import Tuple
 
 from polygon.ast.expressions.attribute import Attribute
 from polygon.ast.expressions.literal import Literal
+from polygon.ast.fingerprint import fingerprint, scanned_tables
+from polygon.checkpoint import Checkpoint
+from polygon.formulas.duplicates import symbol, tuple_equal, values_equal
 from polygon.formulas.integrity_constraint import encode_integrity_constraints
 from polygon.logger import logger
+from polygon.metrics import Registry, measured
 #from polygon.mutation import generate_mutants
 from polygon.schemas import *
 from polygon.smt.ast import *
 from polygon.smt.formula import FormulaManager
 from polygon.smt.provers.smtlibv2 import SMTLIBv2
 from polygon.sql_parser import SQLParser
+from polygon.tracing import Tracer, traced
 from polygon.utils import create_empty_table
 from polygon.variables import *
+from polygon.visitors.canonicalizer import Canonicalizer
+from polygon.visitors.decorrelator import Decorrelator
 from polygon.visitors.expression_encoder import ExpressionEncoder
 from polygon.visitors.initializer import Initializer
 from polygon.visitors.query_encoder import QueryEncoder
+from polygon.visitors.table_usage import TableUsage
 from polygon.visitors.underapproximator import Underapproximator
 from polygon.visitors.visitor import Visitor
 
 
 class Environment:
-    def __init__(self, schema, constraints, bound=2, time_budget=60, default_k=None):
+    def __init__(self, schema, constraints, bound=2, time_budget=60, default_k=None, simplify=True, theory=None,
+                 flat_constants=False, choice_encoding='int', order_by_encoding='pairwise',
+                 key_joins=False, table_bounds=None, bound_policy='global', bag_equality='multiplicity',
+                 aggregate_encoding='fold', decorrelate=True, fast_path=True, lazy_encoding=True,
+                 encoding_workers=None, trace=False, profile=None, metrics=None,
+                 checkpoint=None):
         self.db = Database()
         self.bound_size = bound
+        # per-table bounds by table name, the global bound stays the maximum
+        self.table_bounds = {table.lower(): table_bound for table, table_bound in (table_bounds or {}).items()}
+        # 'usage' derives the bounds of tables not in table_bounds from how the queries use them
+        self.bound_policy = bound_policy
+        self.usage_bounds = {
+            'driving': bound,
+            'lookup': max(1, (bound + 1) // 2),
+            'subquery': max(1, (bound + 1) // 2),
+            'unused': 1,
+        }
+        self.inferred_bounds = {}
         self.table_id_counter = -1
 
         self.schema = schema
         self.constraints = constraints
 
         self.time_budget = time_budget
+        self.simplify = simplify
+        self.theory = theory
+        self.flat_constants = flat_constants
+        self.choice_encoding = choice_encoding
+        self.order_by_encoding = order_by_encoding
+        self.key_joins = key_joins
+        self.bag_equality = bag_equality
+        # 'tournament' combines MAX/MIN/COALESCE operands as a balanced tree instead of a chain
+        self.aggregate_encoding = aggregate_encoding
+        # rewrite correlated subqueries into joins before encoding
+        self.decorrelate = decorrelate
+        # answer syntactically equivalent pairs and pairs of different arity without solving
+        self.fast_path = fast_path
+        # encode an operator only once the search considers it, shapes and bounds are still computed up front
+        self.lazy_encoding = lazy_encoding
+        # number of processes printing the operator encodings to SMT-LIB, None prints them in this process
+        self.encoding_workers = encoding_workers
+        # spans of the phases of every check, see Tracer.export()
+        self.tracer = Tracer(trace)
+        # directory receiving a cProfile file of the checking process of every check, see profiled_task()
+        self.profile = profile
+        # registry counting checks, searches, solver calls and cache lookups, see Registry.export()
+        self.metrics = metrics if metrics is not None else Registry(enabled=False)
+        # directory of the search state of checks, a check that timed out resumes from it, see Checkpoint
+        self.checkpoint = checkpoint
         self.integrity_constraints = []
         self.formulas = FormulaManager(self)
         self.formulas.timeout = self.time_budget
+        # (fingerprint, query id or None) -> output table of an uncorrelated subquery
+        self.subquery_tables = {}
 
         # z3 variables
         self.cell = SMTCell
@@ -118,13 +174,85 @@ class Environment:
             return candidates[string_hash % len(candidates)] + str(string_hash)
         return str(string_hash)
 
+    def table_bound(self, table_name: str) -> int:
+        table_bound = self.table_bounds.get(table_name, self.inferred_bounds.get(table_name, self.bound_size))
+        return min(table_bound, self.bound_size)
+
+    def syntactic_check(self, asts):
+        """
+        Verdict of check() for queries with the same canonical form or a different number of output columns,
+        None otherwise. Relations of different arity differ on any database, the empty one included.
+        """
+        start = datetime.datetime.now()
+        canonicalizer = Canonicalizer()
+        hashes = [canonicalizer.hash(ast) for ast in asts]
+        arities = [canonicalizer.arity(ast) for ast in asts]
+
+        ret = {'canonical_hash': hashes}
+        if hashes[0] == hashes[1]:
+            ret['status'] = 'EQU'
+            ret['fast_path'] = 'canonical'
+            ret['total_time'] = (datetime.datetime.now() - start).total_seconds()
+            return True, None, None, ret['total_time'], ret
+        if None not in arities and arities[0] != arities[1]:
+            ret['status'] = 'NEQ'
+            ret['fast_path'] = 'arity'
+            ret['cex'] = {
+                table['TableName'].lower(): [[column.column_name for column in self.db.schemas[table_idx]]]
+                for table_idx, table in enumerate(self.schema)
+            }
+            ret['total_time'] = (datetime.datetime.now() - start).total_seconds()
+            return False, ret['cex'], None, ret['total_time'], ret
+        return None
+
+    def search_checkpoint(self, queries, asts) -> Checkpoint:
+        canonicalizer = Canonicalizer()
+        key = hashlib.sha1(''.join(canonicalizer.hash(ast) for ast in asts).encode()).hexdigest()
+        # the labels and table ids in the state depend on the exact queries and on the encoding settings
+        settings = [
+            queries, self.schema, sorted({repr(constraint) for constraint in self.constraints}), self.bound_size,
+            self.default_k, self.table_bounds, self.bound_policy, self.key_joins, self.choice_encoding,
+            self.order_by_encoding, self.bag_equality, self.aggregate_encoding, self.decorrelate, self.flat_constants,
+        ]
+        return Checkpoint(self.checkpoint, key, hashlib.sha1(repr(settings).encode()).hexdigest())
+
+    def subquery_table(self, node):
+        """
+        Output table of an uncorrelated subquery. Subqueries with the same structure are encoded once, in both
+        queries of a pair unless they read tables of the current query such as CTEs.
+        """
+        scope = None
+        for table_name in scanned_tables(node):
+            try:
+                if self.db.find_table_by_name(table_name, self).scope is None:
+                    continue
+            except SyntaxError:
+                pass
+            scope = self.curr_query_id
+
+        key = fingerprint(node), scope
+        self.metrics.lookup('subquery', key in self.subquery_tables)
+        if key not in self.subquery_tables:
+            self.subquery_tables[key] = node.accept(QueryEncoder(self))
+        return self.subquery_tables[key]
+
+    def infer_table_bounds(self, asts):
+        usage = TableUsage(self.schema)
+        for ast in asts:
+            ast.accept(usage)
+        self.inferred_bounds = {table: self.usage_bounds[role] for table, role in usage.roles().items()}
+        logger.debug(f'table usage: {usage.usage}')
+
+        # rebuild the base tables and integrity constraints with the new bounds
+        self.clear()
+
     def load_schema(self, schema: list):
         self.integrity_constraints = []
         enum_constraints = []
         for idx, table in enumerate(schema):
             table_id = self.next_table_id()
             table_name = table["TableName"].lower()
-            table_bound = self.bound_size
+            table_bound = self.table_bound(table_name)
             table_schema = TableSchema(table_id, table_name, table_bound)
             column_id = 0
             for col in table['PKeys']:
@@ -404,6 +532,7 @@ class Environment:
 
                                 # reset
                                 self.formulas.formulas = {}
+                                self.formulas.deferred = {}
                                 self.formulas.next_label = 0
 
                                 self.db = Database()
@@ -542,17 +671,40 @@ class Environment:
 
         return databases
 
+    @traced('check')
+    @measured('check')
     def check(self, q1, q2, use_precise_encoding=False):
         # parse
         parser = SQLParser()
 
-        jsons = []
-        for query in [q1, q2]:
-            jsons.append(parser.parse(query))
+        with self.tracer.span('parse'):
+            jsons = []
+            for query in [q1, q2]:
+                jsons.append(parser.parse(query))
+
+            asts = []
+            for j in jsons:
+                asts.append(parser.parse_query(j))
+
+        if self.fast_path:
+            with self.tracer.span('syntactic_check') as span:
+                verdict = self.syntactic_check(asts)
+                span.set(verdict=verdict[-1]['status'] if verdict is not None else None)
+            if verdict is not None:
+                return verdict
 
-        asts = []
-        for j in jsons:
-            asts.append(parser.parse_query(j))
+        # keyed on the queries as written
+        checkpoint = self.search_checkpoint([q1, q2], asts) if self.checkpoint is not None else None
+
+        if self.decorrelate:
+            with self.tracer.span('decorrelate'):
+                asts = [ast.accept(Decorrelator(self.schema)) for ast in asts]
+
+        if self.bound_policy == 'usage':
+            self.infer_table_bounds(asts)
+
+        # after infer_table_bounds(), which starts over with a new formula manager
+        self.formulas.checkpoint = checkpoint
 
         # initializer = Initializer(self)
         #
@@ -576,12 +728,14 @@ class Environment:
                         self.curr_query_id = query_id
                         # print(repr(ast))
                         encoder = QueryEncoder(self)
-                        output = ast.accept(encoder)
+                        with self.tracer.span('encode', query_id=query_id):
+                            output = ast.accept(encoder)
                         outputs.append(output)
                         # print(output.node.label)
                     self.initialized = True
 
-                    self.formulas.append(Not(self.o1_eq_o2(outputs[0], outputs[1])), label='neq')
+                    with self.tracer.span('encode', label='neq'):
+                        self.formulas.append(Not(self.o1_eq_o2(outputs[0], outputs[1])), label='neq')
                 except Exception as e:
                     logger.error(''.join(traceback.format_tb(e.__traceback__)) + str(e))
                     ret['status'] = 'ERR'
@@ -594,10 +748,22 @@ class Environment:
                         succeed_prover = self.formulas.search(outputs, ret)
                     else:
                         succeed_prover = self.formulas.solve_precise(ret)
+                    if self.formulas.checkpoint is not None:
+                        # the verdict is final, nothing is left to resume
+                        self.formulas.checkpoint.clear()
 
                     total_time = (datetime.datetime.now() - start).total_seconds()
                     ret['complete_time'] = datetime.datetime.now()
                     ret['total_time'] = total_time
+                    ret['theory'] = self.formulas.theory
+                    ret['nonlinear_labels'] = self.formulas.nonlinear_labels
+                    # operators the search never had to encode
+                    ret['unencoded_operators'] = list(self.formulas.deferred)
+                    # the verdict only covers databases within these caps on the number of groups
+                    ret['group_caps'] = self.formulas.group_caps()
+                    ret['table_bounds'] = {
+                        table['TableName'].lower(): self.db.schemas[table_idx].bound for table_idx, table in enumerate(self.schema)
+                    }
                     if succeed_prover is None:
                         ret['status'] = 'EQU'
                         return
@@ -640,16 +806,26 @@ class Environment:
         with multiprocess.Manager() as manager:
             ret = manager.dict()
 
-            process = multiprocess.Process(target=task, args=(ret,))
-            process.start()
+            process = multiprocess.Process(target=self.traced_task(self.profiled_task(self.metered_task(task), 'check')), args=(ret,))
+            with self.tracer.span('process'):
+                with self.tracer.span('spawn'):
+                    process.start()
 
-            start = datetime.datetime.now()
-            process.join(self.time_budget)
+                start = datetime.datetime.now()
+                with self.tracer.span('join'):
+                    process.join(self.time_budget)
 
             if process.is_alive():
                 process.terminate()
+                if self.profile is not None:
+                    # the terminated process still writes its profile
+                    process.join()
                 ret['status'] = 'TMO'
                 ret['complete_time'] = datetime.datetime.now()
+            if 'trace' in ret:
+                self.tracer.merge(ret.pop('trace'))
+            if 'metrics' in ret:
+                self.metrics.merge(ret.pop('metrics'))
 
             if ret['status'] == 'ERR':
                 return None, None, None, None, dict(ret)
@@ -667,16 +843,76 @@ class Environment:
             else:
                 return True, None, None, total_time, dict(ret)
 
+    def traced_task(self, task):
+        def run(ret):
+            first = len(self.tracer.spans)
+            if self.tracer.enabled:
+                # forked inside the spawn span of the parent
+                self.tracer.stack.pop()
+            try:
+                with self.tracer.span('task'):
+                    task(ret)
+            finally:
+                # spans of the checking process are sent back with its results, by a timed out one only if profiled
+                if self.tracer.enabled:
+                    ret['trace'] = self.tracer.spans[first:]
+        return run
+
+    def metered_task(self, task):
+        if not self.metrics.enabled:
+            return task
+
+        def run(ret):
+            # counted apart and sent back with the results, since the registry of the parent is not shared
+            self.metrics = Registry()
+            try:
+                task(ret)
+            finally:
+                ret['metrics'] = self.metrics.snapshot()
+        return run
+
+    def profiled_task(self, task, name):
+        """
+        Profiles the checking process with cProfile, including the time spent waiting on the solver, and writes the
+        statistics to <profile>/<name>-<pid>.pstats, e.g., for python -m pstats or snakeviz.
+        """
+        if self.profile is None:
+            return task
+
+        def run(ret):
+            # terminating a timed out check unwinds the task, so that its profile is written too
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                task(ret)
+            finally:
+                profiler.disable()
+                os.makedirs(self.profile, exist_ok=True)
+                path = os.path.join(self.profile, f'{name}-{os.getpid()}.pstats')
+                profiler.dump_stats(path)
+                ret['profile'] = path
+        return run
+
+    @traced('disambiguate')
     def disambiguate(self, queries, group_range, use_precise_encoding=False):
         parser = SQLParser()
 
-        jsons = []
-        for query in queries:
-            jsons.append(parser.parse(query))
+        with self.tracer.span('parse'):
+            jsons = []
+            for query in queries:
+                jsons.append(parser.parse(query))
+
+            asts = []
+            for j in jsons:
+                asts.append(parser.parse_query(j))
 
-        asts = []
-        for j in jsons:
-            asts.append(parser.parse_query(j))
+        if self.decorrelate:
+            with self.tracer.span('decorrelate'):
+                asts = [ast.accept(Decorrelator(self.schema)) for ast in asts]
+
+        if self.bound_policy == 'usage':
+            self.infer_table_bounds(asts)
 
         # initializer = Initializer(self)
         #
@@ -694,7 +930,8 @@ class Environment:
                     self.curr_query_id = query_id
                     # print(repr(ast))
                     encoder = QueryEncoder(self)
-                    output = ast.accept(encoder)
+                    with self.tracer.span('encode', query_id=query_id):
+                        output = ast.accept(encoder)
                     outputs.append(output)
                     # print(output.node.label)
                 self.initialized = True
@@ -761,6 +998,15 @@ class Environment:
                 total_time = (datetime.datetime.now() - start).total_seconds()
                 ret['complete_time'] = datetime.datetime.now()
                 ret['total_time'] = total_time
+                ret['theory'] = self.formulas.theory
+                ret['nonlinear_labels'] = self.formulas.nonlinear_labels
+                # operators the search never had to encode
+                ret['unencoded_operators'] = list(self.formulas.deferred)
+                # the verdict only covers databases within these caps on the number of groups
+                ret['group_caps'] = self.formulas.group_caps()
+                ret['table_bounds'] = {
+                    table['TableName'].lower(): self.db.schemas[table_idx].bound for table_idx, table in enumerate(self.schema)
+                }
                 if succeed_prover is None:
                     ret['status'] = 'EQU'
                     return
@@ -790,16 +1036,28 @@ class Environment:
         with multiprocess.Manager() as manager:
             ret = manager.dict()
 
-            process = multiprocess.Process(target=task, args=(ret,))
-            process.start()
+            process = multiprocess.Process(
+                target=self.traced_task(self.profiled_task(self.metered_task(task), 'disambiguate')), args=(ret,)
+            )
+            with self.tracer.span('process'):
+                with self.tracer.span('spawn'):
+                    process.start()
 
-            start = datetime.datetime.now()
-            process.join(self.time_budget)
+                start = datetime.datetime.now()
+                with self.tracer.span('join'):
+                    process.join(self.time_budget)
 
             if process.is_alive():
                 process.terminate()
+                if self.profile is not None:
+                    # the terminated process still writes its profile
+                    process.join()
                 ret['status'] = 'TMO'
                 ret['complete_time'] = datetime.datetime.now()
+            if 'trace' in ret:
+                self.tracer.merge(ret.pop('trace'))
+            if 'metrics' in ret:
+                self.metrics.merge(ret.pop('metrics'))
 
             total_time = (ret['complete_time'] - start).total_seconds()
 
@@ -837,15 +1095,18 @@ class Environment:
         o2_size = Sum([If(Not(Deleted(o2.table_id, tuple_id)), Int(1), Int(0)) for tuple_id in range(o2.bound)])
 
         if len(o1.columns) == len(o2.columns):
-            lateral_bag_eq = []
-            for tuple_id in range(o1.bound):
-                lateral_bag_eq.append(
-                    Implies(
-                        Not(Deleted(o1.table_id, tuple_id)),
-                        f_multiplicity(o1, [(o1.table_id, tuple_id, column.column_id) for column in o1]) ==
-                        f_multiplicity(o2, [(o1.table_id, tuple_id, column.column_id) for column in o1])
+            if self.bag_equality == 'shared':
+                lateral_bag_eq = self.shared_multiplicities(o1, o2)
+            else:
+                lateral_bag_eq = []
+                for tuple_id in range(o1.bound):
+                    lateral_bag_eq.append(
+                        Implies(
+                            Not(Deleted(o1.table_id, tuple_id)),
+                            f_multiplicity(o1, [(o1.table_id, tuple_id, column.column_id) for column in o1]) ==
+                            f_multiplicity(o2, [(o1.table_id, tuple_id, column.column_id) for column in o1])
+                        )
                     )
-                )
             f = [o1_size == o2_size, And(lateral_bag_eq)]
 
             # sorted columns are equivalent under list semantics
@@ -886,6 +1147,39 @@ class Environment:
         else:
             return Or([o1_size > Int(0), o2_size > Int(0)])
 
+    def shared_multiplicities(self, o1, o2):
+        """
+        Same multiplicities of the tuples of o1 in o1 and o2 as f_multiplicity, but rows are compared through equality
+        variables defined once per pair of tuples, and shared by every multiplicity and every comparison of the tables.
+        """
+        def cross_equal(t1, t2):
+            return self.formulas.define(
+                f'bageq_{symbol(o1.table_id, t1, o2.table_id, t2)}',
+                And([
+                    values_equal(
+                        (self.cell(o1.table_id, t1, c1.column_id), self.null(o1.table_id, t1, c1.column_id)),
+                        (self.cell(o2.table_id, t2, c2.column_id), self.null(o2.table_id, t2, c2.column_id))
+                    )
+                    for c1, c2 in zip(o1, o2)
+                ])
+            )
+
+        lateral_bag_eq = []
+        for tuple_id in range(o1.bound):
+            in_o1 = Sum([
+                If(And([
+                    Not(Deleted(o1.table_id, other_id)),
+                    tuple_equal(self, o1, tuple_id, other_id) if other_id != tuple_id else Bool(True)
+                ]), Int(1), Int(0))
+                for other_id in range(o1.bound)
+            ])
+            in_o2 = Sum([
+                If(And([Not(Deleted(o2.table_id, other_id)), cross_equal(tuple_id, other_id)]), Int(1), Int(0))
+                for other_id in range(o2.bound)
+            ])
+            lateral_bag_eq.append(Implies(Not(Deleted(o1.table_id, tuple_id)), in_o1 == in_o2))
+        return lateral_bag_eq
+
     def copy_cell(self, original_cell, new_cell):
         return And([
             new_cell.NULL == original_cell.NULL,
@@ -899,6 +1193,7 @@ class Environment:
         self.hash_string_table = {}
 
         self.formulas = FormulaManager(self)
+        self.subquery_tables = {}
 
         self.unsat_mutants = []
 
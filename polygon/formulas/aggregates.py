@@ -0,0 +1,21 @@
+from polygon.smt.ast import *
+
+
+def tournament(env, prefix, combine, args):
+    """
+    Folds args with combine as a balanced tree instead of a chain. The winner of every match is kept in auxiliary
+    variables, so operands are not copied into both branches of the comparisons of the next round.
+    """
+    args = list(args)
+    round_id = 0
+    while len(args) > 1:
+        winners = []
+        for match_id in range(len(args) // 2):
+            winner = combine(args[2 * match_id], args[2 * match_id + 1])
+            winners.append(tuple(
+                env.formulas.define(f'{prefix}_{round_id}_{match_id}_{idx}', f)
+                for idx, f in enumerate(winner)
+            ))
+        args = winners + args[len(winners) * 2:]
+        round_id += 1
+    return args[0]
@@ -0,0 +1,48 @@
+from polygon.ast.expressions.attribute import Attribute
+from polygon.ast.expressions.expression import Expression
+from polygon.ast.expressions.literal import Literal
+from polygon.schemas import TableSchema
+
+
+def conjuncts(predicate):
+    if isinstance(predicate, Expression) and predicate.operator == 'and':
+        return [c for arg in predicate.args for c in conjuncts(arg)]
+    return [predicate]
+
+
+def resolve(table: TableSchema, attribute: Attribute):
+    try:
+        return table[attribute.name]
+    except SyntaxError:
+        return None
+
+
+def pinned_columns(table: TableSchema, predicate, correlated=False) -> set:
+    """
+    Column ids of the table that the predicate equates to a constant. Attributes of the outer query are constants
+    too when the predicate belongs to a correlated subquery, which is encoded once per outer tuple.
+    """
+    def is_constant(arg):
+        if isinstance(arg, Literal):
+            return not isinstance(arg.value, bool)
+        return correlated and isinstance(arg, Attribute) and resolve(table, arg) is None
+
+    pinned = set()
+    for conjunct in conjuncts(predicate):
+        if not (isinstance(conjunct, Expression) and conjunct.operator == 'eq' and len(conjunct.args) == 2):
+            continue
+        a, b = conjunct.args
+        for arg, other in [(a, b), (b, a)]:
+            if isinstance(arg, Attribute) and is_constant(other):
+                column = resolve(table, arg)
+                if column is not None:
+                    pinned.add(column.column_id)
+    return pinned
+
+
+def filter_max_rows(table: TableSchema, predicate, correlated=False) -> int:
+    # equality on every column of a key selects at most one tuple
+    pinned = pinned_columns(table, predicate, correlated)
+    if any(key and key <= pinned for key in table.unique_keys):
+        return min(table.bound, 1)
+    return table.bound
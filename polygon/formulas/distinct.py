@@ -1,7 +1,6 @@
-import operator
 from copy import deepcopy
-from itertools import product
 
+from polygon.formulas.duplicates import first_occurrences, symbol, tuple_equal
 from polygon.schemas import TableSchema
 from polygon.smt.ast import *
 
@@ -17,7 +16,7 @@ class FDistinct:
 
         self.output = self.create_output_table(self.input)
         self.output.node = self.node
-        self.semantics(self.input, self.output)
+        self.env.formulas.encode(self.node.distinct_label, lambda: self.semantics(self.input, self.output))
 
     def create_output_table(self, input_table: TableSchema) -> TableSchema:
         input_table_id, input_table_name = input_table.get_info()
@@ -35,28 +34,13 @@ class FDistinct:
         input_table_id = input_table.table_id
         output_table_id = output_table.table_id
 
-        # input_size_variable = self.env.size(input_table_id)
-        # output_size_variable = self.env.size(output_table_id)
-
-        def tuple_equal(t1, t2):
-            f_equ = []
-            for col_idx in range(len(input_table.columns)):
-                f_equ.append(
-                    Or([
-                        And([
-                            self.env.null(input_table_id, t1, col_idx),
-                            self.env.null(input_table_id, t2, col_idx)
-                        ]),
-                        And([
-                            Not(Or([
-                                self.env.null(input_table_id, t1, col_idx),
-                                self.env.null(input_table_id, t2, col_idx)
-                            ])),
-                            self.env.cell(input_table_id, t1, col_idx) == self.env.cell(input_table_id, t2, col_idx)
-                        ])
-                    ])
-                )
-            return And(f_equ)
+        # a tuple is kept iff it is the first occurrence of its value
+        first = first_occurrences(
+            self.env,
+            f'distinct_{symbol(input_table_id)}',
+            [Not(Deleted(input_table_id, tuple_idx)) for tuple_idx in range(input_table.bound)],
+            lambda prev_tuple_idx, tuple_idx: tuple_equal(self.env, input_table, prev_tuple_idx, tuple_idx)
+        )
 
         cases = []
         choice_constraints = []
@@ -78,17 +62,8 @@ class FDistinct:
                 Implies(
                     Choice(output_table_id, tuple_idx) == Int(1),
                     And([
-                        # input tuple is not deleted
-                        Not(Deleted(input_table_id, tuple_idx)),
-                        # input tuple's group by expression is unique
-                        Not(Or([
-                            And([
-                                Not(Deleted(output_table_id, prev_tuple_idx)),
-                                tuple_equal(tuple_idx, prev_tuple_idx)
-                            ])
-                            for prev_tuple_idx in range(0, tuple_idx)
-                        ])) if tuple_idx > 0 else Bool(True),
-
+                        # input tuple is not deleted and its value is unique so far
+                        first[tuple_idx],
                         And(choice_1_tuples_mapping),
                         Not(Deleted(output_table_id, tuple_idx))
                     ])
@@ -100,22 +75,8 @@ class FDistinct:
                 Implies(
                     Choice(output_table_id, tuple_idx) == Int(0),
                     And([
-                        Or([
-                            # choice 0 case 1: input tuple deleted
-                            Deleted(input_table_id, tuple_idx),
-                            # choice 0 case 2: input tuple's group by expression duplicate
-                            And([
-                                Not(Deleted(input_table_id, tuple_idx)),
-                                Or([
-                                    And([
-                                        Not(Deleted(output_table_id, prev_tuple_idx)),
-                                        tuple_equal(tuple_idx, prev_tuple_idx),
-                                    ])
-                                    for prev_tuple_idx in range(0, tuple_idx)
-                                ]) if tuple_idx > 0 else Bool(False)
-                            ]),
-                        ]),
-
+                        # input tuple deleted or duplicate
+                        Not(first[tuple_idx]),
                         Deleted(output_table_id, tuple_idx)
                     ])
                 )
@@ -0,0 +1,60 @@
+from polygon.smt.ast import *
+
+
+def symbol(*args):
+    # negative table ids are used by intermediate group tables
+    return '_'.join([f'm{-arg}' if isinstance(arg, int) and arg < 0 else str(arg) for arg in args])
+
+
+def values_equal(x, y):
+    # NULLs are not distinct from each other
+    x_val, x_null = x
+    y_val, y_null = y
+    return Or([
+        And([x_null, y_null]),
+        And([Not(x_null), Not(y_null), x_val == y_val])
+    ])
+
+
+def tuple_equal(env, table, t1, t2):
+    """Equality of two tuples of a table over all columns, defined once per pair of tuples."""
+    t1, t2 = min(t1, t2), max(t1, t2)
+    table_id = table.table_id
+    return env.formulas.define(
+        f'roweq_{symbol(table_id, t1, t2)}',
+        And([
+            values_equal(
+                (env.cell(table_id, t1, column.column_id), env.null(table_id, t1, column.column_id)),
+                (env.cell(table_id, t2, column.column_id), env.null(table_id, t2, column.column_id))
+            )
+            for column in table
+        ])
+    )
+
+
+def first_occurrences(env, prefix, present, equal):
+    """
+    Whether each tuple is the first occurrence of its value, i.e., its own representative: no earlier present tuple
+    is equal to it. present[i] tells whether tuple i takes part, equal(j, i) whether tuples j < i are duplicates.
+    """
+    first = []
+    for idx in range(len(present)):
+        first.append(env.formulas.define(
+            f'{prefix}_first_{idx}',
+            And([
+                present[idx],
+                Not(Or([And([present[prev_idx], equal(prev_idx, idx)]) for prev_idx in range(idx)]))
+                if idx > 0 else Bool(True)
+            ])
+        ))
+    return first
+
+
+def distinct_values(env, prefix, args):
+    """First occurrences of the aggregated values, args are (val, null, absent) triples."""
+    return first_occurrences(
+        env,
+        prefix,
+        [And([Not(absent), Not(null)]) for _, null, absent in args],
+        lambda prev_idx, idx: args[prev_idx][0] == args[idx][0]
+    )
@@ -2,6 +2,7 @@ from copy import deepcopy
 from itertools import product
 
 from polygon.ast.expressions.expression import Expression
+from polygon.formulas.cardinality import filter_max_rows
 from polygon.schemas import TableSchema
 from polygon.smt.ast import *
 from polygon.visitors.predicate_encoder import PredicateEncoder
@@ -22,23 +23,26 @@ class FFilter:
         self.under_vector_size = k
         self.outer_tuple_id = outer_tuple_id
 
+        # no more input tuples than this satisfy the predicate
+        self.max_rows = filter_max_rows(self.input, self.predicate, correlated=outer_tuple_id is not None)
+
         # precise output
         output = self.create_output_table(self.input)
         output.node = self.node
         self.output = output
 
-        if self.under_vector_size < output.bound:
+        if min(self.under_vector_size, self.max_rows) < output.bound:
             # under output
             self.approximated_output = deepcopy(output)
             self.approximated_output.table_id = self.env.next_table_id()
-            self.approximated_output.bound = self.under_vector_size
+            self.approximated_output.bound = min(self.under_vector_size, self.max_rows)
             self.env.db.add_table(self.approximated_output)
             self.env.formulas.under_table_id_to_original[self.approximated_output.table_id] = output.table_id
             self.output = self.approximated_output
         else:
             self.approximated_output = None
 
-        self.semantics(self.input, output)
+        self.env.formulas.encode(self.node.label, lambda: self.semantics(self.input, output), [self.predicate])
 
     def create_output_table(self, input_table: TableSchema) -> TableSchema:
         input_table_id, input_table_name = input_table.get_info()
@@ -48,6 +52,7 @@ class FFilter:
             output_column = deepcopy(column)
             new_table.append(output_column)
         new_table.lineage = f"Filtered from T{input_table_id} ({self.predicate})"
+        new_table.unique_keys = list(input_table.unique_keys)
         new_table.ancestors.append(input_table)
         self.env.db.add_table(new_table)
         return new_table
@@ -112,7 +117,8 @@ class FFilter:
             for bit_id in range(output_table.bound)
         ])
 
-        self.env.formulas.append(output_table_size <= Int(self.approximated_output.bound), label=f'size_{output_table_id}')
+        if self.approximated_output.bound < self.max_rows:
+            self.env.formulas.append(output_table_size <= Int(self.approximated_output.bound), label=f'size_{output_table_id}')
 
         for mapped_to_tuple_id in range(self.approximated_output.bound):
             mapping = []
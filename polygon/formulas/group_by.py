@@ -1,57 +1,16 @@
 from copy import deepcopy
-from itertools import combinations, product
 
 from polygon.ast.expressions.attribute import Attribute
 from polygon.ast.expressions.expression import Expression
 from polygon.ast.expressions.literal import Literal
 from polygon.ast.scan import Scan
+from polygon.formulas.duplicates import first_occurrences, symbol, values_equal
 from polygon.schemas import TableSchema, ColumnSchema
 from polygon.smt.ast import *
 from polygon.visitors.expression_encoder import ExpressionEncoder
 from polygon.visitors.group_expression_encoder import GroupExpressionEncoder
 
 
-def group_partition(tuple_indices: [int], groups_num: int):
-    def group_numbers(numbers, n):
-        if n == 1:
-            yield [numbers]
-        elif n == len(numbers):
-            yield [[num] for num in numbers]
-        elif n > len(numbers):
-            return
-        else:
-            for i in range(1, len(numbers)):
-                for comb in combinations(numbers, i):
-                    first_group = [list(comb)]
-                    remaining_groups = group_numbers([x for x in numbers if x not in comb], n - 1)
-                    for group in remaining_groups:
-                        yield first_group + group
-
-    def deduplicate_groups(list_of_list_of_lists):
-        unique_set = set()
-
-        deduplicated_list = []
-        for inner_list in list_of_list_of_lists:
-            inner_list_set = frozenset(tuple(sub_list) for sub_list in inner_list)
-            if inner_list_set not in unique_set:
-                deduplicated_list.append([list(sub_list) for sub_list in inner_list_set])
-                unique_set.add(inner_list_set)
-
-        return deduplicated_list
-
-    for groups in deduplicate_groups(group_numbers(tuple_indices, groups_num)):
-        not_grouped = []
-
-        # get tuple pairs that shouldn't be grouped (i.e., GroupBy expressions shouldn't be equivalent)
-        for group in groups:
-            for group_member in group:
-                for idx in tuple_indices:
-                    if idx != group_member and idx not in group:
-                        not_grouped.append([group_member, idx])
-
-        yield groups, not_grouped
-
-
 class FGroupBy:
     def __init__(self,
                  input_table: TableSchema,
@@ -62,16 +21,22 @@ class FGroupBy:
         self.input = input_table
         self.node = node
         self.env = env
+        self.k = k
         self.mapping = {}  # maps new column id to the column id in the input
 
         self.encoder = ExpressionEncoder(self.input, env)
         self.output = self.create_output_table(self.input)
         self.output.node = self.node
-        self.semantics(self.input, self.output)
+        self.env.formulas.encode(
+            self.node.label,
+            lambda: self.semantics(self.input, self.output),
+            [node.expressions, node.having, node.ctx['select_list']]
+        )
 
     def create_output_table(self, input_table: TableSchema) -> TableSchema:
         input_table_id, input_table_name = input_table.get_info()
         output_table_id = self.env.next_table_id()
+        # groups are numbered compactly, the number of groups is capped at k until the cap is relaxed
         new_table = TableSchema(output_table_id, input_table_name, input_table.bound)
 
         new_table.ancestors.append(input_table)
@@ -102,57 +67,62 @@ class FGroupBy:
             group_by_exp[tuple_idx] = expressions
 
         def group_by_exp_equal(t1, t2):
-            f_equ = []
-            VAL, NULL = 0, 1
-            for t1_group_exp, t2_group_exp in zip(group_by_exp[t1], group_by_exp[t2]):
-                f_equ.append(
-                    Or([
-                        And([
-                            t1_group_exp[NULL],
-                            t2_group_exp[NULL]
-                        ]),
-                        And([
-                            Not(Or([t1_group_exp[NULL], t2_group_exp[NULL]])),
-                            t1_group_exp[VAL] == t2_group_exp[VAL]
-                        ])
-                    ])
-                )
-            return And(f_equ)
+            t1, t2 = min(t1, t2), max(t1, t2)
+            return self.env.formulas.define(
+                f'groupeq_{symbol(output_table_id, t1, t2)}',
+                And([
+                    values_equal(t1_group_exp, t2_group_exp)
+                    for t1_group_exp, t2_group_exp in zip(group_by_exp[t1], group_by_exp[t2])
+                ])
+            )
 
         cases = []
         choice_constraints = []
 
-        # temp
-        # cases.append(Choice(13, 0) == Int(0))
-        # cases.append(Choice(13, 1) == Int(0))
-        # cases.append(Choice(13, 2) == Int(0))
-        # cases.append(Choice(13, 3) == Int(0))
-        # cases.append(Choice(13, 4) == Int(0))
-        # cases.append(Choice(13, 5) == Int(0))
-        # cases.append(Choice(-13, 0) == Int(0))
-        # cases.append(Choice(-13, 1) == Int(0))
-        # cases.append(Choice(-13, 2) == Int(0))
-
-        # constrain grouping predicates
+        # each tuple belongs to the group of the first tuple with the same group by expressions (its representative),
+        # groups are numbered by the order in which they first occur
+        present = [Not(Deleted(input_table_id, tuple_idx)) for tuple_idx in range(input_table.bound)]
+        first = first_occurrences(self.env, f'groupby_{symbol(output_table_id)}', present, group_by_exp_equal)
+
+        rank = [
+            self.env.formulas.define(
+                f'groupby_{symbol(output_table_id)}_rank_{tuple_idx}',
+                Sum([If(first[prev_tuple_idx], Int(1), Int(0)) for prev_tuple_idx in range(tuple_idx)]),
+                sort='Int'
+            )
+            for tuple_idx in range(input_table.bound)
+        ]
+
         for tuple_idx in range(input_table.bound):
-            cases.append(
-                Implies(
-                    Deleted(input_table_id, tuple_idx),
-                    And([
-                        Not(self.env.grouping(output_table_id, tuple_idx, group_idx))
-                        for group_idx in range(output_table.bound)
-                    ])
+            group_id = rank[tuple_idx]
+            for prev_tuple_idx in reversed(range(tuple_idx)):
+                group_id = If(
+                    And([present[prev_tuple_idx], group_by_exp_equal(prev_tuple_idx, tuple_idx)]),
+                    rank[prev_tuple_idx],
+                    group_id
                 )
+            group_id = self.env.formulas.define(
+                f'groupby_{symbol(output_table_id)}_gid_{tuple_idx}', group_id, sort='Int'
             )
-            cases.append(
-                Implies(
-                    Not(Deleted(input_table_id, tuple_idx)),
-                    Sum([
-                        If(self.env.grouping(output_table_id, tuple_idx, group_idx), Int(1), Int(0))
-                        for group_idx in range(output_table.bound)
-                    ]) == Int(1)
+
+            # constrain grouping predicates
+            for group_idx in range(output_table.bound):
+                if group_idx > tuple_idx:
+                    cases.append(Not(self.env.grouping(output_table_id, tuple_idx, group_idx)))
+                    continue
+                cases.append(
+                    self.env.grouping(output_table_id, tuple_idx, group_idx) ==
+                    And([present[tuple_idx], group_id == Int(group_idx)])
                 )
-            )
+
+        num_groups = self.env.formulas.define(
+            f'groupby_{symbol(output_table_id)}_count',
+            Sum([If(is_first, Int(1), Int(0)) for is_first in first]),
+            sort='Int'
+        )
+        if self.k < input_table.bound:
+            # under-approximation, relaxed by FormulaManager when it shows up in an unsat core
+            self.env.formulas.append(num_groups <= Int(self.k), label=f'size_groups_{output_table_id}')
 
         for group_idx in range(output_table.bound):
             choice_constraints.append(Or([
@@ -160,50 +130,23 @@ class FGroupBy:
                 Choice(output_table_id, group_idx) == Int(0)
             ]))
 
-            # choice 1 - the tuple has a unique unseen group expression so far, forming a new group to exist
+            # choice 1 - the group exists
             cases.append(
                 Implies(
                     Choice(output_table_id, group_idx) == Int(1),
                     And([
-                        # input tuple is not deleted
-                        Not(Deleted(input_table_id, group_idx)),
-                        # input tuple's group by expression is unique
-                        Not(Or([
-                            And([
-                                Not(Deleted(-output_table_id, prev_group_idx)),
-                                group_by_exp_equal(group_idx, prev_group_idx)
-                            ])
-                            for prev_group_idx in range(0, group_idx)
-                        ])) if group_idx > 0 else Bool(True),
-
-                        self.env.grouping(output_table_id, group_idx, group_idx),
+                        num_groups > Int(group_idx),
                         Not(Deleted(-output_table_id, group_idx)),
                     ])
                 )
             )
 
-            # choice 0 - the tuple is deleted or has a duplicate group by expression
+            # choice 0 - fewer groups are formed
             cases.append(
                 Implies(
                     Choice(output_table_id, group_idx) == Int(0),
                     And([
-                        Or([
-                            # choice 0 case 1: input tuple deleted
-                            Deleted(input_table_id, group_idx),
-                            # choice 0 case 2: input tuple's group by expression duplicate
-                            And([
-                                Not(Deleted(input_table_id, group_idx)),
-                                Or([
-                                    And([
-                                        Not(Deleted(-output_table_id, prev_group_idx)),  # table id?
-                                        group_by_exp_equal(group_idx, prev_group_idx),
-                                        self.env.grouping(output_table_id, group_idx, prev_group_idx)
-                                    ])
-                                    for prev_group_idx in range(0, group_idx)
-                                ]) if group_idx > 0 else Bool(False)
-                            ]),
-                        ]),
-
+                        num_groups <= Int(group_idx),
                         Deleted(-output_table_id, group_idx)
                     ])
                 )
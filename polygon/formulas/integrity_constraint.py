@@ -48,6 +48,8 @@ def encode_primary(constraint, env):
     for attr in constraint[key]:
         attr = attr.split('.')[1].lower()
         distinct_attr.append(attr)
+    # lets joins on the key match at most one tuple
+    table.unique_keys.append(frozenset(column.column_id for column in table if column.column_name in distinct_attr))
 
     def _f_distinct_from(tuple_idx, others):
         _f = []
@@ -7,6 +7,8 @@ from typing import List
 from polygon.ast.expressions.attribute import Attribute
 from polygon.ast.expressions.expression import Expression
 from polygon.schemas import TableSchema
+from polygon.smt.ast import *
+from polygon.visitors.predicate_encoder import JoinPredicateEncoder
 
 
 class FJoin(ABC):
@@ -31,23 +33,30 @@ class FJoin(ABC):
                 Attribute(name=f'{self.right.table_name}.{node.using.value}')
             ])
 
+        # each left tuple matches at most one right tuple when the join is on a key of the right table
+        self.matched_key = self.find_key(self.left, self.right)
+        self.key = self.matched_key if env.key_joins else None
+
         # precise output
         output = self.create_output_table(self.left, self.right)
         output.node = node
         self.output = output
+        self.max_rows = self.find_max_rows(output)
 
-        if self.under_vector_size < output.bound:
+        if min(self.under_vector_size, self.max_rows) < output.bound:
             # under output
             self.approximated_output = deepcopy(output)
             self.approximated_output.table_id = self.env.next_table_id()
-            self.approximated_output.bound = self.under_vector_size
+            self.approximated_output.bound = min(self.under_vector_size, self.max_rows)
             self.env.db.add_table(self.approximated_output)
             self.env.formulas.under_table_id_to_original[self.approximated_output.table_id] = output.table_id
             self.output = self.approximated_output
         else:
             self.approximated_output = None
 
-        self.semantics(self.left, self.right, output)
+        self.env.formulas.encode(
+            self.node.label, lambda: self.semantics(self.left, self.right, output), [self.condition]
+        )
 
     def create_output_table(self, left_table: TableSchema, right_table: TableSchema) -> TableSchema:
         left_table_id, left_table_name = left_table.get_info()
@@ -55,6 +64,12 @@ class FJoin(ABC):
 
         output_table_id = self.env.next_table_id()
         match self.node.join_type:
+            case 'join' | 'inner join' | 'left join' | 'left outer join' | 'right join' | 'right outer join' \
+                    if self.key is not None:
+                # right joins are encoded as left joins with the inputs swapped
+                precise_bound = self.left.bound
+            case 'full join' | 'full outer join' if self.key is not None:
+                precise_bound = self.left.bound + self.right.bound
             case 'join' | 'inner join':
                 precise_bound = self.left.bound * self.right.bound
             case 'left join' | 'left outer join':
@@ -89,6 +104,9 @@ class FJoin(ABC):
             column_id += 1
 
         new_table.lineage = f"Joined from T{left_table_id} and T{right_table_id} on ({self.condition})"
+        if self.matched_key is not None and self.node.join_type not in ['full join', 'full outer join']:
+            # left tuples appear at most once
+            new_table.unique_keys = list(left_table.unique_keys)
         new_table.ancestors.extend([left_table, right_table])
         self.env.db.add_table(new_table)
 
@@ -98,6 +116,232 @@ class FJoin(ABC):
     def semantics(self, left_table, right_table, output):
         ...
 
+    def find_max_rows(self, output_table: TableSchema) -> int:
+        # without key_joins the output keeps a tuple per pair, but no more than one per left tuple can be present
+        if self.matched_key is not None and self.key is None:
+            match self.node.join_type:
+                case 'join' | 'inner join' | 'left join' | 'left outer join' | 'right join' | 'right outer join':
+                    return min(output_table.bound, self.left.bound)
+        return output_table.bound
+
+    def find_key(self, left_table: TableSchema, right_table: TableSchema):
+        if self.node.join_type == 'cross join':
+            return None
+        if not isinstance(self.condition, Expression):
+            return None
+
+        if self.condition.operator == 'and':
+            conjuncts = self.condition.args
+        else:
+            conjuncts = [self.condition]
+
+        def resolve(attribute):
+            # same lookup order as JoinPredicateEncoder
+            try:
+                return left_table, left_table[attribute.name]
+            except SyntaxError:
+                pass
+            try:
+                return right_table, right_table[attribute.name]
+            except SyntaxError:
+                return None, None
+
+        equated = set()
+        for conjunct in conjuncts:
+            if not (isinstance(conjunct, Expression) and conjunct.operator == 'eq' and len(conjunct.args) == 2):
+                continue
+            if not all(isinstance(arg, Attribute) for arg in conjunct.args):
+                continue
+            (a_table, a), (b_table, b) = resolve(conjunct.args[0]), resolve(conjunct.args[1])
+            if a_table is left_table and b_table is right_table:
+                equated.add(b.column_id)
+            elif a_table is right_table and b_table is left_table:
+                equated.add(a.column_id)
+
+        for key in right_table.unique_keys:
+            if key and key <= equated:
+                return key
+        return None
+
+    def semantics_key(self, left_table: TableSchema, right_table: TableSchema, output_table: TableSchema,
+                      left_outer=False, right_outer=False):
+        """
+        Join on a key of the right table: the only right tuple each left tuple may match is kept as a matched index,
+        -1 if there is none, instead of a choice bit for every pair of tuples.
+        """
+        left_table_id = left_table.table_id
+        right_table_id = right_table.table_id
+        output_table_id = output_table.table_id
+
+        encoder = JoinPredicateEncoder(left_table, right_table, self.condition, self.env)
+        cases = []
+        choice_constraints = []
+
+        def copy_tuple(input_table, input_tuple_idx, output_tuple_idx):
+            mapping = []
+            for column in output_table:
+                input_table_id, input_column_id = self.mapping[column.column_id]
+                if input_table_id != input_table.table_id:
+                    continue
+                mapping.append(self.env.copy_cell(
+                    self.env.db[input_table_id, input_tuple_idx, input_column_id],
+                    self.env.db[output_table_id, output_tuple_idx, column.column_id]
+                ))
+            return And(mapping)
+
+        def null_tuple(input_table, output_tuple_idx):
+            return And([
+                self.env.db[output_table_id, output_tuple_idx, column.column_id].NULL
+                for column in output_table
+                if self.mapping[column.column_id][0] == input_table.table_id
+            ])
+
+        matched = []
+        for left_idx in range(left_table.bound):
+            match = Int(-1)
+            for right_idx in reversed(range(right_table.bound)):
+                val, null = encoder.predicate_for_tuple_pair(left_idx, right_idx)
+                match = If(And([Not(Deleted(right_table_id, right_idx)), Not(null), val]), Int(right_idx), match)
+            match = self.env.formulas.define(f'join_{output_table_id}_match_{left_idx}', match, sort='Int')
+            matched.append(match)
+
+            choice_constraints.append(Or([
+                Choice(output_table_id, left_idx) == Int(1),
+                Choice(output_table_id, left_idx) == Int(0)
+            ]))
+
+            right_mapping = [
+                Implies(match == Int(right_idx), copy_tuple(right_table, right_idx, left_idx))
+                for right_idx in range(right_table.bound)
+            ]
+            if left_outer:
+                right_mapping.append(Implies(match < Int(0), null_tuple(right_table, left_idx)))
+
+            cases.append(
+                Implies(
+                    Choice(output_table_id, left_idx) == Int(1),
+                    And([
+                        Not(Deleted(left_table_id, left_idx)),
+                        Bool(True) if left_outer else match >= Int(0),
+
+                        copy_tuple(left_table, left_idx, left_idx),
+                        And(right_mapping),
+                        Not(Deleted(output_table_id, left_idx)),
+                    ])
+                )
+            )
+            cases.append(
+                Implies(
+                    Choice(output_table_id, left_idx) == Int(0),
+                    And([
+                        Deleted(left_table_id, left_idx) if left_outer else Or([
+                            Deleted(left_table_id, left_idx),
+                            match < Int(0)
+                        ]),
+
+                        Deleted(output_table_id, left_idx)
+                    ])
+                )
+            )
+
+        if right_outer:
+            # right tuples no left tuple is matched to
+            for right_idx in range(right_table.bound):
+                output_tuple_idx = left_table.bound + right_idx
+                unmatched = And([
+                    Not(Deleted(right_table_id, right_idx)),
+                    Not(Or([
+                        And([Not(Deleted(left_table_id, left_idx)), matched[left_idx] == Int(right_idx)])
+                        for left_idx in range(left_table.bound)
+                    ]))
+                ])
+
+                choice_constraints.append(Or([
+                    Choice(output_table_id, output_tuple_idx) == Int(1),
+                    Choice(output_table_id, output_tuple_idx) == Int(0)
+                ]))
+                cases.append(
+                    Implies(
+                        Choice(output_table_id, output_tuple_idx) == Int(1),
+                        And([
+                            unmatched,
+
+                            null_tuple(left_table, output_tuple_idx),
+                            copy_tuple(right_table, right_idx, output_tuple_idx),
+                            Not(Deleted(output_table_id, output_tuple_idx)),
+                        ])
+                    )
+                )
+                cases.append(
+                    Implies(
+                        Choice(output_table_id, output_tuple_idx) == Int(0),
+                        And([
+                            Not(unmatched),
+
+                            Deleted(output_table_id, output_tuple_idx)
+                        ])
+                    )
+                )
+
+        if self.approximated_output is not None:
+            cases.extend(self.semantics_approximation(output_table))
+
+        self.env.formulas.append(And([*cases, *choice_constraints]), label=self.node.label)
+
+    def semantics_approximation(self, output_table: TableSchema):
+        output_table_id = output_table.table_id
+        cases = []
+
+        # mapping real output vector to under-approximated vector
+        output_table_size = Sum([
+            If(Deleted(output_table_id, tuple_id), Int(0), Int(1))
+            for tuple_id in range(output_table.bound)
+        ])
+
+        if self.approximated_output.bound < self.max_rows:
+            self.env.formulas.append(output_table_size <= Int(self.approximated_output.bound), label=f'size_{output_table_id}')
+
+        for mapped_to_tuple_id in range(self.approximated_output.bound):
+            mapping = []
+            for output_tuple_id in range(output_table.bound):
+                is_nth_non_deleted_tuple = [
+                    Not(Deleted(output_table_id, output_tuple_id)),
+                    Sum([
+                        If(Deleted(output_table_id, prev_output_tuple_id), Int(0), Int(1))
+                        for prev_output_tuple_id in range(output_tuple_id)
+                    ]) == Int(mapped_to_tuple_id)
+                ]
+                mapping.append(
+                    Implies(
+                        # this output_tuple_id is the nth non-deleted tuple id
+                        And(is_nth_non_deleted_tuple),
+                        And([
+                            self.env.copy_cell(
+                                self.env.db[output_table_id, output_tuple_id, column_id],
+                                self.env.db[self.approximated_output.table_id, mapped_to_tuple_id, column_id]
+                            )
+                            for column_id in range(len(output_table.columns))
+                        ])
+                    )
+                )
+
+            cases.append(
+                Implies(
+                    output_table_size >= Int(mapped_to_tuple_id + 1),
+                    And([
+                        Not(Deleted(self.approximated_output.table_id, mapped_to_tuple_id)),
+                        And(mapping)
+                    ])
+                )
+            )
+            cases.append(
+                Implies(
+                    Not(output_table_size >= Int(mapped_to_tuple_id + 1)),
+                    Deleted(self.approximated_output.table_id, mapped_to_tuple_id)
+                )
+            )
+        return cases
+
     @staticmethod
     def _gen_size(input_schemas: List[TableSchema], output_schema: TableSchema):
         combs = (list(range(input_schema.bound + 1)) for input_schema in input_schemas)
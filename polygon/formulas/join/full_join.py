@@ -9,6 +9,10 @@ from polygon.visitors.predicate_encoder import JoinPredicateEncoder
 
 class FFullJoin(FJoin):
     def semantics(self, left_table: TableSchema, right_table: TableSchema, output_table: TableSchema):
+        if self.key is not None:
+            self.semantics_key(left_table, right_table, output_table, left_outer=True, right_outer=True)
+            return
+
         left_size_variable = self.env.size(left_table.table_id)
         right_size_variable = self.env.size(right_table.table_id)
 
@@ -9,6 +9,10 @@ from polygon.visitors.predicate_encoder import JoinPredicateEncoder
 
 class FInnerJoin(FJoin):
     def semantics(self, left_table: TableSchema, right_table: TableSchema, output_table: TableSchema):
+        if self.key is not None:
+            self.semantics_key(left_table, right_table, output_table)
+            return
+
         left_table_id = left_table.table_id
         right_table_id = right_table.table_id
         output_table_id = output_table.table_id
@@ -78,59 +82,8 @@ class FInnerJoin(FJoin):
                     )
                 )
 
-        if self.approximated_output is None:
-            f = And([*cases, *choice_constraints])
-
-            self.env.formulas.append(f, label=self.node.label)
-            return
-
-        # mapping real output vector to under-approximated vector
-        output_table_size = Sum([
-            Choice(output_table_id, bit_id)
-            for bit_id in range(len(join_bijectives))
-        ])
-
-        self.env.formulas.append(output_table_size <= Int(self.approximated_output.bound), label=f'size_{output_table_id}')
-
-        for mapped_to_tuple_id in range(self.approximated_output.bound):
-            mapping = []
-            for output_tuple_id in range(output_table.bound):
-                is_nth_non_deleted_tuple = [
-                    Choice(output_table_id, output_tuple_id) == Int(1),
-                    Sum([
-                        Choice(output_table_id, prev_output_tuple_id)
-                        for prev_output_tuple_id in range(output_tuple_id)
-                    ]) == Int(mapped_to_tuple_id)
-                ]
-                mapping.append(
-                    Implies(
-                        # this output_tuple_id is the nth non deleted tuple id
-                        And(is_nth_non_deleted_tuple),
-                        And([
-                            self.env.copy_cell(
-                                self.env.db[output_table_id, output_tuple_id, column_id],
-                                self.env.db[self.approximated_output.table_id, mapped_to_tuple_id, column_id]
-                            )
-                            for column_id in range(len(output_table.columns))
-                        ])
-                    )
-                )
-
-            cases.append(
-                Implies(
-                    output_table_size >= Int(mapped_to_tuple_id + 1),
-                    And([
-                        Not(Deleted(self.approximated_output.table_id, mapped_to_tuple_id)),
-                        And(mapping)
-                    ])
-                )
-            )
-            cases.append(
-                Implies(
-                    Not(output_table_size >= Int(mapped_to_tuple_id + 1)),
-                    Deleted(self.approximated_output.table_id, mapped_to_tuple_id)
-                )
-            )
+        if self.approximated_output is not None:
+            cases.extend(self.semantics_approximation(output_table))
 
         f = And([*cases, *choice_constraints])
 
@@ -10,6 +10,10 @@ from polygon.visitors.predicate_encoder import JoinPredicateEncoder
 
 class FLeftJoin(FJoin):
     def semantics(self, left_table: TableSchema, right_table: TableSchema, output_table: TableSchema):
+        if self.key is not None:
+            self.semantics_key(left_table, right_table, output_table, left_outer=True)
+            return
+
         left_table_id = left_table.table_id
         right_table_id = right_table.table_id
         output_table_id = output_table.table_id
@@ -129,59 +133,8 @@ class FLeftJoin(FJoin):
                 )
             )
 
-        if self.approximated_output is None:
-            f = And([*cases, *choice_constraints, *null_tuples_constraints])
-
-            self.env.formulas.append(f, label=self.node.label)
-            return
-
-        # mapping real output vector to under-approximated vector
-        output_table_size = Sum([
-            If(Deleted(output_table_id, tuple_id), Int(0), Int(1))
-            for tuple_id in range(output_table.bound)
-        ])
-
-        self.env.formulas.append(output_table_size <= Int(self.approximated_output.bound), label=f'size_{output_table_id}')
-
-        for mapped_to_tuple_id in range(self.approximated_output.bound):
-            mapping = []
-            for output_tuple_id in range(output_table.bound):
-                is_nth_non_deleted_tuple = [
-                    Not(Deleted(output_table_id, output_tuple_id)),
-                    Sum([
-                        If(Deleted(output_table_id, prev_output_tuple_id), Int(0), Int(1))
-                        for prev_output_tuple_id in range(output_tuple_id)
-                    ]) == Int(mapped_to_tuple_id)
-                ]
-                mapping.append(
-                    Implies(
-                        # this output_tuple_id is the nth non-deleted tuple id
-                        And(is_nth_non_deleted_tuple),
-                        And([
-                            self.env.copy_cell(
-                                self.env.db[output_table_id, output_tuple_id, column_id],
-                                self.env.db[self.approximated_output.table_id, mapped_to_tuple_id, column_id]
-                            )
-                            for column_id in range(len(output_table.columns))
-                        ])
-                    )
-                )
-
-            cases.append(
-                Implies(
-                    output_table_size >= Int(mapped_to_tuple_id + 1),
-                    And([
-                        Not(Deleted(self.approximated_output.table_id, mapped_to_tuple_id)),
-                        And(mapping)
-                    ])
-                )
-            )
-            cases.append(
-                Implies(
-                    Not(output_table_size >= Int(mapped_to_tuple_id + 1)),
-                    Deleted(self.approximated_output.table_id, mapped_to_tuple_id)
-                )
-            )
+        if self.approximated_output is not None:
+            cases.extend(self.semantics_approximation(output_table))
 
         f = And([*cases, *choice_constraints, *null_tuples_constraints])
 
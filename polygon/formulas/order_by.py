@@ -24,8 +24,13 @@ class FOrderBy:
 
         self.output = self.create_output_table(self.input)
         self.output.node = self.node
+        if self.limit is not None:
+            self.output.bound = min(self.limit, self.output.bound)
         self.encoder = ExpressionEncoder(self.input, env)
-        self.semantics(self.input, self.output)
+        semantics = self.semantics_rank if env.order_by_encoding == 'rank' else self.semantics
+        self.env.formulas.encode(
+            self.node.label, lambda: semantics(self.input, self.output), [self.sorting_expressions]
+        )
 
     def create_output_table(self, input_table: TableSchema) -> TableSchema:
         input_table_id, input_table_name = input_table.get_info()
@@ -36,6 +41,8 @@ class FOrderBy:
             output_column = deepcopy(column)
             new_table.append(output_column)
         new_table.lineage = f"Sorted from T{input_table_id} ({self.sorting_expressions})"
+        # choices hold the position of each input tuple, 0 for deleted ones
+        new_table.ctx['choice_domain'] = self.k
         new_table.ancestors.append(input_table)
         self.env.db.add_table(new_table)
         return new_table
@@ -144,7 +151,7 @@ class FOrderBy:
                         )
                     )
 
-        for tuple_idx in range(output_table.bound):
+        for tuple_idx in range(self.k):
             # choice_constraints.append(
             #     Sum([
             #         If(Choice(output_table_id, bit) == Int(tuple_idx + 1), Int(1), Int(0))
@@ -162,8 +169,146 @@ class FOrderBy:
                 )
             )
 
-        if self.limit is not None:
-            output_table.bound = self.limit
+        f = And([*cases, *choice_constraints])
+
+        self.env.formulas.append(f, label=self.node.label)
+
+    def sort_key(self, input_table: TableSchema, tuple_idx):
+        keys = []
+        for expression in self.sorting_expressions:
+            if isinstance(expression, Literal):
+                # syntactic sugar
+                if isinstance(expression.value, bool):
+                    keys.append(None)
+                    continue
+                cell = self.env.db[input_table.table_id, tuple_idx, expression.value - 1]
+                keys.append((cell.VAL, cell.NULL))
+            else:
+                # attribute or expression
+                keys.append(self.encoder.expression_for_tuple(expression, tuple_idx))
+        return keys
+
+    def semantics_rank(self, input_table: TableSchema, output_table: TableSchema):
+        """
+        Same semantics as semantics(), but each pair of tuples is compared once: the comparison and the rank of every
+        input tuple are auxiliary variables shared by all the positions the tuple may take.
+        """
+        input_table_id = input_table.table_id
+        output_table_id = output_table.table_id
+        VAL, NULL = 0, 1
+
+        cases = []
+        choice_constraints = []
+
+        input_table_size = Sum([
+            If(Deleted(input_table_id, tuple_id), Int(0), Int(1))
+            for tuple_id in range(input_table.bound)
+        ])
+
+        self.env.formulas.append(input_table_size <= Int(self.k), label=f'size_{input_table_id}')
+
+        keys = [self.sort_key(input_table, tuple_idx) for tuple_idx in range(input_table.bound)]
+
+        def equal(expression_idx, i, j):
+            # symmetric, shared by (i, j) and (j, i)
+            i, j = min(i, j), max(i, j)
+            this_tuple_cell, other_tuple_cell = keys[i][expression_idx], keys[j][expression_idx]
+            return self.env.formulas.define(
+                f'ob_{output_table_id}_eq_{expression_idx}_{i}_{j}',
+                Or([
+                    And([other_tuple_cell[NULL], this_tuple_cell[NULL]]),
+                    And([
+                        Not(other_tuple_cell[NULL]),
+                        Not(this_tuple_cell[NULL]),
+                        other_tuple_cell[VAL] == this_tuple_cell[VAL]
+                    ])
+                ])
+            )
+
+        def before(other_tuple_idx, tuple_idx):
+            # lexicographic comparison of the sort keys, nulls first
+            is_before = []
+            all_prev_expression_eq = []
+            for expression_idx in range(len(self.sorting_expressions)):
+                if keys[tuple_idx][expression_idx] is None:
+                    continue
+                this_tuple_cell = keys[tuple_idx][expression_idx]
+                other_tuple_cell = keys[other_tuple_idx][expression_idx]
+                is_before.append(And([
+                    *all_prev_expression_eq,
+                    Or([
+                        And([other_tuple_cell[NULL], Not(this_tuple_cell[NULL])]),
+                        And([
+                            Not(other_tuple_cell[NULL]),
+                            Not(this_tuple_cell[NULL]),
+                            other_tuple_cell[VAL] <= this_tuple_cell[VAL]
+                            if self.sort_orders[expression_idx] == 'asc'
+                            else other_tuple_cell[VAL] >= this_tuple_cell[VAL]
+                        ])
+                    ])
+                ]))
+                all_prev_expression_eq.append(equal(expression_idx, tuple_idx, other_tuple_idx))
+            return self.env.formulas.define(
+                f'ob_{output_table_id}_before_{other_tuple_idx}_{tuple_idx}',
+                And([Not(Deleted(input_table_id, other_tuple_idx)), Or(is_before)])
+            )
+
+        for tuple_idx in range(input_table.bound):
+            choice_constraints.append(And([
+                Choice(output_table_id, tuple_idx) >= Int(0),
+                Choice(output_table_id, tuple_idx) <= Int(self.k),
+            ]))
+
+            rank = self.env.formulas.define(
+                f'ob_{output_table_id}_rank_{tuple_idx}',
+                Sum([
+                    If(before(other_tuple_idx, tuple_idx), Int(1), Int(0))
+                    for other_tuple_idx in range(input_table.bound)
+                    if other_tuple_idx != tuple_idx
+                ]),
+                sort='Int'
+            )
+
+            cases.append(
+                Implies(
+                    Choice(output_table_id, tuple_idx) == Int(0),
+                    Deleted(input_table_id, tuple_idx)
+                )
+            )
+            for ordering in range(1, self.k + 1):
+                mapping = []
+                for column in input_table:
+                    input_cell = self.env.db[input_table.table_id, tuple_idx, column.column_id]
+                    output_cell = self.env.db[output_table.table_id, ordering - 1, column.column_id]
+                    mapping.append(self.env.copy_cell(input_cell, output_cell))
+
+                cases.append(
+                    Implies(
+                        Choice(output_table_id, tuple_idx) == Int(ordering),
+                        And([
+                            Not(Deleted(input_table_id, tuple_idx)),
+                            Not(Deleted(output_table_id, ordering - 1)),
+                            rank == Int(ordering - 1),
+                            And(mapping)
+                        ])
+                    )
+                )
+
+        num_sorted_tuples = self.env.formulas.define(
+            f'ob_{output_table_id}_count',
+            Sum([
+                If(Choice(output_table_id, bit) != Int(0), Int(1), Int(0))
+                for bit in range(input_table.bound)
+            ]),
+            sort='Int'
+        )
+        for tuple_idx in range(self.k):
+            cases.append(
+                Implies(
+                    num_sorted_tuples <= Int(tuple_idx),
+                    Deleted(output_table_id, tuple_idx)
+                )
+            )
 
         f = And([*cases, *choice_constraints])
 
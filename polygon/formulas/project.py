@@ -32,6 +32,9 @@ class FProject:
             self.from_group_by = False
 
         output = self.create_output_table(self.input)
+        # an aggregate function in projection -> output table has one row only
+        if self.has_aggregate and not self.from_group_by:
+            output.bound = 1
         if self.from_group_by:
             group_by_label = output.node.label
             self.node.group_by_label = group_by_label
@@ -57,11 +60,13 @@ class FProject:
         if self.from_group_by:
             self.encoder = GroupExpressionEncoder(self.input, self.input.ancestors[0], env)
 
-            self.semantics_group_by(self.input.ancestors[0], output)
+            self.env.formulas.encode(
+                self.node.label, lambda: self.semantics_group_by(self.input.ancestors[0], output), [self.target_list]
+            )
         else:
             self.encoder = ExpressionEncoder(self.input, env)
 
-            self.semantics(self.input, output)
+            self.env.formulas.encode(self.node.label, lambda: self.semantics(self.input, output), [self.target_list])
 
     def create_output_table(self, input_table: TableSchema) -> TableSchema:
         # GROUP BY table
@@ -176,9 +181,7 @@ class FProject:
         cases = []
         choice_constraints = []
 
-        # an aggregate function in projection -> output table has one row only
         if self.has_aggregate:
-            output_table.bound = 1
             choice_constraints.append(Choice(output_table_id, 0) == Int(1))
             cases.append(Not(Deleted(output_table_id, 0)))
 
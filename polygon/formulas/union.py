@@ -20,9 +20,10 @@ class FUnion:
         self.env = env
         self.k = k
 
-        self.output = self.create_output_table(self.inputs)
-        self.output.node = self.node
-        self.semantics(self.inputs, self.output)
+        output = self.create_output_table(self.inputs)
+        output.node = self.node
+        self.output = output
+        self.env.formulas.encode(self.node.label, lambda: self.semantics(self.inputs, output))
 
         if not self.allow_duplicates:
             f = FDistinct(self.output, self.node, self.env)
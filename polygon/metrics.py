@@ -0,0 +1,210 @@
+import functools
+import json
+import resource
+import time
+
+# seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+HELP = {
+    'polygon_checks_total': 'Checks by verdict (EQU, NEQ, TMO, ERR).',
+    'polygon_check_seconds': 'Duration of checks.',
+    'polygon_child_peak_rss_bytes': 'Peak resident set size of the processes forked by checks.',
+    'polygon_searches_total': 'Under-approximation searches started.',
+    'polygon_search_iterations_total': 'Iterations of the under-approximation searches.',
+    'polygon_search_backtracks_total': 'Backtracks of the under-approximation searches.',
+    'polygon_solver_processes_total': 'z3 processes spawned.',
+    'polygon_solver_checks_total': 'check-sat commands by result.',
+    'polygon_solver_check_seconds': 'Time to the answer of check-sat commands.',
+    'polygon_solver_evaluations_total': 'Model evaluations sent to the solver.',
+    'polygon_cache_lookups_total': 'Lookups of the encoding caches by cache and result (hit or miss).',
+    'polygon_metrics_start_time_seconds': 'Unix time the registry was created.',
+}
+
+
+def key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        # label items -> value
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        k = key(labels)
+        self.values[k] = self.values.get(k, 0) + amount
+
+    def merge(self, k, value):
+        self.values[k] = self.values.get(k, 0) + value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[key(labels)] = value
+
+    def merge(self, k, value):
+        self.values[k] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # label items -> {'buckets': observations per bucket and above the last one, 'sum': ..., 'count': ...}
+        self.values = {}
+
+    def observe(self, value, **labels):
+        k = key(labels)
+        if k not in self.values:
+            self.values[k] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0, 'count': 0}
+        histogram = self.values[k]
+        idx = next((idx for idx, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        histogram['buckets'][idx] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def merge(self, k, value):
+        if k not in self.values:
+            self.values[k] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0, 'count': 0}
+        histogram = self.values[k]
+        histogram['buckets'] = [x + y for x, y in zip(histogram['buckets'], value['buckets'])]
+        histogram['sum'] += value['sum']
+        histogram['count'] += value['count']
+
+
+class NullMetric:
+    def inc(self, amount=1, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+    def observe(self, value, **labels):
+        pass
+
+
+NULL_METRIC = NullMetric()
+KINDS = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+class Registry:
+    """
+    Counters, gauges and histograms shared by the environments given the registry, e.g., one per service. The
+    default registry is disabled and hands out a shared no-op metric. Checking processes count into registries of
+    their own, which are merged into the registry of the environment afterwards.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = {}
+        self.start_time = time.time()
+
+    def metric(self, kind: str, name: str):
+        if not self.enabled:
+            return NULL_METRIC
+        if name not in self.metrics:
+            self.metrics[name] = KINDS[kind]()
+        return self.metrics[name]
+
+    def counter(self, name: str):
+        return self.metric('counter', name)
+
+    def gauge(self, name: str):
+        return self.metric('gauge', name)
+
+    def histogram(self, name: str):
+        return self.metric('histogram', name)
+
+    def lookup(self, cache: str, hit: bool):
+        if not self.enabled:
+            return
+        self.counter('polygon_cache_lookups_total').inc(cache=cache, result='hit' if hit else 'miss')
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                'type': metric.kind,
+                'values': [{'labels': dict(k), 'value': value} for k, value in metric.values.items()],
+            }
+            for name, metric in self.metrics.items()
+        }
+
+    def merge(self, snapshot: dict):
+        for name, metric in snapshot.items():
+            for value in metric['values']:
+                self.metric(metric['type'], name).merge(key(value['labels']), value['value'])
+
+    def prometheus(self) -> str:
+        lines = [
+            f"# HELP polygon_metrics_start_time_seconds {HELP['polygon_metrics_start_time_seconds']}",
+            '# TYPE polygon_metrics_start_time_seconds gauge',
+            f'polygon_metrics_start_time_seconds {self.start_time}',
+        ]
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for k, value in sorted(metric.values.items()):
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{labels(k)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip([*metric.buckets, '+Inf'], value['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{labels(k, le=bound)} {cumulative}')
+                lines.append(f"{name}_sum{labels(k)} {value['sum']}")
+                lines.append(f"{name}_count{labels(k)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, format: str = 'prometheus'):
+        """
+        Writes the metrics in the Prometheus text format ('prometheus'), e.g., for the textfile collector of the node
+        exporter, or as a JSON snapshot ('json').
+        """
+        with open(path, 'w') as f:
+            match format:
+                case 'prometheus':
+                    f.write(self.prometheus())
+                case 'json':
+                    snapshot = {'start_time': self.start_time, 'time': time.time(), 'metrics': self.snapshot()}
+                    json.dump(snapshot, f, indent=2)
+                case _:
+                    raise ValueError(f'Unknown metrics format: {format}')
+
+
+def labels(k: tuple, **extra) -> str:
+    items = [*k, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+def measured(name: str):
+    """
+    Counts the calls of a check-like method of an object with a metrics registry by the status of their results,
+    and records their durations and the peak memory of the processes they forked.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            self.metrics.histogram(f'polygon_{name}_seconds').observe(time.perf_counter() - start)
+            self.metrics.counter(f'polygon_{name}s_total').inc(status=result[-1].get('status'))
+            # kilobytes on Linux
+            self.metrics.gauge('polygon_child_peak_rss_bytes').set(
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            )
+            return result
+        return wrapper
+    return decorator
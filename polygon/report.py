@@ -0,0 +1,68 @@
+import argparse
+import json
+import logging
+
+from polygon.environment import Environment
+from polygon.logger import logger
+from polygon.smt.statistics import FIELDS
+
+
+def format_report(statistics: dict, sort: str = 'bytes', top: int = None) -> str:
+    """
+    Table of the formula sizes of the last problem sent to the solver, largest labels first, followed by the
+    auxiliary definitions and the learned conflicts.
+    """
+    rows = sorted(statistics['labels'].items(), key=lambda item: item[1][sort], reverse=True)
+    if top is not None:
+        rows = rows[:top]
+    rows.extend([
+        ('(definitions)', statistics['definitions']),
+        ('(conflicts)', statistics['conflicts']),
+    ])
+
+    width = max(len('label'), *(len(label) for label, _ in rows))
+    lines = [f"{'label':<{width}} " + ' '.join(f'{field:>9}' for field in FIELDS)]
+    for label, stats in rows:
+        lines.append(f'{label:<{width}} ' + ' '.join(f'{stats[field]:>9}' for field in FIELDS))
+    lines.append(f"total bytes: {statistics['bytes']}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the formula size per operator label of a check.')
+    parser.add_argument('schema', help='JSON file with a schema, or an object with "schema" and "constraints"')
+    parser.add_argument('q1')
+    parser.add_argument('q2')
+    parser.add_argument('--bound', type=int, default=2)
+    parser.add_argument('--time-budget', type=int, default=60)
+    parser.add_argument('--sort', choices=FIELDS, default='bytes')
+    parser.add_argument('--top', type=int, default=None)
+    parser.add_argument('--json', help='also write the statistics to this file')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.WARNING)
+
+    with open(args.schema) as f:
+        schema = json.load(f)
+    constraints = []
+    if isinstance(schema, dict):
+        schema, constraints = schema['schema'], schema.get('constraints', [])
+
+    env = Environment(schema, constraints, bound=args.bound, time_budget=args.time_budget)
+    eq, cex, checking_time, total_time, ret = env.check(args.q1, args.q2)
+    print(f"status: {ret.get('status')}, total time: {total_time}")
+
+    statistics = ret.get('formula_stats')
+    if statistics is None:
+        # e.g., answered by the syntactic fast path
+        print('no formula was sent to the solver')
+        return
+    print(format_report(statistics, args.sort, args.top))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(statistics, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ class TableSchema:
             'groups_considered': None
         }
         self.node = None
+        # column ids of declared primary/distinct keys that stay unique in this table
+        self.unique_keys: [frozenset] = []
 
         self.scope = None  # belongs to which query
 
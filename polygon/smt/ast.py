@@ -130,6 +130,44 @@ class Choice(SMTNode):
         return f"Choice({self.table_id}, {self.bit_id})"
 
 
+class BoolChoice(SMTNode):
+    def __init__(self, table_id, bit_id):
+        self.table_id = table_id
+        self.bit_id = bit_id
+
+    def return_type(self):
+        return 'Bool'
+
+    def __str__(self):
+        return f"BoolChoice({self.table_id}, {self.bit_id})"
+
+
+class OneHotChoice(SMTNode):
+    def __init__(self, table_id, bit_id, value):
+        self.table_id = table_id
+        self.bit_id = bit_id
+        self.value = value
+
+    def return_type(self):
+        return 'Bool'
+
+    def __str__(self):
+        return f"OneHotChoice({self.table_id}, {self.bit_id}, {self.value})"
+
+
+class Var(SMTNode):
+    # auxiliary variable introduced by FormulaManager.define
+    def __init__(self, name, sort='Bool'):
+        self.name = name
+        self.sort = sort
+
+    def return_type(self):
+        return self.sort
+
+    def __str__(self):
+        return self.name
+
+
 class CompNode(SMTNode):
     def __init__(self, a, b):
         assert isinstance(a, SMTNode)
@@ -346,6 +384,36 @@ class Bool(SMTNode):
         return str(self.x).upper()
 
 
+class PbNode(SMTNode):
+    def __init__(self, args, coefficients, k):
+        assert isinstance(args, list)
+        assert len(args) == len(coefficients)
+        self.args = args
+        self.coefficients = coefficients
+        self.k = k
+
+    def return_type(self):
+        return 'Bool'
+
+    def terms(self):
+        return ' + '.join([f"{c} * {str(x)}" for c, x in zip(self.coefficients, self.args)])
+
+
+class PbEq(PbNode):
+    def __str__(self):
+        return f"{self.terms()} == {self.k}"
+
+
+class PbLe(PbNode):
+    def __str__(self):
+        return f"{self.terms()} <= {self.k}"
+
+
+class PbGe(PbNode):
+    def __str__(self):
+        return f"{self.terms()} >= {self.k}"
+
+
 # Functions
 def Sum(args):
     if not args:
@@ -1,4 +1,5 @@
 import itertools
+import multiprocess
 import random
 
 from bidict import bidict
@@ -8,6 +9,52 @@ from polygon.logger import logger
 from polygon.smt.ast import *
 from polygon.smt.knowledgebase import KnowledgeBase
 from polygon.smt.provers.smtlibv2 import SMTLIBv2Visitor, SMTLIBv2
+from polygon.smt.pseudo_boolean import PseudoBooleanEncoder, exactly_one
+from polygon.smt.simplifier import Simplifier
+from polygon.smt.statistics import formula_statistics, total
+from polygon.smt.symbols import SymbolTable
+from polygon.smt.theory import TheoryInspector, select_theory
+from polygon.tracing import traced
+from polygon.visitors.decorrelator import subqueries
+
+# keeps the position of a deferred operator encoding among the labels
+PENDING = Bool(True)
+# labels whose encodings do not change once they are dumped
+CACHED_LABELS = ['ic', 'neq', 'disambiguation']
+
+
+def is_cached(label):
+    return '$' in label or 'scan' in label or label.startswith('size_groups_') or label in CACHED_LABELS
+
+
+def serialize(formulas, simplify, domains, flat_constants):
+    """
+    Rewrites and prints labeled formulas in a worker process. Besides the SMT-LIB of every label, returns the
+    constants and one-hot choices the worker came across, which the caller merges into its own.
+    """
+    symbols = SymbolTable() if flat_constants else None
+    visitor = SMTLIBv2Visitor(symbols)
+    simplifier = Simplifier()
+    encoder = PseudoBooleanEncoder(domains) if domains is not None else None
+    serialized = {}
+    for label, formula in formulas:
+        if simplify:
+            formula = simplifier.simplify(formula)
+        if encoder is not None:
+            formula = encoder.encode(formula)
+            if simplify:
+                formula = simplifier.simplify(formula)
+        visitor.variables = set()
+        formula_smt_lib = formula.accept(visitor)
+        fragment = TheoryInspector().inspect(formula)
+        serialized[label] = (
+            formula_smt_lib, visitor.variables, fragment, formula_statistics(formula, formula_smt_lib, fragment)
+        )
+    return (
+        serialized,
+        list(symbols.symbols.values()) if symbols is not None else [],
+        encoder.one_hot if encoder is not None else {},
+    )
 
 
 class FormulaManager:
@@ -29,15 +76,60 @@ class FormulaManager:
         self.table_bound = {}
 
         self.visited_formula_cache = {}
+        self.simplified_formula_cache = {}
+        self.formula_theory_cache = {}
+        self.formula_variables_cache = {}
+        self.formula_statistics_cache = {}
+        # sizes of the formulas of the last problem dumped, see dump()
+        self.statistics = None
+
+        # auxiliary variables, name -> (variable, defining formula)
+        self.definitions = {}
+        self.definition_cache = {}
+        self.next_definition = 0
+
+        # aggregate terms of a table or group, so an aggregate is encoded once however often it is referenced
+        self.aggregate_cache = {}
+        # (expression id, table id, tuple index, ...) -> (expression, (val, null))
+        self.expression_cache = {}
+        # operator label -> encodings postponed until the search considers the operator
+        self.deferred = {}
+        # search state flushed at every iteration, see Checkpoint
+        self.checkpoint = None
+        # caps on the number of groups lifted by the search, which operators encoded later must not assert again
+        self.relaxed_caps = set()
+
+        self.theory = 'QF_UFNIA'
+        self.nonlinear_labels = []
+        self.one_hot_choices = {}
+
+        # ground applications of cell, null, ... are declared as constants when a symbol table is used
+        self.symbols = SymbolTable() if env.flat_constants else None
 
         self.ret = None
 
+    @property
+    def tracer(self):
+        return self.env.tracer
+
+    @property
+    def metrics(self):
+        return self.env.metrics
+
+    def define(self, name: str, f: SMTNode, sort: str = None) -> Var:
+        # the definition is asserted whenever a dumped formula refers to the variable
+        if name not in self.definitions:
+            self.definitions[name] = (Var(name, sort if sort is not None else f.return_type()), f)
+        return self.definitions[name][0]
+
     def append(self, f: SMTNode, label: str = None):
+        if label in self.relaxed_caps:
+            return
         if label is None:
             label = f'f_{self.next_label}'
             self.next_label += 1
 
-        if label in self.formulas:
+        if label in self.formulas and self.formulas[label] is not PENDING:
             # label = f'{label}_{self.next_label}'
             # self.formulas[label] = f
             self.formulas[label] = And([self.formulas[label], f])
@@ -45,6 +137,30 @@ class FormulaManager:
         else:
             self.formulas[label] = f
 
+    def encode(self, label: str, semantics, expressions=()):
+        # subqueries add tables and labels while they are encoded, which the search has to know up front
+        if not self.env.lazy_encoding or next(subqueries(list(expressions)), None) is not None:
+            with self.env.tracer.span('operator', label=label, lazy=False):
+                semantics()
+            return
+
+        query_id = self.env.curr_query_id
+
+        def encode():
+            curr_query_id, self.env.curr_query_id = self.env.curr_query_id, query_id
+            with self.env.tracer.span('operator', label=label, lazy=True):
+                semantics()
+            self.env.curr_query_id = curr_query_id
+
+        self.deferred.setdefault(label, []).append(encode)
+        if label not in self.formulas:
+            self.formulas[label] = PENDING
+
+    def encode_deferred(self):
+        for label in [label for label in self.deferred if '$' not in label or label in self.labels_considered]:
+            for encode in self.deferred.pop(label):
+                encode()
+
     def init_label_table_id_bidict(self):
         label_to_table_id = {}
         for table in self.env.db.schemas.values():
@@ -75,6 +191,7 @@ class FormulaManager:
         self.label_to_table_id = label_to_table_id
         logger.debug(self.label_to_table_id)
 
+    @traced('search')
     def search_naive(self, outputs, ret):
         self.ret = ret
         ret['iters'] = 0
@@ -87,10 +204,7 @@ class FormulaManager:
         self.init_label_table_id_bidict()
         ret['ast_size'] = len(self.label_to_table_id)
 
-        prover = SMTLIBv2(
-            executable_path='z3',
-            executable_options=['--in', f'-T:{self.timeout}'],
-        )
+        prover = self.new_prover()
 
         self.labels_considered = list(self.formulas.keys())
 
@@ -115,7 +229,7 @@ class FormulaManager:
             self.current_under = dict(zip(labels, ua_comb))
             # print(self.current_under)
             self.encode_current_under()
-            if prover.check(self.dump()):
+            if self.check(prover):
                 for node_label in all_nodes:
                     if node_label not in self.label_to_table_id:
                         continue
@@ -126,6 +240,7 @@ class FormulaManager:
 
         return None
 
+    @traced('search')
     def search(self, outputs, ret):
         self.ret = ret
         ret['iters'] = 0
@@ -136,12 +251,10 @@ class FormulaManager:
         ret['solving_time_per_iter'] = []
         ret['num_nodes_changed'] = []
         self.init_label_table_id_bidict()
-        prover = SMTLIBv2(
-            executable_path='z3',
-            executable_options=['--in', f'-T:{self.timeout}'],
-        )
+        prover = self.new_prover()
 
         ret['ast_size'] = len(self.label_to_table_id)
+        self.metrics.counter('polygon_searches_total').inc()
 
         remaining = [list(self.formulas.keys())]
         worklist = []
@@ -215,8 +328,34 @@ class FormulaManager:
                         #     worklist.append(label_to_add)
                         #     del ast_labels[-1]
 
+        if self.checkpoint is not None:
+            state = self.checkpoint.load()
+            if state is not None:
+                worklist, remaining = state['worklist'], state['remaining']
+                self.labels_considered = state['labels_considered']
+                self.current_under = state['current_under']
+                self.kb = state['kb']
+                self.relaxed_caps = set(state['group_caps_relaxed'])
+                for label in self.relaxed_caps:
+                    self.formulas.pop(label, None)
+                ret['group_caps_relaxed'] = state['group_caps_relaxed']
+                ret['iters'], ret['backtracks'] = state['iters'], state['backtracks']
+                ret['resumed_from'] = state['iters']
+
         while worklist:
+            if self.checkpoint is not None:
+                self.checkpoint.save({
+                    'worklist': worklist,
+                    'remaining': remaining,
+                    'labels_considered': self.labels_considered,
+                    'current_under': self.current_under,
+                    'kb': self.kb,
+                    'group_caps_relaxed': ret.get('group_caps_relaxed', []),
+                    'iters': ret['iters'],
+                    'backtracks': ret['backtracks'],
+                })
             ret['iters'] += 1
+            self.metrics.counter('polygon_search_iterations_total').inc()
             # print(worklist, self.labels_considered, remaining)
             self.encode_current_under()
             logger.debug(f'current under: {self.current_under}')
@@ -229,13 +368,16 @@ class FormulaManager:
             #         pass
 
             logger.debug(1)
-            if not prover.check(self.dump()):
+            if not self.check(prover):
                 logger.debug(2)
+                if self.relax_group_caps(prover.unsat_core):
+                    continue
                 # backtrack
                 logger.debug('backtrack')
 
                 # record experiment data
                 ret['backtracks'] += 1
+                self.metrics.counter('polygon_search_backtracks_total').inc()
                 ret['unsat_core_sizes'] = [*deepcopy(ret['unsat_core_sizes']), len(list(filter(lambda x: '$' in x, prover.unsat_core)))]
                 ret['M_sizes'] = [*deepcopy(ret['M_sizes']), len([v for v in self.labels_considered if '$' in v])]
                 if 'neq' in prover.unsat_core or 'disambiguation' in prover.unsat_core:
@@ -301,12 +443,10 @@ class FormulaManager:
         logger.debug(f'#Backtracks: {num_backtracks}')
         return prover
 
+    @traced('backtrack')
     def backtrack(self, unsat_core, ret):
         logger.debug(f'unsat core: {unsat_core}')
-        prover = SMTLIBv2(
-            executable_path='z3',
-            executable_options=['--in', f'-T:{self.timeout}'],
-        )
+        prover = self.new_prover()
 
         prev_labels_considered = deepcopy(self.labels_considered)
 
@@ -334,7 +474,11 @@ class FormulaManager:
             logger.debug(f'trying partition {self.current_under}')
             # print(self.current_under)
             self.encode_current_under()
-            if prover.check(self.dump()):
+            sat = self.check(prover)
+            # a partition is only a conflict once no cap on the number of groups is in its way
+            while not sat and self.relax_group_caps(prover.unsat_core):
+                sat = self.check(prover)
+            if sat:
                 for node_label in unsat_core:
                     if node_label not in self.label_to_table_id:
                         continue
@@ -463,6 +607,19 @@ class FormulaManager:
         else:
             yield ['T'] * vec_size
 
+    def group_caps(self):
+        return [label for label in self.formulas if label.startswith('size_groups_')]
+
+    def relax_group_caps(self, unsat_core):
+        # lift capped numbers of groups before backtracking on choices
+        relaxed = [label for label in unsat_core if label.startswith('size_groups_')]
+        for label in relaxed:
+            del self.formulas[label]
+            self.relaxed_caps.add(label)
+        if relaxed:
+            self.ret['group_caps_relaxed'] = [*self.ret.get('group_caps_relaxed', []), *relaxed]
+        return bool(relaxed)
+
     def add_kb(self, unsat_core):
         conflict = {}
         for node_label in unsat_core:
@@ -487,6 +644,7 @@ class FormulaManager:
                     f.append(Choice(table_id, bit_id) == Int(bit_val))
         self.formulas['under'] = And(f)
 
+    @traced('search')
     def solve_precise(self, ret):
         self.ret = ret
         ret['backtracks'] = 0
@@ -495,10 +653,7 @@ class FormulaManager:
         ret['M_sizes'] = []
         ret['solving_time_per_iter'] = []
         self.init_label_table_id_bidict()
-        prover = SMTLIBv2(
-            executable_path='z3',
-            executable_options=['--in', f'-T:300'],
-        )
+        prover = self.new_prover(timeout=300)
 
         # self.current_under = {
         #     1: ['T', 'T', 0, 0, 'T', 'T', 0, 0],
@@ -511,8 +666,13 @@ class FormulaManager:
 
         for label in self.formulas:
             self.labels_considered.add(label)
+        self.encode_deferred()
+
+        # the precise encoding considers any number of groups
+        for label in self.group_caps():
+            del self.formulas[label]
 
-        if prover.check(self.dump()):
+        if self.check(prover):
             for table_id in self.label_to_table_id.values():
                 table = self.env.db.schemas[table_id]
                 vec = prover.evaluate_choice_vector(table)
@@ -523,28 +683,206 @@ class FormulaManager:
             # print(prover.unsat_core)
         return None
 
+    def rewrite(self, formula, simplifier, encoder, label=None):
+        if label is not None and label in self.simplified_formula_cache:
+            return self.simplified_formula_cache[label]
+        if self.env.simplify:
+            formula = simplifier.simplify(formula)
+        if encoder is not None:
+            formula = encoder.encode(formula)
+            if self.env.simplify:
+                formula = simplifier.simplify(formula)
+        if label is not None:
+            self.simplified_formula_cache[label] = formula
+        return formula
+
+    def choice_domains(self):
+        # multi-valued choices (e.g., ORDER BY positions) are one-hot encoded with Boolean choices
+        domains = {}
+        for table in self.env.db.schemas.values():
+            if table.ctx.get('choice_domain') is not None:
+                domains[table.table_id] = table.ctx['choice_domain']
+        return domains
+
+    def new_prover(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return SMTLIBv2(
+            executable_path='z3',
+            executable_options=['--in', f'-T:{timeout}'],
+            symbols=self.symbols,
+            choice_domains=self.choice_domains() if self.env.choice_encoding == 'bool' else None,
+            tracer=self.tracer,
+            metrics=self.metrics,
+        )
+
     def dump(self):
-        visitor = SMTLIBv2Visitor()
+        visitor = SMTLIBv2Visitor(self.symbols)
+        simplifier = Simplifier()
+        encoder = PseudoBooleanEncoder(self.choice_domains()) if self.env.choice_encoding == 'bool' else None
+        fragments = {}
+        variables = set()
+        statistics = {}
         out = ''
+        self.encode_deferred()
+        if self.env.encoding_workers is not None and self.env.encoding_workers > 1:
+            self.serialize_in_parallel(encoder)
         for label, formula in self.formulas.items():
             if '$' in label and label not in self.labels_considered:
                 continue
             # print(label)
 
             # cache operator encodings since they will not change
-            if '$' in label or 'scan' in label or label in ['ic', 'neq', 'disambiguation']:
+            if is_cached(label):
+                self.metrics.lookup('formula', label in self.visited_formula_cache)
                 if label not in self.visited_formula_cache:
+                    formula = self.rewrite(formula, simplifier, encoder, label)
+                    visitor.variables = set()
                     self.visited_formula_cache[label] = formula.accept(visitor)
+                    self.formula_theory_cache[label] = TheoryInspector().inspect(formula)
+                    self.formula_variables_cache[label] = visitor.variables
+                    self.formula_statistics_cache[label] = formula_statistics(
+                        formula, self.visited_formula_cache[label], self.formula_theory_cache[label]
+                    )
                 formula_smt_lib = self.visited_formula_cache[label]
+                fragments[label] = self.formula_theory_cache[label]
+                variables |= self.formula_variables_cache[label]
+                statistics[label] = self.formula_statistics_cache[label]
             else:
+                formula = self.rewrite(formula, simplifier, encoder)
+                visitor.variables = set()
                 formula_smt_lib = formula.accept(visitor)
+                fragments[label] = TheoryInspector().inspect(formula)
+                variables |= visitor.variables
+                statistics[label] = formula_statistics(formula, formula_smt_lib, fragments[label])
             out = f'{out}\n(assert (! {formula_smt_lib} :named {label}))'
 
+        conflicts = []
         for conflict_name, formula in self.kb.conflicts_learned.items():
-            out = f'{out}\n(assert (! {formula.accept(visitor)} :named {conflict_name}))'
-
+            formula = self.rewrite(formula, simplifier, encoder)
+            formula_smt_lib = formula.accept(visitor)
+            conflicts.append(formula_statistics(formula, formula_smt_lib, TheoryInspector().inspect(formula)))
+            out = f'{out}\n(assert (! {formula_smt_lib} :named {conflict_name}))'
+
+        definitions = {}
+        out = f'{self.dump_definitions(variables, visitor, simplifier, encoder, fragments, definitions)}{out}'
+        self.statistics = {
+            'labels': statistics,
+            'definitions': total(definitions.values()),
+            'conflicts': total(conflicts),
+            'bytes': len(out),
+        }
+
+        if encoder is not None:
+            # one-hot choices of cached labels still need their values to be exclusive
+            self.one_hot_choices.update(encoder.one_hot)
+            for f in exactly_one(self.one_hot_choices):
+                out = f'(assert {f.accept(visitor)})\n{out}'
+
+        if self.symbols is not None:
+            out = f'{self.symbols.dump()}\n{out}'
+
+        self.select_theory(fragments)
         return out
 
+    @traced('serialize')
+    def serialize_in_parallel(self, encoder):
+        labels = [
+            label for label in self.formulas
+            if is_cached(label) and label not in self.visited_formula_cache
+            and ('$' not in label or label in self.labels_considered)
+        ]
+        if len(labels) < 2:
+            return
+
+        workers = min(self.env.encoding_workers, len(labels))
+        with multiprocess.Pool(workers) as pool:
+            results = pool.starmap(serialize, [
+                (
+                    [(label, self.formulas[label]) for label in labels[worker_id::workers]],
+                    self.env.simplify,
+                    encoder.domains if encoder is not None else None,
+                    self.symbols is not None,
+                )
+                for worker_id in range(workers)
+            ])
+
+        for serialized, symbols, one_hot in results:
+            for label, (formula_smt_lib, variables, fragment, stats) in serialized.items():
+                self.visited_formula_cache[label] = formula_smt_lib
+                self.formula_variables_cache[label] = variables
+                self.formula_theory_cache[label] = fragment
+                self.formula_statistics_cache[label] = stats
+            for function, args, _ in symbols:
+                self.symbols.constant(function, args)
+            if encoder is not None:
+                encoder.one_hot.update(one_hot)
+
+    def dump_definitions(self, variables, visitor, simplifier, encoder, fragments, statistics):
+        declarations = ''
+        out = ''
+        dumped = set()
+        worklist = list(variables)
+        while worklist:
+            name = worklist.pop()
+            if name in dumped:
+                continue
+            dumped.add(name)
+
+            self.metrics.lookup('definition', name in self.definition_cache)
+            if name not in self.definition_cache:
+                variable, formula = self.definitions[name]
+                formula = self.rewrite(formula, simplifier, encoder)
+                visitor.variables = set()
+                formula_smt_lib = formula.accept(visitor)
+                fragment = TheoryInspector().inspect(formula)
+                self.definition_cache[name] = (
+                    variable.sort, formula_smt_lib, visitor.variables, fragment,
+                    formula_statistics(formula, formula_smt_lib, fragment),
+                )
+            sort, formula_smt_lib, dependencies, fragments[name], statistics[name] = self.definition_cache[name]
+            # definitions may refer to other auxiliary variables
+            worklist.extend(dependencies)
+            declarations = f'{declarations}\n(declare-const {name} {sort})'
+            out = f'{out}\n(assert (= {name} {formula_smt_lib}))'
+        return f'{declarations}{out}'
+
+    def select_theory(self, fragments):
+        # knowledge base conflicts only compare choice variables against constants, which is linear
+        self.nonlinear_labels = [label for label, fragment in fragments.items() if fragment.nonlinear]
+        if self.env.theory is not None:
+            self.theory = self.env.theory
+            return
+
+        if self.symbols is None:
+            # the prover declares cell, null, deleted, ... as functions over integers
+            functions, arithmetic = True, True
+        else:
+            # every declared constant is emitted, including integer ones only used by conflicts
+            functions = False
+            arithmetic = any(fragment.arithmetic for fragment in fragments.values()) or self.symbols.has_sort('Int')
+        self.theory = select_theory(
+            functions=functions,
+            arithmetic=arithmetic,
+            nonlinear=bool(self.nonlinear_labels),
+            pseudo_boolean=any(fragment.pseudo_boolean for fragment in fragments.values()),
+        )
+        if self.nonlinear_labels:
+            logger.debug(f'non-linear arithmetic required by {self.nonlinear_labels}')
+
+    def check(self, prover):
+        with self.tracer.span('dump') as span:
+            formula = self.dump()
+            span.set(bytes=len(formula), theory=self.theory)
+        if self.ret is not None:
+            # recorded before solving, so that checks that time out report them too
+            self.ret['formula_stats'] = self.statistics
+        return prover.check(formula, theory=self.theory)
+
+    def next_definition_name(self, prefix):
+        self.next_definition += 1
+        return f'{prefix}{self.next_definition}'
+
     def next_node_label(self):
         self.node_cur_label += 1
         return self.node_cur_label
@@ -1,5 +1,6 @@
 import datetime
 import fractions
+import functools
 import subprocess
 import traceback
 
@@ -7,33 +8,66 @@ from subprocess import Popen, PIPE
 
 from polygon.errors import SMTSolverError
 from polygon.logger import logger
+from polygon.metrics import Registry
 from polygon.smt.ast import *
+from polygon.smt.symbols import FUNCTION_SORTS
+from polygon.tracing import Tracer
+
+
+def evaluation(method):
+    # one span per evaluated table, with the number of (eval ...) round trips it took
+    @functools.wraps(method)
+    def wrapper(self, table, *args):
+        with self.tracer.span(method.__name__, table_id=table.table_id) as span:
+            evaluations = self.evaluations
+            result = method(self, table, *args)
+            span.set(round_trips=self.evaluations - evaluations)
+        return result
+    return wrapper
 
 
 class SMTLIBv2Visitor:
-    def __init__(self):
-        pass
+    def __init__(self, symbols=None):
+        # with a symbol table, ground function applications are emitted as flat constants
+        self.symbols = symbols
+        # auxiliary variables referenced by the formulas visited so far
+        self.variables = set()
+
+    def apply(self, function, *args):
+        if self.symbols is not None:
+            return self.symbols.constant(function, args)
+        return f'({function} {" ".join(map(str, args))})'
 
     def visit_SMTCell(self, node):
-        return f'(cell {node.table_id} {node.row_id} {node.column_id})'
+        return self.apply('cell', node.table_id, node.row_id, node.column_id)
 
     def visit_SMTNull(self, node):
-        return f'(null {node.table_id} {node.row_id} {node.column_id})'
+        return self.apply('null', node.table_id, node.row_id, node.column_id)
 
     def visit_SMTGrouping(self, node):
-        return f'(grouping {node.table_id} {node.tuple_id} {node.group_id})'
+        return self.apply('grouping', node.table_id, node.tuple_id, node.group_id)
 
     def visit_Deleted(self, node):
-        return f'(deleted {node.table_id} {node.tuple_id})'
+        return self.apply('deleted', node.table_id, node.tuple_id)
 
     def visit_SMTBelongsToGroup(self, node):
-        return f'(belongstogroup {node.qid} {node.gid})'
+        return self.apply('belongstogroup', node.qid, node.gid)
 
     def visit_SMTSize(self, node):
-        return f'(size {node.table_id})'
+        return self.apply('size', node.table_id)
 
     def visit_Choice(self, node):
-        return f'(choice {node.table_id} {node.bit_id})'
+        return self.apply('choice', node.table_id, node.bit_id)
+
+    def visit_BoolChoice(self, node):
+        return self.apply('bchoice', node.table_id, node.bit_id)
+
+    def visit_OneHotChoice(self, node):
+        return self.apply('onehot', node.table_id, node.bit_id, node.value)
+
+    def visit_Var(self, node):
+        self.variables.add(node.name)
+        return node.name
 
     def visit_And(self, node):
         if len(node.conjunct) == 0:
@@ -117,20 +151,34 @@ class SMTLIBv2Visitor:
         args = ' '.join([arg.accept(self) for arg in node.args])
         return f'((_ pbeq {node.k} {coefficients}) {args})'
 
+    def visit_PbLe(self, node):
+        coefficients = ' '.join(map(str, node.coefficients))
+        args = ' '.join([arg.accept(self) for arg in node.args])
+        return f'((_ pble {node.k} {coefficients}) {args})'
+
+    def visit_PbGe(self, node):
+        coefficients = ' '.join(map(str, node.coefficients))
+        args = ' '.join([arg.accept(self) for arg in node.args])
+        return f'((_ pbge {node.k} {coefficients}) {args})'
+
     def visit(self, node):
         print(type(node))
         raise NotImplementedError
 
 
 class SMTLIBv2:
-    def __init__(self, executable_path, executable_options=None, theory='QF_UFNIA'):  # QF_UFNIRA
+    def __init__(self, executable_path, executable_options=None, theory='QF_UFNIA', symbols=None,
+                 choice_domains=None, tracer=None, metrics=None):  # QF_UFNIRA
         self.executable_path = executable_path
         if executable_options is None:
             executable_options = []
         self.executable_options = executable_options
         self.theory = theory
+        self.symbols = symbols
+        # Boolean choices are used when given, with the domains of one-hot encoded choices
+        self.choice_domains = choice_domains
 
-        self.visitor = SMTLIBv2Visitor()
+        self.visitor = SMTLIBv2Visitor(symbols)
         self.smt_process = None
         self.parser_env = None
         self.model = None
@@ -142,61 +190,66 @@ class SMTLIBv2:
 
         self.checking_time = 0
         self.unsat_core_time = 0
-
-    def check(self, formula: str):
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.metrics = metrics if metrics is not None else Registry(enabled=False)
+        # (eval ...) round trips to the solver
+        self.evaluations = 0
+
+    def check(self, formula: str, theory: str = None):
+        if theory is None:
+            theory = self.theory
         # (set-option :smt.core.minimize true)
         smt2 = f'''
-(set-logic {self.theory})
+(set-logic {theory})
 (set-option :produce-models true)
 (set-option :produce-unsat-cores true)
 (set-option :smt.arith.solver 2)
 (set-option :smt.arith.random_initial_value true)
 (set-option :smt.phase_selection 2)
-
-(declare-fun cell (Int Int Int) Int)
-(declare-fun null (Int Int Int) Bool)
-(declare-fun grouping (Int Int Int) Bool)
-(declare-fun deleted (Int Int) Bool)
-(declare-fun choice (Int Int) Int)
-(declare-fun size (Int) Int)
-
-(declare-fun belongstogroup (Int Int) Bool)
-
+{self.declarations()}
 {formula}
 
 (check-sat)
         '''
 
         try:
-            self.smt_process = Popen(
-                [self.executable_path, *self.executable_options],
-                stdin=PIPE,
-                stdout=PIPE,
-                universal_newlines=True
-            )
-            self.smt_process.stdin.write(smt2)
-            self.smt_process.stdin.flush()
-
-            start = datetime.datetime.now()
-            state = self.smt_process.stdout.readline().strip()
-            self.checking_time = (datetime.datetime.now() - start).total_seconds()
-
-            while state not in ['sat', 'unsat']:
-                if 'error' in state.lower() or 'unsupported' in state.lower():
-                    raise SMTSolverError(state)
-                elif 'warning' in state.lower():
-                    logger.warning(f'Solver msg: {state}')
+            with self.tracer.span('solver'):
+                self.smt_process = Popen(
+                    [self.executable_path, *self.executable_options],
+                    stdin=PIPE,
+                    stdout=PIPE,
+                    universal_newlines=True
+                )
+                self.metrics.counter('polygon_solver_processes_total').inc()
+            with self.tracer.span('check-sat', theory=theory, bytes=len(smt2)) as span:
+                self.smt_process.stdin.write(smt2)
+                self.smt_process.stdin.flush()
+
+                start = datetime.datetime.now()
                 state = self.smt_process.stdout.readline().strip()
+                self.checking_time = (datetime.datetime.now() - start).total_seconds()
+
+                while state not in ['sat', 'unsat']:
+                    if 'error' in state.lower() or 'unsupported' in state.lower():
+                        raise SMTSolverError(state)
+                    elif 'warning' in state.lower():
+                        logger.warning(f'Solver msg: {state}')
+                    state = self.smt_process.stdout.readline().strip()
+                span.set(result=state)
+                self.metrics.counter('polygon_solver_checks_total').inc(result=state)
+                self.metrics.histogram('polygon_solver_check_seconds').observe(self.checking_time)
 
             if state == 'sat':
                 return True
             elif state == 'unsat':
-                start = datetime.datetime.now()
-                self.smt_process.stdin.write('(get-unsat-core)\n')
-                self.smt_process.stdin.flush()
-                self.unsat_core = self.smt_process.stdout.readline().strip()[1:-1].split()
+                with self.tracer.span('unsat-core') as span:
+                    start = datetime.datetime.now()
+                    self.smt_process.stdin.write('(get-unsat-core)\n')
+                    self.smt_process.stdin.flush()
+                    self.unsat_core = self.smt_process.stdout.readline().strip()[1:-1].split()
 
-                self.unsat_core_time = (datetime.datetime.now() - start).total_seconds()
+                    self.unsat_core_time = (datetime.datetime.now() - start).total_seconds()
+                    span.set(size=len(self.unsat_core))
 
                 if len(self.unsat_core) == 0:
                     self.unsat_core = None
@@ -209,12 +262,38 @@ class SMTLIBv2:
             logger.error(''.join(traceback.format_tb(e.__traceback__)) + str(e))
             raise SMTSolverError
 
+    def declarations(self):
+        if self.symbols is not None:
+            # flat constants are declared along with the formula
+            return ''
+        return '''
+(declare-fun cell (Int Int Int) Int)
+(declare-fun null (Int Int Int) Bool)
+(declare-fun grouping (Int Int Int) Bool)
+(declare-fun deleted (Int Int) Bool)
+(declare-fun choice (Int Int) Int)
+(declare-fun bchoice (Int Int) Bool)
+(declare-fun onehot (Int Int Int) Bool)
+(declare-fun size (Int) Int)
+
+(declare-fun belongstogroup (Int Int) Bool)
+'''
+
     def evaluate(self, term: str, args: list = None):
-        command = f'(eval ({term}'
-        if args is not None:
-            command += ' ' + ' '.join([str(v) for v in args])
-        command += '))'
+        if self.symbols is not None:
+            name = self.symbols.name(term, args or [])
+            if name not in self.symbols:
+                # the constant does not occur in any formula, so any value is a model
+                return '0' if FUNCTION_SORTS[term] == 'Int' else 'false'
+            command = f'(eval {name} :completion true)'
+        else:
+            command = f'(eval ({term}'
+            if args is not None:
+                command += ' ' + ' '.join([str(v) for v in args])
+            command += '))'
 
+        self.evaluations += 1
+        self.metrics.counter('polygon_solver_evaluations_total').inc()
         self.smt_process.stdin.write(f'{command}\n')
         self.smt_process.stdin.flush()
         out = self.smt_process.stdout.readline().rstrip()
@@ -222,6 +301,7 @@ class SMTLIBv2:
             out = '-' + out[3:-1]
         return out
 
+    @evaluation
     def evaluate_choice_vector(self, table):
         table_id = table.table_id
         vec = []
@@ -230,6 +310,9 @@ class SMTLIBv2:
         else:
             vec_size = table.bound
         for bit_id in range(vec_size):
+            if self.choice_domains is not None:
+                vec.append(self.evaluate_bool_choice(table_id, bit_id))
+                continue
             bit = self.evaluate('choice', [table_id, bit_id])
             try:
                 vec.append(int(bit))
@@ -237,6 +320,20 @@ class SMTLIBv2:
                 vec.append('T')
         return vec
 
+    def evaluate_bool_choice(self, table_id, bit_id):
+        if table_id in self.choice_domains:
+            for value in range(self.choice_domains[table_id] + 1):
+                if self.evaluate('onehot', [table_id, bit_id, value]) == 'true':
+                    return value
+            return 'T'
+        match self.evaluate('bchoice', [table_id, bit_id]):
+            case 'true':
+                return 1
+            case 'false':
+                return 0
+        return 'T'
+
+    @evaluation
     def evaluate_table(self, table, db, env):
         cex = []
 
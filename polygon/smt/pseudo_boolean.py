@@ -0,0 +1,193 @@
+import operator
+
+from polygon.smt.ast import *
+
+
+COMPARISONS = {
+    Eq: operator.eq,
+    Neq: operator.ne,
+    Gt: operator.gt,
+    Gte: operator.ge,
+    Lt: operator.lt,
+    Lte: operator.le,
+}
+
+# a <op> b is b <flipped op> a
+FLIPPED = {Eq: Eq, Neq: Neq, Gt: Lt, Gte: Lte, Lt: Gt, Lte: Gte}
+
+
+def is_numeral(node):
+    return isinstance(node, Int) and isinstance(node.x, int) and not isinstance(node.x, bool)
+
+
+def exactly_one(one_hot: dict):
+    return [
+        PbEq([OneHotChoice(table_id, bit_id, value) for value in range(k + 1)], [1] * (k + 1), 1)
+        for (table_id, bit_id), k in one_hot.items()
+    ]
+
+
+class PseudoBooleanEncoder:
+    """
+    Rewrites choice variables into Booleans, one-hot Booleans for multi-valued choices, and counting constraints
+    over 0/1 indicators into native pseudo-Boolean constraints.
+    """
+
+    def __init__(self, domains: dict = None):
+        # table id -> largest value of its multi-valued choices, other choices are binary
+        self.domains = domains if domains is not None else {}
+        self.one_hot = {}
+        self.memo = {}
+
+    def encode(self, node):
+        key = id(node)
+        if key in self.memo:
+            return self.memo[key][1]
+        result = node.accept(self)
+        self.memo[key] = (node, result)
+        return result
+
+    def domain(self, choice):
+        if choice.table_id in self.domains:
+            return range(self.domains[choice.table_id] + 1)
+        return range(2)
+
+    def indicator(self, choice, value):
+        if choice.table_id in self.domains:
+            # exactly one value of a one-hot choice holds, see exactly_one()
+            self.one_hot[choice.table_id, choice.bit_id] = self.domains[choice.table_id]
+            return OneHotChoice(choice.table_id, choice.bit_id, value)
+        b = BoolChoice(choice.table_id, choice.bit_id)
+        return b if value == 1 else Not(b)
+
+    def visit_Choice(self, node):
+        # choice used as an integer
+        return Sum([If(self.indicator(node, value), Int(value), Int(0)) for value in self.domain(node) if value != 0])
+
+    def visit_And(self, node):
+        return And([self.encode(x) for x in node.conjunct])
+
+    def visit_Or(self, node):
+        return Or([self.encode(x) for x in node.disjunct])
+
+    def visit_Not(self, node):
+        return Not(self.encode(node.node))
+
+    def visit_Xor(self, node):
+        return Xor(self.encode(node.a), self.encode(node.b))
+
+    def visit_Implies(self, node):
+        return Implies(self.encode(node.premise), self.encode(node.conclusion))
+
+    def visit_If(self, node):
+        return If(self.encode(node.a), self.encode(node.b), self.encode(node.c))
+
+    def visit_Plus(self, node):
+        return Plus(self.encode(node.a), self.encode(node.b))
+
+    def visit_Minus(self, node):
+        return Minus(self.encode(node.a), self.encode(node.b))
+
+    def visit_Mul(self, node):
+        return Mul(self.encode(node.a), self.encode(node.b))
+
+    def visit_Div(self, node):
+        return Div(self.encode(node.a), self.encode(node.b))
+
+    def visit_Neg(self, node):
+        return Neg(self.encode(node.x))
+
+    def visit_Eq(self, node):
+        return self.compare(node)
+
+    def visit_Neq(self, node):
+        return self.compare(node)
+
+    def visit_Gt(self, node):
+        return self.compare(node)
+
+    def visit_Gte(self, node):
+        return self.compare(node)
+
+    def visit_Lt(self, node):
+        return self.compare(node)
+
+    def visit_Lte(self, node):
+        return self.compare(node)
+
+    def visit(self, node):
+        return node
+
+    def compare(self, node):
+        cls, a, b = node.__class__, node.a, node.b
+        if is_numeral(a) and not is_numeral(b):
+            cls, a, b = FLIPPED[cls], b, a
+
+        # choice <op> constant
+        if isinstance(a, Choice) and is_numeral(b):
+            values = [value for value in self.domain(a) if COMPARISONS[cls](value, b.x)]
+            if len(values) == len(self.domain(a)):
+                return Bool(True)
+            if not values:
+                # an empty disjunction would be serialized as true
+                return Bool(False)
+            if len(values) == 1:
+                return self.indicator(a, values[0])
+            return Or([self.indicator(a, value) for value in values])
+
+        # choices copied between tables
+        if isinstance(a, Choice) and isinstance(b, Choice) and cls in [Eq, Neq] \
+                and a.table_id not in self.domains and b.table_id not in self.domains:
+            f = Eq(BoolChoice(a.table_id, a.bit_id), BoolChoice(b.table_id, b.bit_id))
+            return f if cls == Eq else Not(f)
+
+        # counting constraints
+        lhs, rhs = self.linear(a), self.linear(b)
+        if lhs is not None and rhs is not None and (lhs[0] or rhs[0]):
+            args, coefficients = [], []
+            for atom, coefficient in lhs[0]:
+                args.append(atom)
+                coefficients.append(coefficient)
+            for atom, coefficient in rhs[0]:
+                args.append(atom)
+                coefficients.append(-coefficient)
+            k = rhs[1] - lhs[1]
+            match cls.__name__:
+                case 'Eq':
+                    return PbEq(args, coefficients, k)
+                case 'Neq':
+                    return Not(PbEq(args, coefficients, k))
+                case 'Lte':
+                    return PbLe(args, coefficients, k)
+                case 'Lt':
+                    return PbLe(args, coefficients, k - 1)
+                case 'Gte':
+                    return PbGe(args, coefficients, k)
+                case 'Gt':
+                    return PbGe(args, coefficients, k + 1)
+
+        return cls(self.encode(a), self.encode(b))
+
+    def linear(self, node):
+        # sum of coefficient * indicator plus a constant, or None
+        match node:
+            case Int():
+                if is_numeral(node):
+                    return [], node.x
+            case Choice():
+                return [(self.indicator(node, value), value) for value in self.domain(node) if value != 0], 0
+            case If():
+                if is_numeral(node.b) and is_numeral(node.c):
+                    if node.b.x == node.c.x:
+                        return [], node.b.x
+                    return [(self.encode(node.a), node.b.x - node.c.x)], node.c.x
+            case Plus() | Minus():
+                a, b = self.linear(node.a), self.linear(node.b)
+                if a is not None and b is not None:
+                    sign = 1 if isinstance(node, Plus) else -1
+                    return a[0] + [(atom, sign * coefficient) for atom, coefficient in b[0]], a[1] + sign * b[1]
+            case Neg():
+                x = self.linear(node.x)
+                if x is not None:
+                    return [(atom, -coefficient) for atom, coefficient in x[0]], -x[1]
+        return None
@@ -0,0 +1,304 @@
+from polygon.smt.ast import *
+
+
+def is_numeral(node):
+    return isinstance(node, Int) and isinstance(node.x, int) and not isinstance(node.x, bool)
+
+
+def is_bool(node, value=None):
+    if not isinstance(node, Bool):
+        return False
+    return value is None or bool(node.x) == value
+
+
+def atom_key(node):
+    # structural key for cheap atoms, used for de-duplication and absorption
+    match node:
+        case Deleted():
+            return 'deleted', node.table_id, node.tuple_id
+        case SMTNull():
+            return 'null', node.table_id, node.row_id, node.column_id
+        case SMTGrouping():
+            return 'grouping', node.table_id, node.tuple_id, node.group_id
+        case SMTBelongsToGroup():
+            return 'belongstogroup', node.qid, node.gid
+        case Var():
+            return 'var', node.name
+        case Not():
+            key = atom_key(node.node)
+            if key is not None:
+                return 'not', key
+        case CompNode():
+            a, b = term_key(node.a), term_key(node.b)
+            if a is not None and b is not None:
+                return node.__class__.__name__, a, b
+    return None
+
+
+def term_key(node):
+    match node:
+        case Choice():
+            return 'choice', node.table_id, node.bit_id
+        case SMTCell():
+            return 'cell', node.table_id, node.row_id, node.column_id
+        case SMTSize():
+            return 'size', node.table_id
+        case Var():
+            return 'var', node.name
+        case Int():
+            return 'int', node.x
+    return None
+
+
+def negated_key(key):
+    if key[0] == 'not':
+        return key[1]
+    return 'not', key
+
+
+class Simplifier:
+    def __init__(self):
+        # formulas share subterms (e.g., cell variables and encoded expressions), simplify each of them once
+        self.memo = {}
+
+    def simplify(self, node):
+        key = id(node)
+        if key in self.memo:
+            return self.memo[key][1]
+        result = node.accept(self)
+        # keep a reference to the original node so that its id cannot be reused
+        self.memo[key] = (node, result)
+        return result
+
+    def visit_And(self, node):
+        conjunct = []
+        keys = set()
+        for x in self.flatten(node.conjunct, And, 'conjunct'):
+            if is_bool(x, True):
+                continue
+            if is_bool(x, False):
+                return Bool(False)
+            if is_numeral(x):
+                # mirrors the serializer, which treats integers inside conjunctions as truth values
+                if x.x == 0:
+                    return Bool(False)
+                continue
+            key = atom_key(x)
+            if key is not None:
+                if key in keys:
+                    continue
+                if negated_key(key) in keys:
+                    return Bool(False)
+                keys.add(key)
+            conjunct.append(x)
+
+        # absorption: a & (a | b) = a
+        conjunct = [
+            x for x in conjunct
+            if not (isinstance(x, Or) and any(atom_key(y) in keys for y in x.disjunct))
+        ]
+
+        if not conjunct:
+            return Bool(True)
+        if len(conjunct) == 1:
+            return conjunct[0]
+        return And(conjunct)
+
+    def visit_Or(self, node):
+        # an empty disjunction is serialized as true
+        if not node.disjunct:
+            return Bool(True)
+
+        disjunct = []
+        keys = set()
+        domain = {}
+        for x in self.flatten(node.disjunct, Or, 'disjunct'):
+            if is_bool(x, False):
+                continue
+            if is_bool(x, True):
+                return Bool(True)
+            key = atom_key(x)
+            if key is not None:
+                if key in keys:
+                    continue
+                if negated_key(key) in keys:
+                    return Bool(True)
+                keys.add(key)
+                if isinstance(x, Eq) and isinstance(x.a, Choice) and is_numeral(x.b):
+                    domain.setdefault(term_key(x.a), []).append(x)
+            disjunct.append(x)
+
+        # absorption: a | (a & b) = a
+        disjunct = [
+            x for x in disjunct
+            if not (isinstance(x, And) and any(atom_key(y) in keys for y in x.conjunct))
+        ]
+
+        # choice domain constraints, i.e., choice = 1 | choice = 0, become bounds on the choice variable
+        if len(disjunct) == 2 and len(domain) == 1:
+            bits = next(iter(domain.values()))
+            if len(bits) == 2 and sorted(x.b.x for x in bits) == [0, 1]:
+                choice = bits[0].a
+                return And([choice >= Int(0), choice <= Int(1)])
+
+        if not disjunct:
+            return Bool(False)
+        if len(disjunct) == 1:
+            return disjunct[0]
+        return Or(disjunct)
+
+    def visit_Not(self, node):
+        x = self.simplify(node.node)
+        if isinstance(x, Bool):
+            return Bool(not x.x)
+        if isinstance(x, Not):
+            return x.node
+        if isinstance(x, Neq):
+            return Eq(x.a, x.b)
+        return Not(x)
+
+    def visit_Xor(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if isinstance(a, Bool) and isinstance(b, Bool):
+            return Bool(bool(a.x) != bool(b.x))
+        return Xor(a, b)
+
+    def visit_Implies(self, node):
+        premise = self.simplify(node.premise)
+        if is_bool(premise, False):
+            return Bool(True)
+        conclusion = self.simplify(node.conclusion)
+        if is_bool(premise, True) or is_bool(conclusion, True):
+            return conclusion
+        if is_bool(conclusion, False):
+            return self.simplify(Not(premise))
+        return Implies(premise, conclusion)
+
+    def visit_If(self, node):
+        a = self.simplify(node.a)
+        if isinstance(a, Bool):
+            return self.simplify(node.b if a.x else node.c)
+        b = self.simplify(node.b)
+        c = self.simplify(node.c)
+        if b is c or (is_numeral(b) and is_numeral(c) and b.x == c.x):
+            return b
+        if is_bool(b, True) and is_bool(c, False):
+            return a
+        if is_bool(b, False) and is_bool(c, True):
+            return self.simplify(Not(a))
+        return If(a, b, c)
+
+    def visit_Eq(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if is_numeral(a) and is_numeral(b):
+            return Bool(a.x == b.x)
+        if isinstance(a, Bool) and isinstance(b, Bool):
+            return Bool(bool(a.x) == bool(b.x))
+        if isinstance(a, Bool):
+            a, b = b, a
+        if isinstance(b, Bool):
+            return a if b.x else self.simplify(Not(a))
+        if is_numeral(a):
+            a, b = b, a
+        # ITE(c, 1, 0) = 1 is c itself
+        if is_numeral(b) and isinstance(a, If) and is_numeral(a.b) and is_numeral(a.c) and a.b.x != a.c.x:
+            if b.x == a.b.x:
+                return a.a
+            if b.x == a.c.x:
+                return self.simplify(Not(a.a))
+            return Bool(False)
+        if a is b:
+            return Bool(True)
+        return Eq(a, b)
+
+    def visit_Neq(self, node):
+        eq = self.visit_Eq(node)
+        if isinstance(eq, Eq):
+            return Neq(eq.a, eq.b)
+        return self.simplify(Not(eq))
+
+    def visit_Gt(self, node):
+        return self.compare(node, lambda x, y: x > y)
+
+    def visit_Gte(self, node):
+        return self.compare(node, lambda x, y: x >= y)
+
+    def visit_Lt(self, node):
+        return self.compare(node, lambda x, y: x < y)
+
+    def visit_Lte(self, node):
+        return self.compare(node, lambda x, y: x <= y)
+
+    def visit_Plus(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if is_numeral(a) and is_numeral(b):
+            return Int(a.x + b.x)
+        if is_numeral(a) and a.x == 0:
+            return b
+        if is_numeral(b) and b.x == 0:
+            return a
+        return Plus(a, b)
+
+    def visit_Minus(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if is_numeral(a) and is_numeral(b):
+            return Int(a.x - b.x)
+        if is_numeral(b) and b.x == 0:
+            return a
+        return Minus(a, b)
+
+    def visit_Mul(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if is_numeral(a) and is_numeral(b):
+            return Int(a.x * b.x)
+        if is_numeral(a) and a.x == 1:
+            return b
+        if is_numeral(b) and b.x == 1:
+            return a
+        return Mul(a, b)
+
+    def visit_Div(self, node):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        # integer division only agrees with SMT-LIB div for positive divisors
+        if is_numeral(a) and is_numeral(b) and b.x > 0:
+            return Int(a.x // b.x)
+        if is_numeral(b) and b.x == 1:
+            return a
+        return Div(a, b)
+
+    def visit_Neg(self, node):
+        x = self.simplify(node.x)
+        if is_numeral(x):
+            return Int(-x.x)
+        if isinstance(x, Neg):
+            return x.x
+        return Neg(x)
+
+    def visit(self, node):
+        # variables and constants
+        return node
+
+    def compare(self, node, op):
+        a = self.simplify(node.a)
+        b = self.simplify(node.b)
+        if is_numeral(a) and is_numeral(b):
+            return Bool(op(a.x, b.x))
+        return node.__class__(a, b)
+
+    def flatten(self, args, cls, attr):
+        for x in args:
+            x = self.simplify(x)
+            if isinstance(x, cls):
+                yield from getattr(x, attr)
+            else:
+                yield x
+
+
+def simplify(formula: SMTNode) -> SMTNode:
+    return Simplifier().simplify(formula)
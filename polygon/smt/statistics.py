@@ -0,0 +1,53 @@
+from polygon.smt.ast import *
+from polygon.smt.theory import UNINTERPRETED_FUNCTIONS, children
+
+# Boolean and one-hot choices are counted as choices
+COUNTED_FUNCTIONS = {
+    'cell': 'cell',
+    'null': 'null',
+    'deleted': 'deleted',
+    'choice': 'choice',
+    'bchoice': 'choice',
+    'onehot': 'choice',
+}
+FIELDS = ['nodes', 'depth', 'cell', 'null', 'choice', 'deleted', 'nonlinear', 'bytes']
+
+
+def formula_statistics(formula: SMTNode, formula_smt_lib: str, fragment) -> dict:
+    """
+    Size of a rewritten formula: distinct nodes, depth, applications of cell, null, choice and deleted, non-linear
+    terms (from its TheoryInspector fragment) and SMT-LIB bytes. Shared subterms are counted once.
+    """
+    stats = dict.fromkeys(FIELDS, 0)
+    stats['nonlinear'] = len(fragment.nonlinear)
+    stats['bytes'] = len(str(formula_smt_lib))
+
+    depths = {}
+    stack = [(formula, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in depths:
+            continue
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children(node) if id(child) not in depths)
+            continue
+
+        depths[id(node)] = 1 + max((depths[id(child)] for child in children(node)), default=0)
+        stats['nodes'] += 1
+        function = UNINTERPRETED_FUNCTIONS.get(node.__class__)
+        if function in COUNTED_FUNCTIONS:
+            stats[COUNTED_FUNCTIONS[function]] += 1
+
+    stats['depth'] = depths[id(formula)]
+    return stats
+
+
+def total(statistics) -> dict:
+    statistics = list(statistics)
+    stats = dict.fromkeys(FIELDS, 0)
+    for s in statistics:
+        for field in FIELDS:
+            stats[field] = max(stats[field], s[field]) if field == 'depth' else stats[field] + s[field]
+    stats['formulas'] = len(statistics)
+    return stats
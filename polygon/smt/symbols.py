@@ -0,0 +1,59 @@
+FUNCTION_SORTS = {
+    'cell': 'Int',
+    'null': 'Bool',
+    'grouping': 'Bool',
+    'deleted': 'Bool',
+    'choice': 'Int',
+    'bchoice': 'Bool',
+    'onehot': 'Bool',
+    'size': 'Int',
+    'belongstogroup': 'Bool',
+}
+
+FUNCTION_PREFIXES = {
+    'cell': 'c',
+    'null': 'n',
+    'grouping': 'g',
+    'deleted': 'd',
+    'choice': 'ch',
+    'bchoice': 'bc',
+    'onehot': 'oh',
+    'size': 's',
+    'belongstogroup': 'b',
+}
+
+
+class SymbolTable:
+    """Names ground applications of the state functions as individual constants, e.g., (cell 3 1 2) as c_3_1_2."""
+
+    def __init__(self):
+        self.symbols = {}
+        self.declarations = []
+
+    def name(self, function: str, args) -> str:
+        # negative table ids are used by intermediate group tables
+        args = '_'.join([f'm{-arg}' if arg < 0 else str(arg) for arg in args])
+        return f'{FUNCTION_PREFIXES[function]}_{args}'
+
+    def constant(self, function: str, args) -> str:
+        name = self.name(function, args)
+        if name not in self.symbols:
+            sort = FUNCTION_SORTS[function]
+            self.symbols[name] = (function, tuple(args), sort)
+            self.declarations.append(f'(declare-const {name} {sort})')
+        return name
+
+    def lookup(self, name: str):
+        return self.symbols[name]
+
+    def sort(self, name: str) -> str:
+        return self.symbols[name][2]
+
+    def has_sort(self, sort: str) -> bool:
+        return any(symbol[2] == sort for symbol in self.symbols.values())
+
+    def __contains__(self, name):
+        return name in self.symbols
+
+    def dump(self) -> str:
+        return '\n'.join(self.declarations)
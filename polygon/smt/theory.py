@@ -0,0 +1,90 @@
+from polygon.smt.ast import *
+
+
+UNINTERPRETED_FUNCTIONS = {
+    SMTCell: 'cell',
+    SMTNull: 'null',
+    SMTGrouping: 'grouping',
+    Deleted: 'deleted',
+    SMTBelongsToGroup: 'belongstogroup',
+    SMTSize: 'size',
+    Choice: 'choice',
+    BoolChoice: 'bchoice',
+    OneHotChoice: 'onehot',
+}
+
+
+def is_integer_constant(node):
+    return isinstance(node, Int) and isinstance(node.x, int)
+
+
+def children(node):
+    match node:
+        case And():
+            return node.conjunct
+        case Or():
+            return node.disjunct
+        case Not():
+            return [node.node]
+        case Implies():
+            return [node.premise, node.conclusion]
+        case If():
+            return [node.a, node.b, node.c]
+        case Neg():
+            return [node.x]
+        case PbNode():
+            return node.args
+        case CompNode() | Xor() | Plus() | Minus() | Mul() | Div():
+            return [node.a, node.b]
+    return []
+
+
+class TheoryInspector:
+    """Collects the fragment a formula lives in, i.e., functions used, arithmetic and non-linear terms."""
+
+    def __init__(self):
+        self.functions = set()
+        self.arithmetic = False
+        self.nonlinear = []
+        self.pseudo_boolean = False
+
+    def inspect(self, formula: SMTNode):
+        visited = set()
+        stack = [formula]
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+
+            if node.__class__ in UNINTERPRETED_FUNCTIONS:
+                self.functions.add(UNINTERPRETED_FUNCTIONS[node.__class__])
+                # all functions are applied to integer arguments
+                self.arithmetic = True
+            match node:
+                case Var():
+                    self.arithmetic = self.arithmetic or node.sort == 'Int'
+                case Int():
+                    self.arithmetic = True
+                    if not isinstance(node.x, int):
+                        # non-integer literals are only accepted by the non-linear logics
+                        self.nonlinear.append(node)
+                case Mul():
+                    if not (is_integer_constant(node.a) or is_integer_constant(node.b)):
+                        self.nonlinear.append(node)
+                case Div():
+                    if not (is_integer_constant(node.b) and node.b.x != 0):
+                        self.nonlinear.append(node)
+                case PbNode():
+                    self.pseudo_boolean = True
+            stack.extend(children(node))
+        return self
+
+
+def select_theory(functions: bool, arithmetic: bool, nonlinear: bool, pseudo_boolean: bool = False) -> str:
+    # z3 only accepts pseudo-Boolean constraints without a logic restriction
+    if pseudo_boolean:
+        return 'ALL'
+    if not arithmetic:
+        return 'QF_UF'
+    return f"QF_{'UF' if functions else ''}{'NIA' if nonlinear else 'LIA'}"
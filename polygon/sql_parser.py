@@ -408,6 +408,9 @@ class SQLParser:
                         else:
                             # select target is an attribute
                             target_list.append(Attribute(attr['value'], alias=alias))
+                elif isinstance(attr.get('all_columns'), str):
+                    # t.* next to other targets
+                    target_list.append(Attribute(f"{attr['all_columns']}.*"))
                 else:
                     target_list.append(Attribute(attr))
     
@@ -0,0 +1,182 @@
+"""
+Goal: check that optional encodings do not change the verdicts of a few query pairs. Every pair is checked with
+the default Environment and again with a single option changed.
+"""
+
+import logging
+import tempfile
+from unittest import mock
+
+from polygon.checkpoint import Checkpoint
+from polygon.encoder_benchmark import encode_queries
+from polygon.environment import Environment
+from polygon.logger import logger
+from polygon.smt.ast import *
+
+
+schema = [
+    {
+        "TableName": "Employees",
+        "PKeys": [
+            {"Name": "emp_id", "Type": "int"}
+        ],
+        "FKeys": [
+            {"FName": "dept_id", "PTable": 1, "PName": "dept_id"}
+        ],
+        "Others": [
+            {"Name": "name", "Type": "varchar"},
+            {"Name": "age", "Type": "int"},
+            {"Name": "salary", "Type": "int"}
+        ]
+    },
+    {
+        "TableName": "Dept",
+        "PKeys": [
+            {"Name": "dept_id", "Type": "int"}
+        ],
+        "FKeys": [],
+        "Others": [
+            {"Name": "dname", "Type": "varchar"}
+        ]
+    }
+]
+
+pairs = [
+    ("SELECT emp_id FROM Employees WHERE age > 30",
+     "SELECT emp_id FROM Employees WHERE age >= 30"),
+    ("SELECT emp_id FROM Employees WHERE age > 30 AND salary > 5",
+     "SELECT emp_id FROM Employees WHERE salary > 5 AND age > 30"),
+    ("SELECT dept_id, COUNT(*) FROM Employees GROUP BY dept_id",
+     "SELECT dept_id, COUNT(emp_id) FROM Employees GROUP BY dept_id"),
+    ("SELECT DISTINCT age FROM Employees",
+     "SELECT age FROM Employees GROUP BY age"),
+    ("SELECT MAX(age) FROM Employees",
+     "SELECT MIN(age) FROM Employees"),
+    ("SELECT dept_id, MAX(salary), AVG(salary) FROM Employees GROUP BY dept_id",
+     "SELECT dept_id, MAX(salary), SUM(salary) / COUNT(salary) FROM Employees GROUP BY dept_id"),
+    ("SELECT emp_id FROM Employees WHERE name = 'a'",
+     "SELECT emp_id FROM Employees WHERE name = 'b'"),
+    ("SELECT emp_id FROM Employees UNION SELECT dept_id FROM Dept",
+     "SELECT emp_id FROM Employees UNION ALL SELECT dept_id FROM Dept"),
+    # age is a column of the CTE, the subquery is not correlated
+    ("WITH c AS (SELECT dept_id AS did, age FROM Employees) "
+     "SELECT e.emp_id FROM Employees e WHERE EXISTS (SELECT 1 FROM c WHERE c.did = age)",
+     "WITH c AS (SELECT dept_id AS did, age FROM Employees) "
+     "SELECT e.emp_id FROM Employees e WHERE e.age IN (SELECT c.did FROM c)"),
+    ("SELECT e.*, d.dname FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id",
+     "SELECT e.*, d.dname FROM Dept d JOIN Employees e ON e.dept_id = d.dept_id"),
+    ("SELECT e.*, d.dname FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id WHERE e.age > 30",
+     "SELECT e.*, d.dname FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id WHERE e.age >= 30"),
+    # joins on the key of Dept, referenced by Employees
+    ("SELECT e.name, d.dname FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id",
+     "SELECT e.name, d.dname FROM Employees e LEFT JOIN Dept d ON e.dept_id = d.dept_id"),
+    ("SELECT e.emp_id FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id",
+     "SELECT emp_id FROM Employees WHERE dept_id IS NOT NULL"),
+    ("SELECT e.emp_id, d.dname FROM Employees e LEFT JOIN Dept d ON e.dept_id = d.dept_id WHERE d.dname = 'a'",
+     "SELECT e.emp_id, d.dname FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id WHERE d.dname = 'a'"),
+    # Dept is only looked up
+    ("SELECT emp_id FROM Employees WHERE dept_id IN (SELECT dept_id FROM Dept WHERE dname = 'a')",
+     "SELECT e.emp_id FROM Employees e JOIN Dept d ON e.dept_id = d.dept_id WHERE d.dname = 'a'"),
+    ("SELECT emp_id FROM Employees WHERE dept_id IN (SELECT dept_id FROM Dept WHERE dname = 'a')",
+     "SELECT emp_id FROM Employees WHERE dept_id IN (SELECT dept_id FROM Dept WHERE dname = 'b')"),
+]
+
+# correlated subqueries are only encoded once decorrelated
+correlated = [
+    ("SELECT e.emp_id FROM Employees e WHERE EXISTS (SELECT 1 FROM Dept d WHERE d.dept_id = e.dept_id)",
+     "SELECT e.emp_id FROM Employees e WHERE e.dept_id IS NOT NULL"),
+    ("WITH c AS (SELECT dept_id AS did FROM Dept) "
+     "SELECT e.emp_id FROM Employees e WHERE EXISTS (SELECT 1 FROM c WHERE c.did = e.dept_id)",
+     "SELECT e.emp_id FROM Employees e WHERE e.dept_id IS NOT NULL"),
+]
+
+# checks compare the queries as bags and leave ORDER BY out, see ordered_verdict()
+ordered_pairs = [
+    ("SELECT emp_id, age FROM Employees ORDER BY age LIMIT 1",
+     "SELECT emp_id, age FROM Employees ORDER BY emp_id LIMIT 1"),
+    ("SELECT emp_id, age FROM Employees ORDER BY age LIMIT 1",
+     "SELECT emp_id, age FROM Employees ORDER BY age ASC LIMIT 1"),
+]
+
+options = [
+    {'simplify': False},
+    {'theory': 'ALL'},
+    {'flat_constants': True},
+    {'choice_encoding': 'bool'},
+    {'bag_equality': 'shared'},
+    {'aggregate_encoding': 'tournament'},
+    {'fast_path': True},
+    {'lazy_encoding': False},
+    {'encoding_workers': 2},
+    {'decorrelate': False},
+    {'order_by_encoding': 'rank'},
+    {'key_joins': True},
+    {'bound_policy': 'usage'},
+    {'table_bounds': {'Dept': 1}},
+]
+
+
+def check(q1, q2, **kwargs):
+    # the fast path would answer some pairs without encoding them
+    env = Environment(schema, [], bound=2, time_budget=60, **{'fast_path': False, **kwargs})
+    eq, cex, checking_time, total_time, ret = env.check(q1, q2)
+    return eq, ret
+
+
+def verdict(q1, q2, **kwargs):
+    return check(q1, q2, **kwargs)[0]
+
+
+def ordered_verdict(q1, q2, **kwargs):
+    """
+    Encodes the pair with its ORDER BY clauses, all operators at once, and solves the precise encoding.
+    """
+    env = Environment(schema, [], bound=3, time_budget=60, **kwargs)
+    o1, o2 = encode_queries(env, [q1, q2])
+    env.formulas.append(Not(env.o1_eq_o2(o1, o2)), label='neq')
+    env.formulas.labels_considered = set(env.formulas.formulas)
+    prover = env.formulas.new_prover()
+    sat = prover.check(env.formulas.dump(), theory=env.formulas.theory)
+    prover.smt_process.terminate()
+    return not sat
+
+
+def resumed(q1, q2, **kwargs):
+    """
+    Checks the pair again from the checkpoint of its last iteration, which a finished check would remove.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        with mock.patch.object(Checkpoint, 'clear'):
+            check(q1, q2, checkpoint=directory, **kwargs)
+        return check(q1, q2, checkpoint=directory, **kwargs)
+
+
+def main():
+    logger.setLevel(logging.WARNING)
+
+    for q1, q2 in [*pairs, *correlated]:
+        expected = verdict(q1, q2)
+        assert expected is not None, (q1, q2)
+        for kwargs in options:
+            if kwargs == {'decorrelate': False} and (q1, q2) in correlated:
+                continue
+            eq = verdict(q1, q2, **kwargs)
+            print(f"{'EQ' if eq else 'NEQ'} {kwargs} {q1} | {q2}")
+            assert eq == expected, (kwargs, q1, q2)
+
+        for kwargs in [{}, {'bound_policy': 'usage'}]:
+            eq, ret = resumed(q1, q2, **kwargs)
+            print(f"{'EQ' if eq else 'NEQ'} resumed from {ret.get('resumed_from')} {kwargs} {q1} | {q2}")
+            assert eq == expected and ret.get('resumed_from') is not None, (kwargs, q1, q2)
+
+    for q1, q2 in ordered_pairs:
+        expected = ordered_verdict(q1, q2)
+        eq = ordered_verdict(q1, q2, order_by_encoding='rank')
+        print(f"{'EQ' if eq else 'NEQ'} {{'order_by_encoding': 'rank'}} {q1} | {q2}")
+        assert eq == expected, (q1, q2)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import functools
+import json
+import os
+import time
+
+
+class Span:
+    def __init__(self, tracer, name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.tracer.open(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.close(self)
+        return False
+
+
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Records nested, timed spans with attributes. A disabled tracer hands out a shared no-op span, so traced code
+    only pays for a method call. Spans recorded in a checking process are sent back with its results and merged.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        # open spans, innermost last
+        self.stack = []
+        self.next_span_id = 0
+
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def open(self, span: Span):
+        # ids stay unique across the processes a check forks
+        span.span_id = f'{os.getpid()}:{self.next_span_id}'
+        self.next_span_id += 1
+        span.parent_id = self.stack[-1].span_id if self.stack else None
+        self.stack.append(span)
+        span.start = time.perf_counter_ns()
+
+    def close(self, span: Span):
+        end = time.perf_counter_ns()
+        self.stack.pop()
+        self.spans.append({
+            'name': span.name,
+            'id': span.span_id,
+            'parent': span.parent_id,
+            'pid': os.getpid(),
+            # the monotonic clock is shared by the processes of a check
+            'start_us': span.start // 1000,
+            'duration_us': (end - span.start) // 1000,
+            'attributes': span.attributes,
+        })
+
+    def merge(self, spans: list):
+        self.spans.extend(spans)
+
+    def chrome_trace(self) -> dict:
+        return {'traceEvents': [
+            {
+                'name': span['name'],
+                'ph': 'X',
+                'ts': span['start_us'],
+                'dur': span['duration_us'],
+                'pid': span['pid'],
+                'tid': span['pid'],
+                'args': span['attributes'],
+            }
+            for span in self.spans
+        ]}
+
+    def export(self, path: str, format: str = 'jsonl'):
+        """
+        Writes the spans as JSON lines ('jsonl') or in the Chrome trace event format ('chrome').
+        """
+        with open(path, 'w') as f:
+            match format:
+                case 'jsonl':
+                    for span in sorted(self.spans, key=lambda span: span['start_us']):
+                        f.write(f'{json.dumps(span, default=str)}\n')
+                case 'chrome':
+                    json.dump(self.chrome_trace(), f, default=str)
+                case _:
+                    raise ValueError(f'Unknown trace format: {format}')
+
+
+def traced(name: str):
+    """
+    Records every call of a method of an object with a tracer as a span.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,205 @@
+import hashlib
+
+from polygon.ast.expressions.attribute import Attribute
+from polygon.ast.fingerprint import structure
+from polygon.ast.join import Join
+from polygon.ast.node import Node
+from polygon.ast.query import Query
+from polygon.ast.scan import Scan
+from polygon.ast.union import Union
+from polygon.visitors.decorrelator import attributes, is_star
+
+COMMUTATIVE = ['eq', 'neq', 'add', 'mul']
+FLIPPED = {'gt': 'lt', 'gte': 'lte'}
+
+
+def queries(node):
+    match node:
+        case Node():
+            if isinstance(node, Query):
+                yield node
+            for value in vars(node).values():
+                yield from queries(value)
+        case list() | tuple():
+            for value in node:
+                yield from queries(value)
+        case dict():
+            for value in node.values():
+                yield from queries(value)
+
+
+class Canonicalizer:
+    """
+    Canonical form of a query up to commuted AND/OR operands and comparisons, swapped inner join sides, renamed
+    table aliases and single-valued IN lists. Queries with the same canonical form are equivalent.
+    """
+
+    def __init__(self):
+        # alias -> canonical name, one scope per enclosing query
+        self.scopes = []
+        self.references = set()
+        self.star = False
+
+    def canonical(self, node):
+        # t.* may also be parsed into an attribute named {'all_columns': t}
+        self.references = {
+            attribute.name.lower().rpartition('.')[2]
+            for attribute in attributes(node) if isinstance(attribute.name, str)
+        }
+        # the order of the columns of * depends on the order of the joins
+        self.star = any(
+            not query.select_clause.target_list or any(is_star(target) for target in query.select_clause.target_list)
+            for query in queries(node)
+        )
+        return node.accept(self)
+
+    def hash(self, node) -> str:
+        return hashlib.sha1(repr(self.canonical(node)).encode()).hexdigest()
+
+    def visit_Query(self, node: Query):
+        cte = tuple((name.lower(), query.accept(self)) for name, query in (node.cte or {}).items())
+
+        self.scopes.append(self.names(node.from_clause))
+        from_clause = node.from_clause.accept(self)
+        where = self.expression(node.where_clause.predicate) if node.where_clause is not None else None
+        group_by = having = None
+        if node.group_by_clause is not None:
+            group_by = tuple(sorted({repr(self.expression(e)): self.expression(e)
+                                     for e in node.group_by_clause.expressions}.values(), key=repr))
+            having = self.expression(node.group_by_clause.having)
+        select = tuple(self.target(target) for target in node.select_clause.target_list)
+        order_by = None
+        if node.order_by_clause is not None:
+            order_by = (
+                tuple(self.expression(e) for e in node.order_by_clause.expressions),
+                tuple(node.order_by_clause.sort_orders),
+                node.order_by_clause.limit,
+            )
+        self.scopes.pop()
+
+        return 'query', cte, from_clause, where, group_by, having, select, node.select_clause.distinct, order_by
+
+    def visit_Union(self, node: Union):
+        queries = sorted((query.accept(self) for query in node.queries), key=repr)
+        return 'union', node.allow_duplicates, tuple(queries)
+
+    def visit_Scan(self, node: Scan):
+        return 'scan', node.table.lower(), self.scopes[-1][(node.alias or node.table).lower()]
+
+    def visit_Join(self, node: Join):
+        left, right = node.left.accept(self), node.right.accept(self)
+        condition = self.expression(node.condition)
+        using = node.using.value.lower() if node.using is not None else None
+        match node.join_type:
+            case 'join' | 'inner join' | 'cross join':
+                join_type = 'inner'
+                if not self.star:
+                    left, right = sorted([left, right], key=repr)
+            case 'left join' | 'left outer join':
+                join_type = 'left'
+            case 'right join' | 'right outer join':
+                join_type = 'right'
+                if not self.star:
+                    join_type, left, right = 'left', right, left
+            case _:
+                join_type = node.join_type
+        return 'join', join_type, left, right, condition, using
+
+    def visit_Attribute(self, node: Attribute):
+        name = node.name if isinstance(node.name, str) else f"{node.name['all_columns']}.*"
+        qualifier, _, column = name.lower().rpartition('.')
+        for scope in reversed(self.scopes):
+            if qualifier in scope:
+                return 'attribute', scope[qualifier], column
+        return 'attribute', qualifier, column
+
+    def visit_Literal(self, node):
+        return 'literal', type(node.value).__name__, repr(node.value)
+
+    def visit_CaseWhen(self, node):
+        cases = tuple((self.expression(condition), self.expression(result)) for condition, result in node.cases)
+        return 'case', cases, self.expression(node.default)
+
+    def visit_Expression(self, node):
+        operator = node.operator
+        args = [self.expression(arg) for arg in node.args]
+
+        if operator in ['and', 'or']:
+            operands = {}
+            for arg in args:
+                # (a AND b) AND c
+                nested = arg[2] if isinstance(arg, tuple) and arg[:2] == ('expression', operator) else [arg]
+                for operand in nested:
+                    operands[repr(operand)] = operand
+            if len(operands) == 1:
+                return next(iter(operands.values()))
+            args = sorted(operands.values(), key=repr)
+        elif operator in COMMUTATIVE:
+            args = sorted(args, key=repr)
+        elif operator in FLIPPED:
+            operator, args = FLIPPED[operator], args[::-1]
+        elif operator in ['in', 'nin'] and isinstance(node.args[1], list):
+            values = {repr(value): value for value in args[1]}
+            if len(values) == 1:
+                operator = 'eq' if operator == 'in' else 'neq'
+                args = sorted([args[0], *values.values()], key=repr)
+            else:
+                args = [args[0], tuple(sorted(values.values(), key=repr))]
+
+        return 'expression', operator, tuple(args), self.expression(node.agg_filter)
+
+    def visit(self, node):
+        return structure(node)
+
+    def expression(self, node):
+        match node:
+            case None | bool():
+                return node
+            case list() | tuple():
+                return tuple(self.expression(x) for x in node)
+        return node.accept(self)
+
+    def target(self, node):
+        # output names only matter where the queries refer to them
+        alias = getattr(node, 'alias', None)
+        if alias is not None and alias.lower() not in self.references:
+            alias = None
+        return self.expression(node), alias.lower() if alias is not None else None
+
+    def names(self, node) -> dict:
+        items = []
+
+        def collect(item):
+            match item:
+                case Join():
+                    collect(item.left)
+                    collect(item.right)
+                case Scan():
+                    items.append(((item.alias or item.table).lower(), item.table.lower()))
+                case Query() | Union() if item.alias is not None:
+                    items.append((item.alias.lower(), None))
+
+        collect(node)
+        depth = len(self.scopes)
+        tables = [table for _, table in items]
+        names = {}
+        for idx, (alias, table) in enumerate(items):
+            if table is None:
+                names[alias] = f'#{idx}@{depth}'
+            elif tables.count(table) == 1:
+                names[alias] = f'{table}@{depth}'
+            else:
+                names[alias] = f'{table}#{idx}@{depth}'
+        return names
+
+    def arity(self, node):
+        """
+        Number of output columns, or None if it cannot be told from the query.
+        """
+        if isinstance(node, Union):
+            return self.arity(node.queries[0])
+        # SELECT * and SELECT t.* alone are parsed into an empty target list
+        if not isinstance(node, Query) or not node.select_clause.target_list \
+                or any(is_star(target) for target in node.select_clause.target_list):
+            return None
+        return len(node.select_clause.target_list)
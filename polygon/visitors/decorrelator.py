@@ -0,0 +1,326 @@
+import copy
+
+from polygon.ast.expressions.attribute import Attribute
+from polygon.ast.expressions.case_when import CaseWhen
+from polygon.ast.expressions.expression import Expression
+from polygon.ast.expressions.literal import Literal
+from polygon.ast.filter import Filter
+from polygon.ast.group_by import GroupBy
+from polygon.ast.join import Join
+from polygon.ast.node import Node
+from polygon.ast.project import Project
+from polygon.ast.query import Query
+from polygon.ast.scan import Scan
+from polygon.ast.union import Union
+from polygon.formulas.cardinality import conjuncts
+
+AGGREGATES = ['max', 'min', 'sum', 'avg', 'count']
+
+
+def conjunction(predicates):
+    if not predicates:
+        return None
+    if len(predicates) == 1:
+        return predicates[0]
+    return Expression(operator='and', args=predicates)
+
+
+def attributes(node):
+    match node:
+        case Attribute():
+            yield node
+        case Node():
+            for value in vars(node).values():
+                yield from attributes(value)
+        case list() | tuple():
+            for value in node:
+                yield from attributes(value)
+        case dict():
+            for value in node.values():
+                yield from attributes(value)
+
+
+def subqueries(node):
+    match node:
+        case Query() | Union():
+            yield node
+        case Node():
+            for value in vars(node).values():
+                yield from subqueries(value)
+        case list() | tuple():
+            for value in node:
+                yield from subqueries(value)
+
+
+def has_aggregate(node):
+    match node:
+        case Query() | Union():
+            return False
+        case CaseWhen():
+            return has_aggregate([node.cases, node.default])
+        case Expression():
+            return node.operator in AGGREGATES or has_aggregate([node.args, node.agg_filter])
+        case list() | tuple():
+            return any(has_aggregate(x) for x in node)
+    return False
+
+
+def is_star(target):
+    # SELECT t.* next to other targets, SELECT * and SELECT t.* alone leave the target list empty
+    return isinstance(target, Attribute) and (not isinstance(target.name, str) or target.name.endswith('*'))
+
+
+def output_columns(node):
+    """
+    Returns the column names of a query, or None if they depend on the tables a star expands to.
+    """
+    if isinstance(node, Union):
+        return output_columns(node.queries[0])
+    targets = node.select_clause.target_list
+    if not targets or any(is_star(target) for target in targets):
+        return None
+    return {
+        (target.alias if target.alias is not None else str(target)).lower().rpartition('.')[2]
+        for target in targets
+    }
+
+
+class Decorrelator:
+    """
+    Rewrites subqueries correlated through equalities in their WHERE clause into uncorrelated subqueries, which
+    are encoded once instead of once per outer tuple:
+
+    - EXISTS and IN conjuncts of WHERE become IN over a subquery that also selects the correlated columns. Only
+      positive conjuncts are rewritten, where NULL and FALSE filter alike.
+    - scalar aggregates become a LEFT JOIN with the subquery grouped by the correlated columns.
+    """
+
+    def __init__(self, schema):
+        self.columns = {}
+        for table in schema:
+            columns = [*table['PKeys'], *table['Others']]
+            self.columns[table['TableName'].lower()] = {c['Name'].lower() for c in columns} | {
+                fk['FName'].lower() for fk in table['FKeys']
+            }
+        # scopes of the enclosing queries
+        self.scopes = []
+        # CTE name -> column names, of the enclosing queries
+        self.ctes = []
+        self.next_alias = 0
+
+    def visit_Query(self, node: Query):
+        # a CTE can refer to the CTEs before it
+        ctes = {}
+        self.ctes.append(ctes)
+        if node.cte:
+            for name, cte_query in node.cte.items():
+                self.derived(cte_query)
+                ctes[name.lower()] = output_columns(cte_query)
+        self.from_items(node.from_clause)
+
+        # subqueries of the subqueries first
+        scope = self.scope(node.from_clause)
+        self.scopes.append(scope)
+        for clause in [node.where_clause, node.group_by_clause, node.select_clause]:
+            for subquery in subqueries(clause):
+                subquery.accept(self)
+        self.scopes.pop()
+
+        outer = {}
+        for enclosing in [*self.scopes, scope]:
+            outer.update(enclosing)
+
+        if node.where_clause is not None:
+            predicate = conjunction([
+                self.semi_join(conjunct, outer) for conjunct in conjuncts(node.where_clause.predicate)
+            ])
+            node.where_clause.predicate = self.scalars(node, predicate, outer, scope)
+        if node.group_by_clause is None and not any(is_star(target) for target in node.select_clause.target_list):
+            node.select_clause.target_list = [
+                self.scalars(node, target, outer, scope) for target in node.select_clause.target_list
+            ]
+        self.ctes.pop()
+        return node
+
+    def visit_Union(self, node: Union):
+        for query in node.queries:
+            query.accept(self)
+        return node
+
+    def visit(self, node):
+        return node
+
+    def derived(self, node):
+        # derived tables and CTEs cannot refer to the enclosing queries
+        scopes = self.scopes
+        self.scopes = []
+        node.accept(self)
+        self.scopes = scopes
+
+    def from_items(self, node):
+        match node:
+            case Join():
+                self.from_items(node.left)
+                self.from_items(node.right)
+            case Query() | Union():
+                self.derived(node)
+
+    def table_columns(self, table: str):
+        # CTEs shadow the tables of the schema, unknown tables have unknown columns (None)
+        for ctes in reversed(self.ctes):
+            if table in ctes:
+                return ctes[table]
+        return self.columns.get(table)
+
+    def scope(self, node) -> dict:
+        # qualifier -> column names, or None if unknown
+        match node:
+            case Scan():
+                name = (node.alias if node.alias is not None else node.table).lower()
+                return {name: self.table_columns(node.table.lower())}
+            case Join():
+                return {**self.scope(node.left), **self.scope(node.right)}
+            case Query() | Union() if node.alias is not None:
+                return {node.alias.lower(): output_columns(node)}
+        return {}
+
+    @staticmethod
+    def resolves(attribute: Attribute, scope: dict):
+        if not isinstance(attribute.name, str):
+            # t.*
+            return attribute.name['all_columns'].lower() in scope
+        qualifier, _, column = attribute.name.lower().rpartition('.')
+        if qualifier:
+            return qualifier in scope
+        return any(columns is not None and column in columns for columns in scope.values())
+
+    def is_outer(self, attribute: Attribute, inner: dict, outer: dict):
+        return not self.resolves(attribute, inner) and self.resolves(attribute, outer)
+
+    def correlation(self, subquery, outer: dict):
+        """
+        Splits the WHERE clause of the subquery into (inner expression, outer attribute) equalities and the
+        uncorrelated rest. Returns None if the subquery refers to the enclosing queries in any other way.
+        """
+        if not isinstance(subquery, Query) or subquery.cte or subquery.group_by_clause is not None \
+                or subquery.order_by_clause is not None or subquery.where_clause is None:
+            return None
+
+        inner = self.scope(subquery.from_clause)
+        # an unqualified column could be of the inner tables whose columns are unknown
+        if any(columns is None for columns in inner.values()):
+            return None
+
+        def refers_outer(node):
+            return any(self.is_outer(attribute, inner, outer) for attribute in attributes(node))
+
+        pairs, rest = [], []
+        for conjunct in conjuncts(subquery.where_clause.predicate):
+            if isinstance(conjunct, Expression) and conjunct.operator == 'eq' and len(conjunct.args) == 2:
+                a, b = conjunct.args
+                for x, y in [(a, b), (b, a)]:
+                    if isinstance(y, Attribute) and self.is_outer(y, inner, outer) and not refers_outer(x):
+                        pairs.append((x, y))
+                        break
+                else:
+                    rest.append(conjunct)
+            else:
+                rest.append(conjunct)
+
+        if not pairs or refers_outer([rest, subquery.select_clause, subquery.from_clause]):
+            return None
+        return pairs, conjunction(rest)
+
+    def semi_join(self, conjunct, outer: dict):
+        if not isinstance(conjunct, Expression):
+            return conjunct
+
+        match conjunct.operator:
+            case 'is_not_null' if isinstance(conjunct.args[0], Query):
+                subquery, lhs = conjunct.args[0], []
+            case 'in' if isinstance(conjunct.args[1], Query):
+                subquery = conjunct.args[1]
+                lhs = conjunct.args[0] if isinstance(conjunct.args[0], list) else [conjunct.args[0]]
+            case _:
+                return conjunct
+
+        # without GROUP BY, a subquery with aggregates returns exactly one tuple
+        if has_aggregate(subquery.select_clause.target_list):
+            return conjunct
+        correlation = self.correlation(subquery, outer)
+        if correlation is None:
+            return conjunct
+        pairs, rest = correlation
+
+        targets = subquery.select_clause.target_list if lhs else []
+        rewritten = Query(
+            select_clause=Project([*targets, *[x for x, _ in pairs]], subquery.select_clause.distinct),
+            from_clause=subquery.from_clause,
+            where_clause=Filter(rest) if rest is not None else None,
+        )
+        lhs = [*lhs, *[y for _, y in pairs]]
+        return Expression(operator='in', args=[lhs if len(lhs) > 1 else lhs[0], rewritten])
+
+    def scalars(self, node: Query, expression, outer: dict, scope: dict):
+        match expression:
+            case Query():
+                return self.grouped_join(node, expression, outer, scope)
+            case CaseWhen():
+                expression.cases = [
+                    (self.scalars(node, condition, outer, scope), self.scalars(node, result, outer, scope))
+                    for condition, result in expression.cases
+                ]
+                expression.default = self.scalars(node, expression.default, outer, scope)
+            case Expression():
+                for idx, arg in enumerate(expression.args):
+                    # subqueries used as sets
+                    if expression.operator in ['in', 'nin'] and idx == 1 \
+                            or expression.operator in ['is_null', 'is_not_null'] and idx == 0:
+                        continue
+                    if isinstance(arg, list):
+                        expression.args[idx] = [self.scalars(node, x, outer, scope) for x in arg]
+                    else:
+                        expression.args[idx] = self.scalars(node, arg, outer, scope)
+        return expression
+
+    def grouped_join(self, node: Query, subquery: Query, outer: dict, scope: dict):
+        targets = subquery.select_clause.target_list
+        if len(targets) != 1 or not isinstance(targets[0], Expression) or targets[0].operator not in AGGREGATES \
+                or subquery.select_clause.distinct:
+            return subquery
+        correlation = self.correlation(subquery, outer)
+        if correlation is None:
+            return subquery
+        pairs, rest = correlation
+        # the join condition can only refer to this query
+        if not all(self.resolves(y, scope) for _, y in pairs):
+            return subquery
+
+        alias = f'decorrelated{self.next_alias}'
+        self.next_alias += 1
+
+        keys = []
+        for idx, (x, _) in enumerate(pairs):
+            key = copy.copy(x)
+            key.alias = f'{alias}_key{idx}'
+            keys.append(key)
+        aggregate = copy.copy(targets[0])
+        aggregate.alias = f'{alias}_value'
+
+        grouped = Query(
+            select_clause=Project([*keys, aggregate]),
+            from_clause=subquery.from_clause,
+            where_clause=Filter(rest) if rest is not None else None,
+            group_by_clause=GroupBy([x for x, _ in pairs]),
+            alias=alias,
+        )
+        node.from_clause = Join(node.from_clause, grouped, 'left join', condition=conjunction([
+            Expression(operator='eq', args=[Attribute(name=f'{alias}.{alias}_key{idx}'), y])
+            for idx, (_, y) in enumerate(pairs)
+        ]))
+
+        value = Attribute(name=f'{alias}.{alias}_value')
+        # outer tuples without a matching group see an empty subquery
+        if aggregate.operator == 'count':
+            return Expression(operator='coalesce', args=[value, Literal(value=0)])
+        return value
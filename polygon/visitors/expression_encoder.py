@@ -6,88 +6,92 @@ from polygon.ast.expressions.attribute import Attribute
 from polygon.ast.expressions.expression import Expression
 from polygon.ast.expressions.literal import Literal
 from polygon.ast.query import Query
+from polygon.formulas.aggregates import tournament
+from polygon.formulas.duplicates import distinct_values, symbol
 from polygon.smt.ast import *
 
 from polygon.ast.expressions.operator import Operator
 from polygon.variables import Variable
 
 
-def Max(args):
-    def Max2(x, y):
-        x_val, x_null, x_deleted = x
-        y_val, y_null, y_deleted = y
-
-        # val = If(
-        #     Or([
-        #         And([x_val <= y_val, Not(Or([x_null, y_null]))]),
-        #         And([x_null, Not(y_null)])
-        #     ]),
-        #     y_val,
-        #     x_val
-        # )
-        # null = And([x_null, y_null])
-        # return val, null
-
-        val = If(
-            And([Not(x_deleted), y_deleted]),
-            x_val,
+def Max2(x, y):
+    x_val, x_null, x_deleted = x
+    y_val, y_null, y_deleted = y
+
+    # val = If(
+    #     Or([
+    #         And([x_val <= y_val, Not(Or([x_null, y_null]))]),
+    #         And([x_null, Not(y_null)])
+    #     ]),
+    #     y_val,
+    #     x_val
+    # )
+    # null = And([x_null, y_null])
+    # return val, null
+
+    val = If(
+        And([Not(x_deleted), y_deleted]),
+        x_val,
+        If(
+            And([x_deleted, Not(y_deleted)]),
+            y_val,
             If(
-                And([x_deleted, Not(y_deleted)]),
-                y_val,
+                And([Not(x_deleted), Not(y_deleted)]),
                 If(
-                    And([Not(x_deleted), Not(y_deleted)]),
-                    If(
-                        Or([
-                            And([x_val <= y_val, Not(Or([x_null, y_null]))]),
-                            And([x_null, Not(y_null)]),
-                        ]),
-                        y_val,
-                        x_val
-                    ),
-                    Int(0)
-                )
+                    Or([
+                        And([x_val <= y_val, Not(Or([x_null, y_null]))]),
+                        And([x_null, Not(y_null)]),
+                    ]),
+                    y_val,
+                    x_val
+                ),
+                Int(0)
             )
         )
-        null = And([Implies(Not(x_deleted), x_null), Implies(Not(y_deleted), y_null)])
-        deleted = And([x_deleted, y_deleted])
+    )
+    null = And([Implies(Not(x_deleted), x_null), Implies(Not(y_deleted), y_null)])
+    deleted = And([x_deleted, y_deleted])
 
-        return val, null, deleted
+    return val, null, deleted
 
-    val, null, deleted = functools.reduce(Max2, args)
+
+def Max(args, reduce=functools.reduce):
+    val, null, deleted = reduce(Max2, args)
     return val, Or([null, deleted])
 
 
-def Min(args):
-    def Min2(x, y):
-        x_val, x_null, x_deleted = x
-        y_val, y_null, y_deleted = y
+def Min2(x, y):
+    x_val, x_null, x_deleted = x
+    y_val, y_null, y_deleted = y
 
-        val = If(
-            And([Not(x_deleted), y_deleted]),
-            x_val,
+    val = If(
+        And([Not(x_deleted), y_deleted]),
+        x_val,
+        If(
+            And([x_deleted, Not(y_deleted)]),
+            y_val,
             If(
-                And([x_deleted, Not(y_deleted)]),
-                y_val,
+                And([Not(x_deleted), Not(y_deleted)]),
                 If(
-                    And([Not(x_deleted), Not(y_deleted)]),
-                    If(
-                        Or([
-                            And([x_val >= y_val, Not(Or([x_null, y_null]))]),
-                            And([x_null, Not(y_null)]),
-                        ]),
-                        y_val,
-                        x_val
-                    ),
-                    Int(0)
-                )
+                    Or([
+                        And([x_val >= y_val, Not(Or([x_null, y_null]))]),
+                        And([x_null, Not(y_null)]),
+                    ]),
+                    y_val,
+                    x_val
+                ),
+                Int(0)
             )
         )
-        null = And([Implies(Not(x_deleted), x_null), Implies(Not(y_deleted), y_null)])
-        deleted = And([x_deleted, y_deleted])
+    )
+    null = And([Implies(Not(x_deleted), x_null), Implies(Not(y_deleted), y_null)])
+    deleted = And([x_deleted, y_deleted])
+
+    return val, null, deleted
 
-        return val, null, deleted
 
-    val, null, deleted = functools.reduce(Min2, args)
+def Min(args, reduce=functools.reduce):
+    val, null, deleted = reduce(Min2, args)
     return val, Or([null, deleted])
 
 
@@ -96,24 +100,8 @@ def Count(args):
     return val, Bool(False)
 
 
-def Count_Distinct(args):
-    val = Sum([
-        If(
-            And([
-                Not(deleted),
-                Not(null),
-                And([
-                    Implies(
-                        And([Not(prev_deleted), Not(prev_null)]),
-                        val != prev_val
-                    )
-                    for prev_val, prev_null, prev_deleted in args[:idx]
-                ])
-            ]),
-            Int(1),
-            Int(0))
-        for idx, (val, null, deleted) in enumerate(args)
-    ])
+def Count_Distinct(args, first):
+    val = Sum([If(is_first, Int(1), Int(0)) for is_first in first])
     return val, Bool(False)
 
 
@@ -122,24 +110,8 @@ def AggSum(args):
     return val, And([Or([null, deleted]) for _, null, deleted in args])
 
 
-def Sum_Distinct(args):
-    val = Sum([
-        If(
-            And([
-                Not(deleted),
-                Not(null),
-                And([
-                    Implies(
-                        And([Not(prev_deleted), Not(prev_null)]),
-                        val != prev_val
-                    )
-                    for prev_val, prev_null, prev_deleted in args[:idx]
-                ])
-            ]),
-            val,
-            Int(0))
-        for idx, (val, null, deleted) in enumerate(args)
-    ])
+def Sum_Distinct(args, first):
+    val = Sum([If(is_first, val, Int(0)) for is_first, (val, _, _) in zip(first, args)])
     return val, And([Or([null, deleted]) for _, null, deleted in args])
 
 
@@ -149,12 +121,18 @@ def Avg(args):
     return sum_val / count_val, And([Or([null, deleted]) for _, null, deleted in args])
 
 
-def Avg_Distinct(args):
-    sum_distinct_val, _ = Sum_Distinct(args)
-    count_distinct_val, _ = Count_Distinct(args)
+def Avg_Distinct(args, first):
+    sum_distinct_val, _ = Sum_Distinct(args, first)
+    count_distinct_val, _ = Count_Distinct(args, first)
     return sum_distinct_val / count_distinct_val, And([Or([null, deleted]) for _, null, deleted in args])
 
 
+def Coalesce2(x, y):
+    x_val, x_null = x
+    y_val, y_null = y
+    return If(Not(x_null), x_val, y_val), And([x_null, y_null])
+
+
 def Abs(x):
     return If(x >= Int(0), x, -x)
 
@@ -168,15 +146,77 @@ class ExpressionEncoder:
 
         if projected_list is not None:
             self.projected_list = projected_list
-        self.subquery_table_map = {}
 
     def expression_for_tuple(self, exp, idx: int):
         self.tuple_idx = idx
 
+        key = (id(exp), self.table.table_id, idx, self.outer_tuple_id, id(getattr(self, 'projected_list', None)))
+        self.env.metrics.lookup('expression', key in self.env.formulas.expression_cache)
+        if key in self.env.formulas.expression_cache:
+            return self.env.formulas.expression_cache[key][1]
+
         val, null = exp.accept(self)
         val = EnsureInt(val)
+        # the node is kept so that its id is not reused
+        self.env.formulas.expression_cache[key] = (exp, (val, null))
         return val, null
 
+    def distinct_values(self, args):
+        prefix = self.env.formulas.next_definition_name(f'aggdistinct_{symbol(self.table.table_id)}_')
+        return distinct_values(self.env, prefix, args)
+
+    def reduce(self, prefix):
+        if self.env.aggregate_encoding == 'tournament':
+            prefix = self.env.formulas.next_definition_name(f'{prefix}_{symbol(self.table.table_id)}_')
+            return functools.partial(tournament, self.env, prefix)
+        return functools.reduce
+
+    def aggregate(self, node):
+        if node.operator == 'count' and not node.args[0] and isinstance(node.args[1], Attribute) and node.args[1].name == '*':
+            return Sum([Not(Deleted(self.table.table_id, tuple_id)) for tuple_id in range(self.table.bound)]), Bool(False)
+
+        if node.operator == 'avg' and not node.args[0]:
+            # shares the terms of SUM and COUNT over the same argument
+            sum_val, sum_null = self.visit_Expression(Expression(operator='sum', args=node.args, agg_filter=node.agg_filter))
+            count_val, _ = self.visit_Expression(Expression(operator='count', args=node.args, agg_filter=node.agg_filter))
+            return sum_val / count_val, sum_null
+
+        agg_exp_encoder = ExpressionEncoder(self.table, self.env)
+        to_be_aggregated = []
+
+        filter_node = node.agg_filter
+
+        for tuple_id in range(self.table.bound):
+            # ret is a (val, null, deleted) pair
+            val, null = agg_exp_encoder.expression_for_tuple(node.args[1], tuple_id)
+            row_deleted = Deleted(self.table.table_id, tuple_id)
+
+            if filter_node:
+                f_val, f_null = agg_exp_encoder.expression_for_tuple(filter_node, tuple_id)
+                f_val = EnsureBool(f_val)
+                row_deleted = Or([row_deleted, f_null, Not(f_val)])
+
+            ret = (val, null, row_deleted)
+            to_be_aggregated.append(ret)
+
+        match node.operator:
+            case 'max':
+                return Max(to_be_aggregated, self.reduce('aggmax'))
+            case 'min':
+                return Min(to_be_aggregated, self.reduce('aggmin'))
+            case 'count':
+                if node.args[0]:
+                    return Count_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+                return Count(to_be_aggregated)
+            case 'sum':
+                if node.args[0]:
+                    return Sum_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+                return AggSum(to_be_aggregated)
+            case 'avg':
+                return Avg_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+            case _:
+                raise NotImplementedError
+
     def visit_Variable(self, var):
         return var.VAL, var.NULL
 
@@ -239,28 +279,14 @@ class ExpressionEncoder:
                 raise NotImplementedError
         elif node.operator == 'is_null' or node.operator == 'isnull':
             if isinstance(node.args[0], Query):
-                from polygon.visitors.query_encoder import QueryEncoder
-
-                if str(node.args[0]) in self.subquery_table_map:
-                    in_table = self.subquery_table_map[str(node.args[0])]
-                else:
-                    visitor = QueryEncoder(self.env)
-                    in_table = node.args[0].accept(visitor)
-                    self.subquery_table_map[str(node.args[0])] = in_table
+                in_table = self.env.subquery_table(node.args[0])
                 return And([Deleted(in_table.table_id, tuple_id) for tuple_id in range(in_table.bound)]), Bool(False)
             else:
                 _, null = node.args[0].accept(self)
                 return null, Bool(False)
         elif node.operator == 'is_not_null':
             if isinstance(node.args[0], Query):
-                from polygon.visitors.query_encoder import QueryEncoder
-
-                if str(node.args[0]) in self.subquery_table_map:
-                    in_table = self.subquery_table_map[str(node.args[0])]
-                else:
-                    visitor = QueryEncoder(self.env)
-                    in_table = node.args[0].accept(visitor)
-                    self.subquery_table_map[str(node.args[0])] = in_table
+                in_table = self.env.subquery_table(node.args[0])
                 return Or([Not(Deleted(in_table.table_id, tuple_id)) for tuple_id in range(in_table.bound)]), Bool(False)
             else:
                 _, null = node.args[0].accept(self)
@@ -292,14 +318,7 @@ class ExpressionEncoder:
                 return val, null
 
             # rhs is a subquery
-            from polygon.visitors.query_encoder import QueryEncoder
-
-            if str(node.args[1]) in self.subquery_table_map:
-                in_table = self.subquery_table_map[str(node.args[1])]
-            else:
-                visitor = QueryEncoder(self.env)
-                in_table = node.args[1].accept(visitor)
-                self.subquery_table_map[str(node.args[1])] = in_table
+            in_table = self.env.subquery_table(node.args[1])
 
             # lhs is a list of [(exp1_val, exp1_null), (exp2_val, exp2_null), ...]
             lhs = []
@@ -359,14 +378,7 @@ class ExpressionEncoder:
                 return val, null
 
             # rhs is a subquery
-            from polygon.visitors.query_encoder import QueryEncoder
-
-            if str(node.args[1]) in self.subquery_table_map:
-                in_table = self.subquery_table_map[str(node.args[1])]
-            else:
-                visitor = QueryEncoder(self.env)
-                in_table = node.args[1].accept(visitor)
-                self.subquery_table_map[str(node.args[1])] = in_table
+            in_table = self.env.subquery_table(node.args[1])
 
             lhs = []
             if isinstance(node.args[0], Attribute | Expression):
@@ -479,54 +491,16 @@ class ExpressionEncoder:
 
             # aggregate functions
             if node.operator in ['min', 'max', 'count', 'sum', 'avg']:
-                if node.operator == 'count' and not node.args[0] and isinstance(node.args[1], Attribute) and node.args[1].name == '*':
-                    return Sum([Not(Deleted(self.table.table_id, tuple_id)) for tuple_id in range(self.table.bound)]), Bool(False)
-
-                agg_exp_encoder = ExpressionEncoder(self.table, self.env)
-                to_be_aggregated = []
-
-                filter_node = node.agg_filter
-
-                for tuple_id in range(self.table.bound):
-                    # ret is a (val, null, deleted) pair
-                    # ret = (
-                    #     *agg_exp_encoder.expression_for_tuple(node.args[1], tuple_id),
-                    #     Deleted(self.table.table_id, tuple_id)
-                    # )
-                    # to_be_aggregated.append(ret)
-                    val, null = agg_exp_encoder.expression_for_tuple(node.args[1], tuple_id)
-                    row_deleted = Deleted(self.table.table_id, tuple_id)
-
-                    if filter_node:
-                        f_val, f_null = agg_exp_encoder.expression_for_tuple(filter_node, tuple_id)
-                        f_val = EnsureBool(f_val)
-                        row_deleted = Or([row_deleted, f_null, Not(f_val)])
-                    
-                    ret = (val, null, row_deleted)
-                    to_be_aggregated.append(ret)
-
-
-                match node.operator:
-                    case 'max':
-                        return Max(to_be_aggregated)
-                    case 'min':
-                        return Min(to_be_aggregated)
-                    case 'count':
-                        if node.args[0]:
-                            return Count_Distinct(to_be_aggregated)
-                        return Count(to_be_aggregated)
-                    case 'sum':
-                        if node.args[0]:
-                            return Sum_Distinct(to_be_aggregated)
-                        return AggSum(to_be_aggregated)
-                    case 'avg':
-                        if node.args[0]:
-                            return Avg_Distinct(to_be_aggregated)
-                        return Avg(to_be_aggregated)
-                    case _:
-                        raise NotImplementedError
+                key = (node.operator, repr(node.args[0]), repr(node.args[1]), repr(node.agg_filter), self.table.table_id)
+                self.env.metrics.lookup('aggregate', key in self.env.formulas.aggregate_cache)
+                if key not in self.env.formulas.aggregate_cache:
+                    self.env.formulas.aggregate_cache[key] = self.aggregate(node)
+                return self.env.formulas.aggregate_cache[key]
 
             if node.operator == 'coalesce':
+                if self.env.aggregate_encoding == 'tournament' and len(node.args) > 2:
+                    return self.reduce('coalesce')(Coalesce2, [arg.accept(self) for arg in node.args])
+
                 def Next(idx):
                     val, null = node.args[idx].accept(self)
                     if idx >= len(node.args) - 1:
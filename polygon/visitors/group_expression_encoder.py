@@ -2,90 +2,95 @@ import datetime
 import functools
 
 from polygon.ast.expressions.attribute import Attribute
+from polygon.ast.expressions.expression import Expression
 from polygon.ast.expressions.literal import Literal
+from polygon.formulas.aggregates import tournament
+from polygon.formulas.duplicates import distinct_values, symbol
 from polygon.smt.ast import *
 
 from polygon.ast.expressions.operator import Operator
 from polygon.variables import Variable
-from polygon.visitors.expression_encoder import ExpressionEncoder
-
-
-def GroupMax(args):
-    def Max2(x, y):
-        x_val, x_null, x_in_group = x
-        y_val, y_null, y_in_group = y
-
-        # val = If(
-        #     Or([
-        #         And([x_val <= y_val, Not(Or([x_null, y_null]))]),
-        #         And([x_null, Not(y_null)]),
-        #         And([Not(x_in_group), y_in_group]),
-        #     ]),
-        #     y_val,
-        #     x_val
-        # )
-        val = If(
-            And([x_in_group, Not(y_in_group)]),
-            x_val,
+from polygon.visitors.expression_encoder import Coalesce2, ExpressionEncoder
+
+
+def GroupMax2(x, y):
+    x_val, x_null, x_in_group = x
+    y_val, y_null, y_in_group = y
+
+    # val = If(
+    #     Or([
+    #         And([x_val <= y_val, Not(Or([x_null, y_null]))]),
+    #         And([x_null, Not(y_null)]),
+    #         And([Not(x_in_group), y_in_group]),
+    #     ]),
+    #     y_val,
+    #     x_val
+    # )
+    val = If(
+        And([x_in_group, Not(y_in_group)]),
+        x_val,
+        If(
+            And([y_in_group, Not(x_in_group)]),
+            y_val,
             If(
-                And([y_in_group, Not(x_in_group)]),
-                y_val,
+                And([x_in_group, y_in_group]),
                 If(
-                    And([x_in_group, y_in_group]),
-                    If(
-                        Or([
-                            And([x_val <= y_val, Not(Or([x_null, y_null]))]),
-                            And([x_null, Not(y_null)]),
-                        ]),
-                        y_val,
-                        x_val
-                    ),
-                    Int(0)
-                )
+                    Or([
+                        And([x_val <= y_val, Not(Or([x_null, y_null]))]),
+                        And([x_null, Not(y_null)]),
+                    ]),
+                    y_val,
+                    x_val
+                ),
+                Int(0)
             )
         )
-        null = And([Implies(x_in_group, x_null), Implies(y_in_group, y_null)])
-        # null = And([x_null, y_null])
-        in_group = Or([x_in_group, y_in_group])
+    )
+    null = And([Implies(x_in_group, x_null), Implies(y_in_group, y_null)])
+    # null = And([x_null, y_null])
+    in_group = Or([x_in_group, y_in_group])
 
-        return val, null, in_group
+    return val, null, in_group
 
-    val, null, in_group = functools.reduce(Max2, args)
+
+def GroupMax(args, reduce=functools.reduce):
+    val, null, _ = reduce(GroupMax2, args)
     return val, null
 
 
-def GroupMin(args):
-    def Min2(x, y):
-        x_val, x_null, x_in_group = x
-        y_val, y_null, y_in_group = y
+def GroupMin2(x, y):
+    x_val, x_null, x_in_group = x
+    y_val, y_null, y_in_group = y
 
-        val = If(
-            And([x_in_group, Not(y_in_group)]),
-            x_val,
+    val = If(
+        And([x_in_group, Not(y_in_group)]),
+        x_val,
+        If(
+            And([y_in_group, Not(x_in_group)]),
+            y_val,
             If(
-                And([y_in_group, Not(x_in_group)]),
-                y_val,
+                And([x_in_group, y_in_group]),
                 If(
-                    And([x_in_group, y_in_group]),
-                    If(
-                        Or([
-                            And([x_val >= y_val, Not(Or([x_null, y_null]))]),
-                            And([x_null, Not(y_null)]),
-                        ]),
-                        y_val,
-                        x_val
-                    ),
-                    Int(0)
-                )
+                    Or([
+                        And([x_val >= y_val, Not(Or([x_null, y_null]))]),
+                        And([x_null, Not(y_null)]),
+                    ]),
+                    y_val,
+                    x_val
+                ),
+                Int(0)
             )
         )
-        null = And([Implies(x_in_group, x_null), Implies(y_in_group, y_null)])
-        # null = And([x_null, y_null])
-        in_group = Or([x_in_group, y_in_group])
+    )
+    null = And([Implies(x_in_group, x_null), Implies(y_in_group, y_null)])
+    # null = And([x_null, y_null])
+    in_group = Or([x_in_group, y_in_group])
 
-        return val, null, in_group
+    return val, null, in_group
 
-    val, null, _ = functools.reduce(Min2, args)
+
+def GroupMin(args, reduce=functools.reduce):
+    val, null, _ = reduce(GroupMin2, args)
     return val, null
 
 
@@ -94,25 +99,8 @@ def GroupCount(args):
     return val, Bool(False)
 
 
-def GroupCount_Distinct(args):
-    val = Sum([
-        If(
-            And([
-                Not(null),
-                in_group,
-                And([
-                    Implies(
-                        And([prev_in_group, Not(prev_null)]),
-                        val != prev_val
-                    )
-                    for prev_val, prev_null, prev_in_group in args[:idx]
-                ])
-            ]),
-            Int(1),
-            Int(0)
-        )
-        for idx, (val, null, in_group) in enumerate(args)
-    ])
+def GroupCount_Distinct(args, first):
+    val = Sum([If(is_first, Int(1), Int(0)) for is_first in first])
     return val, Bool(False)
 
 
@@ -121,25 +109,8 @@ def GroupSum(args):
     return val, And([Implies(in_group, null) for _, null, in_group in args])
 
 
-def GroupSum_Distinct(args):
-    val = Sum([
-        If(
-            And([
-                Not(null),
-                in_group,
-                And([
-                    Implies(
-                        And([prev_in_group, Not(prev_null)]),
-                        val != prev_val
-                    )
-                    for prev_val, prev_null, prev_in_group in args[:idx]
-                ])
-            ]),
-            val,
-            Int(0)
-        )
-        for idx, (val, null, in_group) in enumerate(args)
-    ])
+def GroupSum_Distinct(args, first):
+    val = Sum([If(is_first, val, Int(0)) for is_first, (val, _, _) in zip(first, args)])
     return val, And([Implies(in_group, null) for _, null, in_group in args])
 
 
@@ -150,9 +121,9 @@ def GroupAvg(args):
     return val, And([Implies(in_group, null) for _, null, in_group in args])
 
 
-def GroupAvg_Distinct(args):
-    sum_distinct_val, _ = GroupSum_Distinct(args)
-    count_distinct_val, _ = GroupCount_Distinct(args)
+def GroupAvg_Distinct(args, first):
+    sum_distinct_val, _ = GroupSum_Distinct(args, first)
+    count_distinct_val, _ = GroupCount_Distinct(args, first)
     val = sum_distinct_val / count_distinct_val
     return val, And([Implies(in_group, null) for _, null, in_group in args])
 
@@ -166,7 +137,6 @@ class GroupExpressionEncoder:
         self.env = env
         if projected_list is not None:
             self.projected_list = projected_list
-        self.subquery_table_map = {}
 
     def expression_for_group(self, exp, group_id: int, convert_to_bool=False):
         self.group_id = group_id
@@ -179,6 +149,80 @@ class GroupExpressionEncoder:
             val = (val != Int(0))
         return val, null
 
+    def distinct_values(self, args):
+        prefix = self.env.formulas.next_definition_name(
+            f'groupdistinct_{symbol(self.groupby_table.table_id, self.group_id)}_'
+        )
+        return distinct_values(self.env, prefix, [(val, null, Not(in_group)) for val, null, in_group in args])
+
+    def reduce(self, prefix):
+        if self.env.aggregate_encoding == 'tournament':
+            prefix = self.env.formulas.next_definition_name(
+                f'{prefix}_{symbol(self.groupby_table.table_id, self.group_id)}_'
+            )
+            return functools.partial(tournament, self.env, prefix)
+        return functools.reduce
+
+    def aggregate(self, node):
+        if node.operator == 'count' and not node.args[0] and isinstance(node.args[1], Attribute) and node.args[1].name == '*':
+            in_groups = [SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
+                         for tuple_id in range(self.input_table.bound)]
+            return Sum([If(in_group, Int(1), Int(0)) for in_group in in_groups]), Bool(False)
+
+        if node.operator == 'avg' and not node.args[0]:
+            # shares the terms of SUM and COUNT over the same argument
+            sum_val, sum_null = self.visit_Expression(Expression(operator='sum', args=node.args, agg_filter=node.agg_filter))
+            count_val, _ = self.visit_Expression(Expression(operator='count', args=node.args, agg_filter=node.agg_filter))
+            return sum_val / count_val, sum_null
+
+        agg_exp_encoder = ExpressionEncoder(self.input_table, self.env)
+
+        # find
+        to_be_aggregated = []
+        for tuple_id in range(self.input_table.bound):
+            val, null = agg_exp_encoder.expression_for_tuple(node.args[1], tuple_id)
+            if val.return_type() == 'Bool':
+                val = If(val, Int(1), Int(0))
+            
+            if node.agg_filter:
+                f_val, f_null = agg_exp_encoder.expression_for_tuple(node.agg_filter, tuple_id)
+                f_val = EnsureBool(f_val)
+                row_in_group = And([
+                                    SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id),
+                                    Not(f_null),
+                                    f_val
+                ])
+                #ret = (f_val, f_null, row_in_group)
+            else: 
+                row_in_group = SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
+                # ret is a (val, null, in_group) pair
+                # ret = (
+                #     val,
+                #     null,
+                #     SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
+                # )
+
+            ret = (val, null, row_in_group)
+            to_be_aggregated.append(ret)
+
+        match node.operator:
+            case 'max':
+                return GroupMax(to_be_aggregated, self.reduce('groupmax'))
+            case 'min':
+                return GroupMin(to_be_aggregated, self.reduce('groupmin'))
+            case 'count':
+                if node.args[0]:
+                    return GroupCount_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+                return GroupCount(to_be_aggregated)
+            case 'sum':
+                if node.args[0]:
+                    return GroupSum_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+                return GroupSum(to_be_aggregated)
+            case 'avg':
+                return GroupAvg_Distinct(to_be_aggregated, self.distinct_values(to_be_aggregated))
+            case _:
+                raise NotImplementedError
+
     def visit_Variable(self, var):
         return var.VAL, var.NULL
 
@@ -246,60 +290,14 @@ class GroupExpressionEncoder:
                 return node.args[0].accept(self)
 
             if node.operator in ['min', 'max', 'count', 'sum', 'avg']:
-                if node.operator == 'count' and not node.args[0] and isinstance(node.args[1], Attribute) and node.args[1].name == '*':
-                    in_groups = [SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
-                                 for tuple_id in range(self.input_table.bound)]
-                    return Sum([If(in_group, Int(1), Int(0)) for in_group in in_groups]), Bool(False)
-
-                agg_exp_encoder = ExpressionEncoder(self.input_table, self.env)
-
-                # find
-                to_be_aggregated = []
-                for tuple_id in range(self.input_table.bound):
-                    val, null = agg_exp_encoder.expression_for_tuple(node.args[1], tuple_id)
-                    if val.return_type() == 'Bool':
-                        val = If(val, Int(1), Int(0))
-                    
-                    if node.agg_filter:
-                        f_val, f_null = agg_exp_encoder.expression_for_tuple(node.agg_filter, tuple_id)
-                        f_val = EnsureBool(f_val)
-                        row_in_group = And([
-                                            SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id),
-                                            Not(f_null),
-                                            f_val
-                        ])
-                        #ret = (f_val, f_null, row_in_group)
-                    else: 
-                        row_in_group = SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
-                        # ret is a (val, null, in_group) pair
-                        # ret = (
-                        #     val,
-                        #     null,
-                        #     SMTGrouping(self.groupby_table.table_id, tuple_id, self.group_id)
-                        # )
-
-                    ret = (val, null, row_in_group)
-                    to_be_aggregated.append(ret)
-
-                match node.operator:
-                    case 'max':
-                        return GroupMax(to_be_aggregated)
-                    case 'min':
-                        return GroupMin(to_be_aggregated)
-                    case 'count':
-                        if node.args[0]:
-                            return GroupCount_Distinct(to_be_aggregated)
-                        return GroupCount(to_be_aggregated)
-                    case 'sum':
-                        if node.args[0]:
-                            return GroupSum_Distinct(to_be_aggregated)
-                        return GroupSum(to_be_aggregated)
-                    case 'avg':
-                        if node.args[0]:
-                            return GroupAvg_Distinct(to_be_aggregated)
-                        return GroupAvg(to_be_aggregated)
-                    case _:
-                        raise NotImplementedError
+                key = (
+                    node.operator, repr(node.args[0]), repr(node.args[1]), repr(node.agg_filter),
+                    self.groupby_table.table_id, self.input_table.table_id, self.group_id
+                )
+                self.env.metrics.lookup('aggregate', key in self.env.formulas.aggregate_cache)
+                if key not in self.env.formulas.aggregate_cache:
+                    self.env.formulas.aggregate_cache[key] = self.aggregate(node)
+                return self.env.formulas.aggregate_cache[key]
             elif node.operator == 'ifnull':
                 if_val, if_null = node.args[0].accept(self)
                 default_val, default_null = node.args[1].accept(self)
@@ -351,6 +349,9 @@ class GroupExpressionEncoder:
                 ])
                 return val, null
             elif node.operator == 'coalesce':
+                if self.env.aggregate_encoding == 'tournament' and len(node.args) > 2:
+                    return self.reduce('coalesce')(Coalesce2, [arg.accept(self) for arg in node.args])
+
                 def Next(idx):
                     val, null = node.args[idx].accept(self)
                     if idx >= len(node.args) - 1:
@@ -459,14 +460,7 @@ class GroupExpressionEncoder:
         return val, null
 
     def visit_Query(self, node):
-        from polygon.visitors.query_encoder import QueryEncoder
-
-        if str(node) in self.subquery_table_map:
-            sub_table = self.subquery_table_map[str(node)]
-        else:
-            visitor = QueryEncoder(self.env)
-            sub_table = node.accept(visitor)
-            self.subquery_table_map[str(node)] = sub_table
+        sub_table = self.env.subquery_table(node)
 
         return self.env.cell(sub_table.table_id, 0, 0), self.env.null(sub_table.table_id, 0, 0)
 
@@ -23,7 +23,6 @@ class JoinPredicateEncoder(PredicateEncoder):
         self.predicate = predicate
         self.env = env
         self.tuple_idx_pair = None
-        self.subquery_table_map = {}
 
     def predicate_for_tuple_pair(self, left_idx: int, right_idx: int):
         self.tuple_idx_pair = (left_idx, right_idx)
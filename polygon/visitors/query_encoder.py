@@ -34,7 +34,8 @@ class QueryEncoder:
     def visit_Query(self, node: Query) -> Tuple[TableSchema, TableSchema]:
         if not node.initialized:
             initializer = Initializer(self.env)
-            node.accept(initializer)
+            with self.env.tracer.span('initialize'):
+                node.accept(initializer)
             node.initialized = True
 
         # WITH clause
@@ -75,7 +76,8 @@ class QueryEncoder:
     def visit_Union(self, node) -> Tuple[TableSchema, TableSchema]:
         if not self.env.initialized and not node.initialized:
             initializer = Initializer(self.env)
-            node.accept(initializer)
+            with self.env.tracer.span('initialize'):
+                node.accept(initializer)
             node.initialized = True
 
         output_tables = []
@@ -144,10 +146,11 @@ class QueryEncoder:
         return f.output
 
     def visit_GroupBy(self, node: GroupBy) -> Tuple[TableSchema, TableSchema]:
-        # k, branches = self.env.formulas.under_config[node.label]
+        # group ids are symbolic, so only the number of groups is bounded and no partitions are branched on
+        k, _ = self.env.formulas.under_config[node.label]
 
-        f = FGroupBy(self.output_table, node, self.env, self.output_table.bound)
-        f.output.ctx['groups_considered'] = [self.output_table.bound]
+        f = FGroupBy(self.output_table, node, self.env, k)
+        f.output.ctx['groups_considered'] = [f.output.bound]
         return f.output
 
     def visit_Filter(self, node: Filter) -> Tuple[TableSchema, TableSchema]:
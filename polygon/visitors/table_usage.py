@@ -0,0 +1,149 @@
+from polygon.ast.expressions.attribute import Attribute
+from polygon.ast.expressions.expression import Expression
+from polygon.ast.join import Join
+from polygon.ast.node import Node
+from polygon.ast.query import Query
+from polygon.ast.scan import Scan
+from polygon.ast.union import Union
+from polygon.formulas.cardinality import conjuncts
+
+# from the least to the most demanding
+ROLES = ['unused', 'subquery', 'lookup', 'driving']
+
+
+class TableUsage:
+    """
+    Finds how the queries use each base table: scanned as a driving table, joined on its primary key (lookup), or
+    only read in subqueries of expressions. A table takes the most demanding role over all queries.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.keys = {table['TableName'].lower(): {c['Name'].lower() for c in table['PKeys']} for table in schema}
+        self.usage = {table: 'unused' for table in self.keys}
+        self.in_subquery = False
+
+    def use(self, table: str, role: str):
+        table = table.lower()
+        if table in self.usage and ROLES.index(role) > ROLES.index(self.usage[table]):
+            self.usage[table] = role
+
+    def roles(self):
+        # referenced rows of a foreign key have to exist
+        for table in self.schema:
+            if self.usage[table['TableName'].lower()] != 'unused':
+                for fk in table['FKeys']:
+                    self.use(self.schema[int(fk['PTable'])]['TableName'], 'lookup')
+        return self.usage
+
+    def visit_Query(self, node: Query):
+        if node.cte:
+            for cte_query in node.cte.values():
+                cte_query.accept(self)
+
+        scans, lookups, conditions = [], [], []
+        self.from_items(node.from_clause, scans, lookups, conditions)
+        if node.where_clause is not None:
+            conditions.extend(conjuncts(node.where_clause.predicate))
+
+        for scan in scans:
+            if self.in_subquery:
+                self.use(scan.table, 'subquery')
+            elif scan in lookups and self.on_key(scan, conditions):
+                self.use(scan.table, 'lookup')
+            else:
+                self.use(scan.table, 'driving')
+
+        # subqueries in expressions
+        in_subquery = self.in_subquery
+        self.in_subquery = True
+        for clause in [node.where_clause, node.group_by_clause, node.select_clause, node.order_by_clause]:
+            if clause is not None:
+                clause.accept(self)
+        self.in_subquery = in_subquery
+
+    def visit_Union(self, node: Union):
+        for query in node.queries:
+            query.accept(self)
+
+    def from_items(self, node, scans, lookups, conditions):
+        match node:
+            case Scan():
+                scans.append(node)
+            case Join():
+                self.from_items(node.left, scans, lookups, conditions)
+                self.from_items(node.right, scans, lookups, conditions)
+                match node.join_type:
+                    case 'join' | 'inner join' | 'left join' | 'left outer join' | 'cross join':
+                        looked_up = node.right
+                    case 'right join' | 'right outer join':
+                        looked_up = node.left
+                    case _:
+                        looked_up = None
+                if isinstance(looked_up, Scan):
+                    lookups.append(looked_up)
+                    if node.using is not None:
+                        conditions.append(Expression(operator='eq', args=[
+                            Attribute(name=f'{self.scan_name(looked_up)}.{node.using.value}'),
+                            Attribute(name=node.using.value)
+                        ]))
+                if node.condition is not None:
+                    conditions.extend(conjuncts(node.condition))
+            case Query() | Union():
+                # derived tables are read like the tables of the enclosing query
+                node.accept(self)
+
+    @staticmethod
+    def scan_name(scan: Scan):
+        return (scan.alias if scan.alias is not None else scan.table).lower()
+
+    def on_key(self, scan: Scan, conditions):
+        key = self.keys.get(scan.table.lower())
+        if not key:
+            return False
+
+        name = self.scan_name(scan)
+        equated = set()
+        for conjunct in conditions:
+            if not (isinstance(conjunct, Expression) and conjunct.operator == 'eq' and len(conjunct.args) == 2):
+                continue
+            a, b = conjunct.args
+            for attribute, other in [(a, b), (b, a)]:
+                if not (isinstance(attribute, Attribute) and isinstance(other, Attribute)):
+                    continue
+                qualifier, _, column = attribute.name.lower().rpartition('.')
+                other_qualifier = other.name.lower().rpartition('.')[0]
+                if qualifier == name and column in key and other_qualifier != name:
+                    equated.add(column)
+        return key <= equated
+
+    def visit_Filter(self, node):
+        node.predicate.accept(self)
+
+    def visit_GroupBy(self, node):
+        for expression in [*node.expressions, node.having]:
+            if isinstance(expression, Node):
+                expression.accept(self)
+
+    def visit_Project(self, node):
+        for target in node.target_list:
+            target.accept(self)
+
+    def visit_OrderBy(self, node):
+        for expression in node.expressions:
+            expression.accept(self)
+
+    def visit_Expression(self, node):
+        for arg in [*node.args, node.agg_filter]:
+            if isinstance(arg, Node):
+                arg.accept(self)
+
+    def visit_CaseWhen(self, node):
+        for condition, result in node.cases:
+            condition.accept(self)
+            result.accept(self)
+        if node.default is not None:
+            node.default.accept(self)
+
+    def visit(self, node):
+        pass